@@ -27,8 +27,9 @@ SoftwareSerial bt(2, 3); // (RX/TX)
 
 byte c = ' ';
 
-byte rsp[] = {0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00};
-byte req[] = {0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00};
+// sized for the largest v2 frames (set pixels request 18, responses 10)
+byte rsp[10];
+byte req[18];
 
 const int MSG_SIZE = 8;
 
@@ -39,6 +40,19 @@ const byte MSG_RSP_SET_LED = 0x03;
 const byte MSG_BOOT = 0x04;
 const byte MSG_BUTTON = 0x06;
 
+// protocol v2, see the host's hc_vitaminder.py.  frames are [id, seq, payload..., crc8]
+const byte MSG_REQ_HELLO = 0x08;
+const byte MSG_RSP_HELLO = 0x09;
+const byte MSG_REQ_SET_PIXELS = 0x0A;
+const byte MSG_RSP_SET_PIXELS = 0x0B;
+const byte MSG_REQ_HEARTBEAT_V2 = 0x0C;
+const byte MSG_RSP_HEARTBEAT_V2 = 0x0D;
+const int SET_PIXELS_SIZE = 18;
+const int HEARTBEAT_V2_SIZE = 3;
+const int V2_RSP_SIZE = 10;
+const byte PROTO_VERSION = 2;
+const byte CAP_BATCH = 0x01;
+
 const int PIXEL_PIN = 8;
 const int PIXEL_COUNT = 4;
 const int DEFAULT_BRIGHTNESS = 128;
@@ -142,8 +156,20 @@ void loop() {
   }
 
   if (bt.available()) {
-    len = bt.readBytes(req, MSG_SIZE);
-    if (len == MSG_SIZE) {
+    // v2 frames differ in length, peek at the ID to know how much to read
+    int size = MSG_SIZE;
+    int id = bt.peek();
+    if (id == MSG_REQ_SET_PIXELS) {
+      size = SET_PIXELS_SIZE;
+    } else if (id == MSG_REQ_HEARTBEAT_V2) {
+      size = HEARTBEAT_V2_SIZE;
+    }
+    len = bt.readBytes(req, size);
+    if (len == size && size == MSG_SIZE && req[0] == MSG_REQ_HELLO) {
+      handleHello();
+    } else if (len == size && size != MSG_SIZE) {
+      handleV2();
+    } else if (len == MSG_SIZE) {
       Serial.println("received full msg");
 
       if (req[0] == MSG_REQ_HEARTBEAT) {
@@ -230,6 +256,73 @@ void loop() {
   }
 }
 
+byte crc8(byte *data, int len) {
+  // CRC-8, polynomial 0x07, init 0
+  byte crc = 0;
+  for (int i = 0; i < len; i++) {
+    crc ^= data[i];
+    for (int b = 0; b < 8; b++) {
+      crc = (crc & 0x80) ? (crc << 1) ^ 0x07 : (crc << 1);
+    }
+  }
+  return crc;
+}
+
+void handleHello() {
+  if (crc8(req, MSG_SIZE - 1) != req[MSG_SIZE - 1]) {
+    Serial.println("hello with bad crc");
+    return;
+  }
+  Serial.println("msg 8 - hello");
+
+  rsp[0] = MSG_RSP_HELLO;
+  rsp[1] = req[1] < PROTO_VERSION ? req[1] : PROTO_VERSION;
+  rsp[2] = CAP_BATCH;
+  rsp[3] = PIXEL_COUNT;
+  rsp[4] = 0x00;
+  rsp[5] = 0x00;
+  rsp[6] = 0x00;
+  rsp[7] = crc8(rsp, MSG_SIZE - 1);
+  bt.write(rsp, MSG_SIZE);
+}
+
+void handleV2() {
+  int size = req[0] == MSG_REQ_SET_PIXELS ? SET_PIXELS_SIZE : HEARTBEAT_V2_SIZE;
+  if (crc8(req, size - 1) != req[size - 1]) {
+    // no response, the host times out and sends it again
+    Serial.println("v2 msg with bad crc");
+    return;
+  }
+
+  haveContact();
+
+  if (req[0] == MSG_REQ_SET_PIXELS) {
+    Serial.println("msg A - set pixels");
+    FastLED.setBrightness(req[2]);
+    for (int pixelIdx = 0; pixelIdx < PIXEL_COUNT; pixelIdx++) {
+      pixels[pixelIdx] = CRGB(req[3 + 3 * pixelIdx], req[4 + 3 * pixelIdx], req[5 + 3 * pixelIdx]);
+    }
+    // bytes 15,16 have blink_off and blink_on durations (div by 10)
+    // TODO implement blinking
+    FastLED.show();
+    rsp[0] = MSG_RSP_SET_PIXELS;
+  } else {
+    rsp[0] = MSG_RSP_HEARTBEAT_V2;
+  }
+
+  // echo the sequence number so the host can pair the response with its request
+  rsp[1] = req[1];
+  rsp[2] = FastLED.getBrightness();
+  rsp[3] = pixels[VIT_PIX].r;
+  rsp[4] = pixels[VIT_PIX].g;
+  rsp[5] = pixels[VIT_PIX].b;
+  rsp[6] = pixels[SYS_PIX].r;
+  rsp[7] = pixels[SYS_PIX].g;
+  rsp[8] = pixels[SYS_PIX].b;
+  rsp[9] = crc8(rsp, V2_RSP_SIZE - 1);
+  bt.write(rsp, V2_RSP_SIZE);
+}
+
 void clearPixels() {
   for (int i=0; i<PIXEL_COUNT; i++) {
     pixels[i] = CRGB::Black;
@@ -1,10 +1,30 @@
+from time import perf_counter, time as wall_clock
+# before anything else is imported, --profile-startup counts the imports from here
+IMPORT_STARTED = perf_counter()
+
 import threading
-from queue import Queue
 from enum import Enum, auto
-import serial
 import sys
 from datetime import datetime, timedelta, date, time
-import configparser
+import logging
+import os
+
+# asyncio, serial and configparser are imported where they are used: a Pi Zero spends most of
+# its start up importing, and the GUI, the threaded daemon and a config snapshot each need only some
+
+from hc_vitaminder_proto import VitFrameDecoder, MSG_REQ_SET_LED, MSG_REQ_HELLO, MSG_REQ_SET_PIXELS, \
+    MSG_REQ_HEARTBEAT_V2, MSG_RSP_HEARTBEAT_V2, FRAME_SIZES, SEQUENCED, PROTO_V1, PROTO_V2, CAP_BATCH, PIXEL_COUNT, SYS_PIX, VIT_PIX, hello_frame, \
+    sequenced, set_pixels_payload, rsp_echo, button_frame
+from hc_vitaminder_anim import VitAnimator, AnimPattern, TokenBucket
+from hc_vitaminder_journal import VitJournal, REC_SNAPSHOT, REC_TRANSITION, REC_BUTTON, BUTTON_OK, \
+    BUTTON_SNOOZE
+from hc_vitaminder_link import VitRequestTracker
+from hc_vitaminder_liveness import VitLiveness, retry_span
+from hc_vitaminder_metrics import VitMetrics, registry
+from hc_vitaminder_queue import VitEventQueue, PRIO_URGENT, PRIO_INPUT, PRIO_LOW
+from hc_vitaminder_rules import VitRules, compile_rules, medications_from_config, LEVEL_NAILED, \
+    LEVEL_UNMEDICATED, LEVEL_SNOOZED, LEVEL_SOFT, LEVEL_HARD
+from hc_vitaminder_supervisor import VitLinkSupervisor, Backoff
 
 # server message definitions (ones sent out from python):
 # id=00: heartbeat request
@@ -49,36 +69,394 @@ import configparser
 #       none, it is likely (but not required) the host will send a "set LED" message soon,
 #       since a button press typically triggers a state change.
 
+# protocol v2 (hc_vitaminder_proto.py), negotiated with HELLO and backward compatible:
+# until the device answers HELLO, and after every BOOT, everything is v1 as above.
+# v2 frames are [id, seq, payload..., crc8], the CRC-8 (poly 0x07) covers every byte before it.
+# id=08: hello (8 bytes, a v1 firmware reads it whole and ignores it)
+#   req bytes:
+#       0 - message ID 0x08
+#       1 - highest protocol version the host speaks
+#       2 - host capability bits (0x01 batch pixel frames)
+#       3-6 - zero
+#       7 - crc8
+#   rsp bytes (8):
+#       0 - 0x09
+#       1 - protocol version the device will speak
+#       2 - device capability bits
+#       3 - pixel count
+#       4-6 - zero
+#       7 - crc8
+# id=0A: set pixels, every pixel its own color in one frame (18 bytes)
+#   req bytes:
+#       0 - message ID 0x0A
+#       1 - sequence number
+#       2 - brightness
+#       3-14 - r, g, b for pixels 0-3
+#       15 - off millis duration (div by 10)
+#       16 - on millis duration (div by 10)
+#       17 - crc8
+#   only used when the pixels need more than one color, a single color still goes out as
+#   the shorter 0x02 frame
+#   rsp bytes (10):
+#       0 - 0x0B
+#       1 - sequence number of the request
+#       2 - led brightness
+#       3-5 - vita LED r, g, b
+#       6-8 - sys  LED r, g, b
+#       9 - crc8
+# id=0C: heartbeat (3 bytes: 0x0C, seq, crc8)
+#   rsp bytes (10): 0x0D, seq, then the same 8 bytes as the set pixels response
+
+
+log = logging.getLogger("hc_vitaminder")
+
 
 def rgb_from_config(color_str="0,0,0"):
-    return [int(c) for c in color_str.split(',')]
+    rgb = [int(c) for c in color_str.split(',')]
+    if len(rgb) != 3 or not all(0 <= c <= 255 for c in rgb):
+        raise ValueError("color %r is not r,g,b with each 0-255" % color_str)
+    return rgb
+
+
+def build_set_led_frame(brightness, rgb, pixel_mask=0x0F, blink_off=25, blink_on=75):
+    #   req bytes:
+    #       0 - message ID 0x02
+    #       1 - brightness
+    #       2 - pixel mask (least significant nibble represents the 4 pixels)
+    #       3 - red
+    #       4 - green
+    #       5 - blue
+    #       6 - off millis duration (div by 10) (off=0 means constant on)
+    #       7 - on millis duration (div by 10)
+    return bytes([0x02, brightness, pixel_mask, rgb[0], rgb[1], rgb[2], blink_off, blink_on])
+
+
+class LedPlan:
+    # what the pixels should look like in one state, and the frames that get them there
+    def __init__(self, brightness, pixels, blink_off=25, blink_on=75):
+        self.brightness = brightness
+        self.pixels = tuple(tuple(rgb) for rgb in pixels)
+        self.blink_off = blink_off
+        self.blink_on = blink_on
+        # what a response reports once the device shows this plan
+        self.echo = bytes([brightness]) + bytes(self.pixels[VIT_PIX]) + bytes(self.pixels[SYS_PIX])
+
+        # v1: one set-LED frame per distinct color, one frame for the usual all-alike case
+        masks = {}
+        for i, rgb in enumerate(self.pixels):
+            masks[rgb] = masks.get(rgb, 0) | (1 << i)
+        self.v1_frames = self.frames_for_masks(masks)
+
+        # v2: the SET_PIXELS payload, sequence number and CRC go on at send time
+        self.v2_payload = set_pixels_payload(brightness, self.pixels, blink_off, blink_on)
+
+    def frames_for_masks(self, masks):
+        return tuple(build_set_led_frame(self.brightness, rgb, mask, self.blink_off, self.blink_on)
+                     for rgb, mask in masks.items())
+
+    def v1_delta(self, shown):
+        # v1 frames for only the pixels that differ from the plan the device shows
+        if shown.brightness != self.brightness:
+            return self.v1_frames
+        masks = {}
+        for i, rgb in enumerate(self.pixels):
+            if rgb != shown.pixels[i]:
+                masks[rgb] = masks.get(rgb, 0) | (1 << i)
+        return self.frames_for_masks(masks)
+
+    def owns(self, frame):
+        # is this frame (possibly an older send of it) part of the plan
+        if frame[0] == MSG_REQ_SET_PIXELS:
+            return frame[2:-1] == self.v2_payload
+        if frame[0] != MSG_REQ_SET_LED or frame[1] != self.brightness:
+            return False
+        rgb = tuple(frame[3:6])
+        return all(self.pixels[i] == rgb for i in range(PIXEL_COUNT) if frame[2] & (1 << i))
+
+    def scaled(self, level):
+        # animation keyframe: the vit pixels dimmed to level (0..1), the sys pixel left alone.
+        # the colors are scaled rather than the brightness byte, which would dim the sys LED too
+        pixels = [rgb if i == SYS_PIX else tuple(int(round(c * level)) for c in rgb)
+                  for i, rgb in enumerate(self.pixels)]
+        return LedPlan(self.brightness, pixels, 0, 0)
+
+
+class VitConfig:
+    # compiled snapshot of a config section, everything the hot paths need is parsed once here
+    # instead of string lookups and int()/fromisoformat() on every call.
+    #
+    # read-only once built: a changed config file is compiled into a new VitConfig, which
+    # raises ValueError (or KeyError for a missing key) when it doesn't hold up, and the
+    # controller swaps it in whole (Vitaminder.apply_config), so nobody sees half of each
+    def __init__(self, config):
+        # section name when loaded from a multi-device config, "DEFAULT" otherwise
+        self.name = getattr(config, "name", None)
+        self.comm_port = config["comm_port"]
+        self.comm_read_timeout = int(config["comm_read_timeout"])
+        self.msg_size = int(config["msg_size"])
+
+        # every medication's windows, weekdays and snooze length in one interval index
+        # (hc_vitaminder_rules.py), devices with the same schedules share it
+        self.rules = compile_rules(medications_from_config(config))
+
+        self.heartbeat_thread_sleep_sec = int(config["heartbeat_thread_sleep_sec"])
+        self.dummy_thread_sleep_sec = config.getint("dummy_thread_sleep_sec", fallback=1200)
+
+        self.request_timeout_sec = config.getfloat("request_timeout_sec", fallback=2.0)
+        self.request_max_retries = config.getint("request_max_retries", fallback=3)
+        self.request_backoff = config.getfloat("request_backoff", fallback=2.0)
+        self.ctl_thread_sleep_sec = int(config["ctl_thread_sleep_sec"])
+
+        # heartbeats only go out once the link has been quiet for long enough that the firmware's
+        # solitude timer (device_solitude_sec) could otherwise run out before one gets through,
+        # retries and heartbeat_margin_sec included.  heartbeat_thread_sleep_sec caps the quiet time
+        self.device_solitude_sec = config.getfloat("device_solitude_sec", fallback=300.0)
+        self.heartbeat_margin_sec = config.getfloat("heartbeat_margin_sec", fallback=10.0)
+        self.liveness_margin_sec = self.heartbeat_margin_sec + retry_span(self.request_timeout_sec,
+                                                                          self.request_max_retries,
+                                                                          self.request_backoff)
+        self.event_queue_size = config.getint("event_queue_size", fallback=256)
+
+        # state journal, an empty journal_dir keeps everything in memory like before
+        self.journal_dir = config.get("journal_dir", fallback="")
+        self.journal_fsync_sec = config.getfloat("journal_fsync_sec", fallback=1.0)
+        self.journal_fsync_batch = config.getint("journal_fsync_batch", fallback=32)
+        self.journal_snapshot_every = config.getint("journal_snapshot_every", fallback=1000)
+        self.journal_max_records = config.getint("journal_max_records", fallback=100000)
+
+        # link drops: reconnect attempts back off from reconnect_initial_sec to reconnect_max_sec,
+        # set-LED frames written meanwhile wait in an outbox of link_outbox_size frames
+        self.reconnect_initial_sec = config.getfloat("reconnect_initial_sec", fallback=0.5)
+        self.reconnect_max_sec = config.getfloat("reconnect_max_sec", fallback=30.0)
+        self.reconnect_jitter = config.getfloat("reconnect_jitter", fallback=0.5)
+        self.link_outbox_size = config.getint("link_outbox_size", fallback=8)
+
+        # highest protocol version to negotiate, 1 never sends HELLO
+        self.protocol_version = config.getint("protocol_version", fallback=PROTO_V2)
+
+        # the pixels for each state with their frames prebuilt, ready to hand to the port.
+        # the sys LED follows the vit LED unless sys_color_<state> says otherwise
+        self.led_plans = {}
+        for state, key in [(VitState.UNMEDICATED, "unmedicated"),
+                           (VitState.NAILED_IT, "nailed_it"),
+                           (VitState.SOFT_REMINDER, "soft_reminder"),
+                           (VitState.HARD_REMINDER, "hard_reminder"),
+                           (VitState.SNOOZE, "snooze")]:
+            vit = rgb_from_config(config["color_" + key])
+            sys_ = rgb_from_config(config.get("sys_color_" + key, fallback=config["color_" + key]))
+            pixels = [vit] * PIXEL_COUNT
+            pixels[SYS_PIX] = sys_
+            # blinking is done by the host now (see below), the device is told to stay on
+            self.led_plans[state] = LedPlan(int(config["brightness_" + key]), pixels, 0, 0)
+        self.default_plan = LedPlan(128, [[128, 0, 255]] * PIXEL_COUNT, 0, 0)
+
+        # LED animation per state (hc_vitaminder_anim.py).  pattern_<state> is solid, blink, fade
+        # or pulse; without one the reminders blink when blink_soft_* / blink_hard_* say so
+        self.led_patterns = {}
+        for state, key, blink_key in [(VitState.UNMEDICATED, "unmedicated", "unmedicated"),
+                                      (VitState.NAILED_IT, "nailed_it", "nailed_it"),
+                                      (VitState.SOFT_REMINDER, "soft_reminder", "soft"),
+                                      (VitState.HARD_REMINDER, "hard_reminder", "hard"),
+                                      (VitState.SNOOZE, "snooze", "snooze")]:
+            blink_off = config.getint("blink_%s_off" % blink_key, fallback=0)
+            blink_on = config.getint("blink_%s_on" % blink_key, fallback=0)
+            kind = config.get("pattern_" + key, fallback="blink" if blink_off > 0 else "solid")
+            if kind == "blink":
+                pattern = AnimPattern(kind, (blink_off + blink_on) / 1000.0, blink_on / 1000.0)
+            else:
+                pattern = AnimPattern(kind, config.getint("pattern_period_ms_" + key, fallback=2000) / 1000.0)
+            if pattern.animated:
+                self.led_patterns[state] = pattern
+
+        # host -> device byte budget.  link_budget_share of the line is what we allow ourselves,
+        # animation frames only get what heartbeats and state changes leave of it
+        self.link_baud = config.getint("link_baud", fallback=9600)
+        self.link_budget_share = config.getfloat("link_budget_share", fallback=0.5)
+        self.link_burst_bytes = config.getint("link_burst_bytes", fallback=36)
+        self.anim_max_fps = config.getint("anim_max_fps", fallback=20)
+
+        # seconds between looks at the config file for changes, 0 = only on SIGHUP
+        self.config_watch_sec = config.getfloat("config_watch_sec", fallback=2.0)
+
+        self.check()
+        self.frozen = True
+
+    def check(self):
+        for name in ("comm_read_timeout", "msg_size", "heartbeat_thread_sleep_sec", "ctl_thread_sleep_sec",
+                     "request_timeout_sec", "reconnect_initial_sec", "reconnect_max_sec", "link_baud",
+                     "link_budget_share", "link_burst_bytes", "anim_max_fps"):
+            if getattr(self, name) <= 0:
+                raise ValueError("%s must be more than 0, not %s" % (name, getattr(self, name)))
+        if self.device_solitude_sec - self.liveness_margin_sec <= 0:
+            raise ValueError("device_solitude_sec (%s) leaves no time between heartbeats after %.1f s for the "
+                             "retries and heartbeat_margin_sec" % (self.device_solitude_sec, self.liveness_margin_sec))
+        for name in ("request_max_retries", "event_queue_size", "link_outbox_size", "config_watch_sec",
+                     "heartbeat_margin_sec"):
+            if getattr(self, name) < 0:
+                raise ValueError("%s can't be negative, not %s" % (name, getattr(self, name)))
+        if not 0.0 <= self.reconnect_jitter <= 1.0:
+            raise ValueError("reconnect_jitter must be between 0 and 1, not %s" % self.reconnect_jitter)
+        if self.protocol_version not in (PROTO_V1, PROTO_V2):
+            raise ValueError("protocol_version must be %d or %d, not %d" % (PROTO_V1, PROTO_V2, self.protocol_version))
+
+    def __setattr__(self, name, value):
+        if getattr(self, "frozen", False):
+            raise AttributeError("VitConfig is read-only, compile a new one and swap it in")
+        super().__setattr__(name, value)
+
+    def led_plan(self, state):
+        return self.led_plans.get(state, self.default_plan)
+
+    def led_pattern(self, state):
+        # None for states that just show their colors
+        return self.led_patterns.get(state)
 
 
 class Vitaminder:
-    def __init__(self, config=None):
+    def __init__(self, config=None, cfg=None, clock=wall_clock):
+        # cfg: an already compiled VitConfig (config snapshot), config is not read then.
+        # clock: epoch seconds, everything about the schedule goes by it (the scheduler handed
+        # to start_clock() must use the same one), see hc_vitaminder_timesim.py
         self.config = config
+        self.clock = clock
+        self.cfg = cfg if cfg is not None else VitConfig(config)
+        self.name = self.cfg.name
 
         self.port_name = None
         self.serial_port = None
         self.state = VitState.UNMEDICATED
-        self.current_date = date.today()
+        self.current_date = self.now().date()
         self.snooze_expiration = None
 
-        self.snooze_delta = timedelta(seconds=int(self.config["snooze_duration_seconds"]))
-
-        self.heartbeat_time = None
-        self.heartbeat_result = None
+        # what each medication is up to today, self.state is the most urgent of them
+        self.rules = VitRules(self.cfg.rules)
+
+        # when the device last answered us, a heartbeat is only sent when the link went quiet
+        self.liveness = VitLiveness(self.cfg.device_solitude_sec, self.cfg.liveness_margin_sec,
+                                    self.cfg.heartbeat_thread_sleep_sec, self.cfg.link_baud, self.clock)
+        self.heartbeat_timer = None
+
+        # last LED plan written, and what the device last confirmed it is showing (response echo)
+        self.led_plan_sent = None
+        self.led_echo_acked = None
+        self.led_writes_skipped = 0
+
+        # protocol spoken right now, v1 until the device answers our HELLO
+        self.protocol = PROTO_V1
+        self.seq = 0
+
+        # every byte we write is charged here (8N1, 10 bits a byte), animation frames wait for it
+        self.link_budget = TokenBucket(self.cfg.link_baud / 10.0 * self.cfg.link_budget_share,
+                                       self.cfg.link_burst_bytes)
+        self.animator = VitAnimator(self.link_budget, max_fps=self.cfg.anim_max_fps)
+        self.animation_timer = None
+
+        # is the link up, and what to do while it isn't (see hc_vitaminder_supervisor.py)
+        self.supervisor = VitLinkSupervisor(Backoff(initial=self.cfg.reconnect_initial_sec,
+                                                    maximum=self.cfg.reconnect_max_sec,
+                                                    jitter=self.cfg.reconnect_jitter),
+                                            outbox_size=self.cfg.link_outbox_size)
+
+        # heartbeat / set-LED requests waiting for their response.  on the schedule's clock, the
+        # round trips place the device's last contact on it and the timeouts run on its scheduler
+        self.requests = VitRequestTracker(timeout_sec=self.cfg.request_timeout_sec,
+                                          max_retries=self.cfg.request_max_retries,
+                                          backoff=self.cfg.request_backoff,
+                                          clock=self.clock)
+
+        # shared boundary scheduler (hc_vitaminder_sched.VitScheduler), see start_clock()
+        self.scheduler = None
+        self.transition_timer = None
+
+        # inbound byte stream -> frames, keeps its resync / bad frame counters across reads
+        self.decoder = VitFrameDecoder(FRAME_TYPES, frame_size=self.cfg.msg_size)
+
+        # append-only record of state changes and presses, replayed here so a restart
+        # picks up where the last run left off (NAILED_IT stays nailed)
+        self.journal = None
+        if self.cfg.journal_dir:
+            self.journal = VitJournal(os.path.join(self.cfg.journal_dir, "%s.journal" % (self.name or "DEFAULT")),
+                                      fsync_sec=self.cfg.journal_fsync_sec,
+                                      fsync_batch=self.cfg.journal_fsync_batch,
+                                      snapshot_every=self.cfg.journal_snapshot_every,
+                                      max_records=self.cfg.journal_max_records)
+            self.restore(self.journal.open())
+
+        # counters for the /metrics exporter (hc_vitaminder_metrics), only touched by the controller
+        self.metrics = VitMetrics()
+        registry.add_device(self)
 
         self.alive = True
         self.alive_lock = threading.Condition()
-        self.msg_lock = threading.Condition()
-        self.msg_queue = Queue()
+        self.msg_queue = VitEventQueue(EVENT_PRIORITIES, COALESCED_EVENTS, maxsize=self.cfg.event_queue_size,
+                                       unbounded=TIMER_EVENTS)
+
+        # only set when running in asyncio mode, see run_async()
+        self.loop = None
+        self.alive_event = None
+        self.transport = None
+
+        # StartupProfile while --profile-startup waits for the first frame to go out
+        self.startup = None
+
+        # hc_vitaminder_capture.VitTraceWriter (--capture), every port we open records into it
+        self.trace = None
+
+        # hc_vitaminder_shard.StateSlot when a shard worker runs us, our row of the fleet's state table
+        self.state_slot = None
+
+        # listener(v, old_state) for every state change, called on the controller (hc_vitaminder_api.py)
+        self.transition_listeners = []
+
+    def restore(self, rec):
+        if rec is None:
+            # fresh journal, start it off with what we have
+            self.record(REC_SNAPSHOT)
+            return
+        try:
+            state = VitState(rec.state)
+        except ValueError:
+            log.warning("journal %s ends in unknown state %d, ignoring it", self.journal.path, rec.state)
+            return
+        self.state = state
+        self.current_date = date.fromordinal(rec.day)
+        self.snooze_expiration = datetime.fromtimestamp(rec.snooze) if rec.snooze else None
+        self.rules.restore(STATE_LEVELS[state], self.snooze_expiration)
+        # a stale date or an expired snooze is sorted out by the first clock event
+        log.info("restored %s from journal (%d records replayed in %.1f ms)", self.state.name,
+                 self.journal.replayed, 1000.0 * self.journal.replay_sec)
+
+    def record(self, kind, detail=0):
+        if self.journal is None:
+            return
+        snooze = self.snooze_expiration.timestamp() if self.snooze_expiration is not None else 0.0
+        self.journal.append(kind, self.state.value, detail, self.current_date.toordinal(), snooze, self.clock())
+
+    def now(self):
+        # local wall clock time as the schedule sees it
+        return datetime.fromtimestamp(self.clock())
+
+    def open_port(self):
+        import serial
+
+        port = serial.Serial(self.cfg.comm_port, timeout=self.cfg.comm_read_timeout)
+        if self.trace is not None:
+            from hc_vitaminder_capture import CaptureSerial
+
+            port = CaptureSerial(port, self.trace)
+        return port
 
     def connect(self):
-        self.port_name = self.config["comm_port"]
-        print("connecting:", self.port_name)
-        self.serial_port = serial.Serial(self.port_name, timeout=int(self.config["comm_read_timeout"]))
-        print("connection status:", self.serial_port.isOpen())
+        self.port_name = self.cfg.comm_port
+        log.info("connecting: %s", self.port_name)
+        try:
+            self.serial_port = self.open_port()
+        except OSError as e:
+            # not there yet (out of range, rfcomm not bound), the serial reader keeps trying
+            self.link_lost(e)
+            return False
+        log.info("connection status: %s", self.serial_port.isOpen())
+        return True
 
     def disconnect(self):
         if self.is_connected():
@@ -87,61 +465,334 @@ class Vitaminder:
     def is_connected(self):
         return self.serial_port is not None and self.serial_port.isOpen()
 
+    def link_lost(self, error, port=None):
+        # any thread: reading or writing the port failed (serial.SerialException is an OSError too).
+        # port is the one that failed, a failure on a port a reconnect already replaced is old news
+        if port is not None and port is not self.serial_port:
+            return
+        if not self.supervisor.lost(error):
+            return
+        log.warning("%s: link lost: %s", self.name, error)
+        if self.transport is not None:
+            self.transport.close()
+        self.add_event(VitEvent(VitMsg.LINK_DOWN))
+
+    def reopen_port(self):
+        # called by the serial reader while the link is down (and by the hub when the port's device
+        # node comes back).  the old descriptor is dead either way, a fresh one replaces it
+        try:
+            port = self.open_port()
+        except OSError as e:
+            log.info("%s: reconnect attempt %d failed: %s", self.name, self.supervisor.attempts, e)
+            return False
+        if self.loop is not None:
+            from hc_vitaminder_aio import AsyncSerialPort
+
+            if self.transport is not None:
+                self.transport.close()
+            self.transport = AsyncSerialPort(port, on_lost=self.link_lost)
+        old_port, self.serial_port = self.serial_port, port
+        if old_port is not None:
+            try:
+                old_port.close()
+            except OSError:
+                pass
+        self.decoder.flush_partial()
+        downtime = self.supervisor.recovered()
+        if downtime is not None:
+            log.info("%s: link back after %.1f s", self.name, downtime)
+        self.add_event(VitEvent(VitMsg.LINK_UP))
+        return True
+
+    def handle_link_up(self):
+        # the device gets whatever LED frames were held back (only the latest state), or when
+        # nothing changed in the meantime, a heartbeat whose echo tells whether it still shows it
+        held = self.supervisor.take_held()
+        for frame in held:
+            self.write_frame(frame)
+        if held:
+            return
+        if self.led_echo_acked is None:
+            self.send_set_led_message(repaint=True)
+        else:
+            self.send_heartbeat()
+
     def __del__(self):
         self.disconnect()
 
-    def send_set_led_message(self):
-        # we basically need a brightness (just use default) and a color (base on state)
-        color_map = {
-            VitState.UNMEDICATED:   rgb_from_config(self.config["color_unmedicated"]),
-            VitState.NAILED_IT:     rgb_from_config(self.config["color_nailed_it"]),
-            VitState.SOFT_REMINDER: rgb_from_config(self.config["color_soft_reminder"]),
-            VitState.HARD_REMINDER: rgb_from_config(self.config["color_hard_reminder"]),
-            VitState.SNOOZE:        rgb_from_config(self.config["color_snooze"]),
-        }
-        brightness_map = {
-            VitState.UNMEDICATED:   int(self.config["brightness_unmedicated"]),
-            VitState.NAILED_IT:     int(self.config["brightness_nailed_it"]),
-            VitState.SOFT_REMINDER: int(self.config["brightness_soft_reminder"]),
-            VitState.HARD_REMINDER: int(self.config["brightness_hard_reminder"]),
-            VitState.SNOOZE:        int(self.config["brightness_snooze"])
-        }
-
-        rgb = color_map.get(self.state, [128, 0, 255])
-        brightness = brightness_map.get(self.state, 128)
-
-        # rgb = [0, 0, 255]
-        # TODO implement blinking for reminder states
-
-        blink_off = 25
-        blink_on = 75
-
-        pixel_mask = 0x0F
-
-        #   req bytes:
-        #       0 - message ID 0x02
-        #       1 - brightness
-        #       2 - pixel mask (least significant nibble represents the 4 pixels)
-        #       3 - red
-        #       4 - green
-        #       5 - blue
-        #       6 - off millis duration (div by 10) (off=0 means constant on)
-        #       7 - on millis duration (div by 10)
-
-        self.serial_port.write(bytes([0x02, brightness, pixel_mask, rgb[0], rgb[1], rgb[2], blink_off, blink_on]))
-
-    def time_update_thread(self, debug=False):
-        while self.alive:
-            if debug:
-                print("time_update() doing my thing")
-            self.update_state_by_time()
-            self.add_event(VitEvent(VitMsg.STATE))
-            self.alive_lock.acquire()
-            self.alive_lock.wait(int(self.config["time_update_thread_sleep_sec"]))
-            self.alive_lock.release()
+    def write_frame(self, frame, attempt=0):
+        # every outbound frame goes through here, asyncio mode hands it to the non-blocking transport
+        if not self.supervisor.up:
+            self.supervisor.hold(frame)
+            return
+        req = self.requests.sent(frame, attempt)
+        if req is not None and self.scheduler is not None:
+            req.timer = self.scheduler.call_later(req.timeout, self.add_event,
+                                                  VitEvent(VitMsg.REQUEST_TIMEOUT, req))
+
+        port = self.serial_port
+        try:
+            if self.transport is not None:
+                self.transport.write(frame)
+            else:
+                port.write(frame)
+        except OSError as e:
+            if req is not None:
+                self.requests.finish(req)
+            self.link_lost(e, port)
+            self.supervisor.hold(frame)
+            return
+        self.link_budget.charge(len(frame))
+        self.metrics.frame_out(len(frame))
+        if self.startup is not None:
+            self.startup.mark("first frame")
+            self.startup.report()
+            self.startup = None
+
+    def next_seq(self):
+        self.seq = (self.seq + 1) & 0xFF
+        return self.seq
+
+    def send_hello(self):
+        self.protocol = PROTO_V1
+        if self.cfg.protocol_version >= PROTO_V2:
+            self.write_frame(hello_frame(self.cfg.protocol_version, CAP_BATCH))
+
+    def send_heartbeat(self):
+        if self.protocol >= PROTO_V2:
+            frame = sequenced(MSG_REQ_HEARTBEAT_V2, self.next_seq())
+            round_trip = len(frame) + FRAME_SIZES[MSG_RSP_HEARTBEAT_V2]
+        else:
+            frame = bytes([0, 1, 1, 1, 1, 1, 1, 1])
+            round_trip = 2 * len(frame)
+        self.write_frame(frame)
+        self.liveness.heartbeat_sent(round_trip)
+
+    def handle_heartbeat(self, force=False):
+        # the liveness timer fired: only bother the link when nothing got answered for quiet_sec,
+        # then look again when that next runs out.  force (HEARTBEAT with data True) sends anyway
+        now = self.clock()
+        due = force or self.liveness.due(now)
+        if due:
+            self.send_heartbeat()
+        else:
+            self.liveness.heartbeat_skipped()
+        self.schedule_heartbeat(now, sent=due)
+
+    def schedule_heartbeat(self, now, sent=False):
+        if self.scheduler is None:
+            return
+        if self.heartbeat_timer is not None:
+            self.heartbeat_timer.cancel()
+        # after a heartbeat give its answer (and retries) a full quiet time to move last contact
+        when = now + self.liveness.quiet_sec if sent else self.liveness.next_heartbeat(now)
+        self.heartbeat_timer = self.scheduler.call_at(when, self.add_event, VitEvent(VitMsg.HEARTBEAT))
+
+    def send_set_led_message(self, repaint=False):
+        # frames are prebuilt per state, see VitConfig.  repaint: the device lost what it showed
+        pattern = self.cfg.led_pattern(self.state)
+        if pattern is not None and self.scheduler is not None:
+            plan = self.cfg.led_plan(self.state)
+            if self.animator.pattern is not pattern or self.animator.plan is not plan:
+                self.animator.start(plan, pattern, self.scheduler.clock(), sum(len(f) for f in self.led_frames(plan)))
+                repaint = True
+            self.animate(repaint)
+            return
+        self.stop_animation()
+
+        plan = self.cfg.led_plan(self.state)
+        frames = self.led_frames(plan)
+        if not frames:
+            # the device already shows exactly this, save the airtime
+            self.led_writes_skipped += 1
+            return
+        self.write_led_plan(plan, frames)
+
+    def led_frames(self, plan):
+        # the frames that take the device from what it last confirmed to plan, [] when it shows it already
+        if plan.echo == self.led_echo_acked:
+            return []
+        shown = self.led_plan_sent
+        if shown is not None and shown.echo == self.led_echo_acked:
+            # pixels the device confirmed showing don't need sending again (sys LED while animating)
+            frames = plan.v1_delta(shown)
+        else:
+            frames = plan.v1_frames
+        if self.protocol >= PROTO_V2 and len(frames) > 1:
+            # every pixel in one frame.  a single color stays on the 8 byte v1 frame, SET_PIXELS
+            # would be 28 bytes on air against 16, and the response echo checks it either way.
+            # the sequence number is stamped on in write_led_plan()
+            return [sequenced(MSG_REQ_SET_PIXELS, 0, plan.v2_payload)]
+        return list(frames)
+
+    def write_led_plan(self, plan, frames):
+        self.led_plan_sent = plan
+        for frame in frames:
+            if frame[0] in SEQUENCED:
+                frame = sequenced(frame[0], self.next_seq(), frame[2:-1])
+            self.write_frame(frame)
+
+    def animate(self, force=False):
+        # write the keyframe that is due (if the link budget allows) and set a timer for the next one
+        plan, frames, next_due = self.animator.step(self.scheduler.clock(), self.led_frames, force)
+        if frames:
+            self.write_led_plan(plan, frames)
+        if self.animation_timer is not None:
+            self.animation_timer.cancel()
+        self.animation_timer = self.scheduler.call_at(next_due, self.add_event, VitEvent(VitMsg.ANIMATE))
+
+    def stop_animation(self):
+        self.animator.stop()
+        if self.animation_timer is not None:
+            self.animation_timer.cancel()
+            self.animation_timer = None
+
+    def handle_led_response(self, e):
+        req, rtt, matched = self.requests.response(e.data)
+        if e.event_id == VitMsg.SERIAL_HEARTBEAT_RSP:
+            self.metrics.heartbeat_response()
+        if req is not None:
+            # any answered heartbeat or set-LED reset the firmware's solitude timer when it arrived
+            self.liveness.contact(self.clock() - rtt)
+
+        echo = rsp_echo(e.data)
+        if e.event_id == VitMsg.SERIAL_STATE_RSP:
+            if matched:
+                self.led_echo_acked = echo
+            else:
+                self.led_echo_acked = None
+                if req is not None and not self.animator.running and self.cfg.led_plan(self.state).owns(req.frame):
+                    # the device shows something other than what we asked for, ask again
+                    self.resend(req)
+        elif self.led_echo_acked is not None and echo != self.led_echo_acked:
+            # heartbeat says the pixels aren't what we think (solitude error wipes them), repaint
+            self.led_echo_acked = None
+            self.send_set_led_message(repaint=True)
+
+    def handle_hello_response(self, e):
+        self.requests.response(e.data)
+        version = min(e.data[1], self.cfg.protocol_version)
+        if version >= PROTO_V2 and e.data[2] & CAP_BATCH:
+            self.protocol = PROTO_V2
+        log.info("%s: device speaks protocol v%d", self.name, self.protocol)
+
+    def handle_request_timeout(self, req):
+        if not self.requests.expire(req):
+            # answered in the meantime
+            return
+        if req.kind == MSG_REQ_HELLO:
+            # v1 firmware ignores HELLO, no point asking again until it reboots
+            log.info("%s: no answer to HELLO, staying on protocol v1", self.name)
+            return
+        if req.kind in (MSG_REQ_SET_LED, MSG_REQ_SET_PIXELS) and (self.animator.running or
+                                                                  not self.cfg.led_plan(self.state).owns(req.frame)):
+            # the state moved on, a newer frame is already out there (or the next keyframe will be)
+            return
+        self.resend(req)
+
+    def resend(self, req):
+        if self.requests.should_retry(req):
+            frame = req.frame
+            if frame[0] in SEQUENCED:
+                # new number, a late answer to the old one must not count for this one
+                frame = sequenced(frame[0], self.next_seq(), frame[2:-1])
+            self.write_frame(frame, attempt=req.attempt + 1)
+        else:
+            log.warning("giving up on request %s after %d attempts", req.frame.hex(), req.attempt + 1)
+
+    def next_transition_time(self, now=None):
+        # the next instant update_state_by_time() could possibly come up with a different answer
+        if now is None:
+            now = self.now()
 
-        if debug:
-            print("time_update() end")
+        # midnight rollover always counts
+        candidates = [datetime.combine(self.current_date + timedelta(days=1), time())]
+
+        # a window edge or snooze expiry (nothing when everything is taken for the day)
+        when = self.rules.next_transition(now)
+        if when is not None:
+            candidates.append(when)
+
+        return min(candidates)
+
+    def schedule_next_transition(self):
+        if self.scheduler is None:
+            return
+        if self.transition_timer is not None:
+            self.transition_timer.cancel()
+        when = self.next_transition_time().timestamp()
+        self.transition_timer = self.scheduler.call_at(when, self.add_event, VitEvent(VitMsg.CLOCK))
+
+    def start_clock(self, scheduler):
+        # replaces the old 60 second poll: settle the state now, then only wake at real transitions
+        self.scheduler = scheduler
+        if self.journal is not None:
+            self.journal.scheduler = scheduler
+        self.add_event(VitEvent(VitMsg.CLOCK, True))
+        # the first heartbeat only when the state frames the clock sends aren't answered
+        self.schedule_heartbeat(scheduler.clock())
+
+    def handle_clock(self, e):
+        before = self.state
+        self.catch_up_clock()
+
+        # e.data is True for the first clock event, the device always gets the state then
+        if e.data:
+            self.send_hello()
+        if self.state != before or e.data:
+            self.send_set_led_message()
+
+    def catch_up_clock(self):
+        rolled_over = self.current_date != self.now().date()
+        self.update_state_by_time()
+        if rolled_over:
+            # the poller used to settle on the time based state one tick after the rollover
+            self.update_state_by_time()
+        self.schedule_next_transition()
+
+    def reload_config(self, config):
+        # any thread (the config watcher): compile and check the new section, the controller swaps
+        # it in.  False when it doesn't hold up, the running config stays
+        try:
+            cfg = VitConfig(config)
+        except (KeyError, ValueError) as e:
+            log.warning("%s: config not reloaded, keeping the running one: %s", self.name, e)
+            return False
+        self.add_event(VitEvent(VitMsg.RELOAD, cfg))
+        return True
+
+    def apply_config(self, cfg):
+        # controller: from here on everything reads the new snapshot.  the parts that copied
+        # settings at start up get them now, the LEDs change right away if their frame did
+        old, self.cfg = self.cfg, cfg
+        for name in RESTART_SETTINGS:
+            if getattr(old, name) != getattr(cfg, name):
+                log.warning("%s: %s changed, it takes effect on the next restart", self.name, name)
+
+        self.link_budget.rate = cfg.link_baud / 10.0 * cfg.link_budget_share
+        self.link_budget.burst = float(cfg.link_burst_bytes)
+        self.animator.max_fps = cfg.anim_max_fps
+        self.requests.timeout_sec = cfg.request_timeout_sec
+        self.requests.max_retries = cfg.request_max_retries
+        self.requests.backoff = cfg.request_backoff
+        self.supervisor.backoff.initial = cfg.reconnect_initial_sec
+        self.supervisor.backoff.maximum = cfg.reconnect_max_sec
+        self.supervisor.backoff.jitter = cfg.reconnect_jitter
+        self.msg_queue.maxsize = cfg.event_queue_size
+        self.rules = VitRules(cfg.rules).carry_over(self.rules)
+        self.liveness.configure(cfg.device_solitude_sec, cfg.liveness_margin_sec, cfg.heartbeat_thread_sleep_sec,
+                                cfg.link_baud)
+        self.schedule_heartbeat(self.clock())
+        log.info("%s: config reloaded", self.name)
+
+        if cfg.comm_port != old.comm_port:
+            # the reader reconnects, to the new port
+            self.link_lost(OSError("comm_port changed to %s" % cfg.comm_port), self.serial_port)
+        if cfg.protocol_version != old.protocol_version:
+            self.send_hello()
+
+        self.catch_up_clock()
+        self.send_set_led_message()
 
     def update_state_by_time(self):
         # if it is our first update after 2am of a new day,
@@ -157,182 +808,273 @@ class Vitaminder:
         #   2am - 6pm, UNMEDICATED
         #   6pm-7pm, SOFT_REMINDER
         #   7pm-2am, HARD_REMINDER
+        # (the default schedule, with several medications each goes through the above on its own)
 
-        if self.current_date is not None and self.current_date != date.today():
+        now = self.now()
+        if self.current_date is not None and self.current_date != now.date():
             # we have a new day! happy new year!
-            self.current_date = date.today()
+            self.current_date = now.date()
+            self.rules.new_day()
             self.snooze_expiration = None
             self.state = VitState.UNMEDICATED
             return
 
-        if self.state == VitState.NAILED_IT:
-            # congrats brah
-            return
+        # taken, snoozed and the windows are all in the rules, the device shows the most urgent medication
+        self.settle_state(now)
+        log.debug("update_state_by_time() %s", self.state.name)
 
-        if self.state == VitState.SNOOZE:
-            if datetime.now() < self.snooze_expiration:
-                # goto sleep; goto sleep; goto sleep, little baby
-                return
-            else:
-                # WAKE UP, SLEEPY HEAD!
-                self.snooze_expiration = None
-                self.state = VitState.UNMEDICATED
-
-        n = datetime.now().time()
-        unmed_begin = time.fromisoformat(self.config["boundary_unmedicated_begin"])
-        unmed_end = time.fromisoformat(self.config["boundary_unmedicated_end"])
-        soft_begin = time.fromisoformat(self.config["boundary_soft_reminder_begin"])
-        soft_end = time.fromisoformat(self.config["boundary_soft_reminder_end"])
-        # print("time.now()", n)
-        # print("unmed_begin", unmed_begin)
-        # print("unmed_end", unmed_end)
-        # print("soft_begin", soft_begin)
-        # print("soft_end", soft_end)
-
-        if unmed_begin <= n < unmed_end:
-            self.state = VitState.UNMEDICATED
-            print("update_state_by_time() UNMEDICATED")
-        elif soft_begin <= n < soft_end:
-            self.state = VitState.SOFT_REMINDER
-            print("update_state_by_time() SOFT_REMINDER")
-        else:
-            self.state = VitState.HARD_REMINDER
-            print("update_state_by_time() HARD_REMINDER")
+    def settle_state(self, now):
+        self.state = LEVEL_STATES[self.rules.level(now)]
+        self.snooze_expiration = self.rules.snooze_expiration()
 
     def handle_button_press(self, event):
-        # snooze button is only valid if current state is hard or soft reminder, or snooze (adds more time)
+        now = self.now()
         if event.data[2] == 0x01:
-            # snooze button
-            if self.state in [VitState.SNOOZE, VitState.SOFT_REMINDER, VitState.HARD_REMINDER]:
-                self.state = VitState.SNOOZE
-                self.snooze_expiration = datetime.now() + self.snooze_delta
+            # snooze button, snoozes whatever is reminding (soft, hard or already snoozed, which adds more time)
+            self.rules.snooze(now)
 
         elif event.data[1] == 0x01:
             # ok button
 
-            # if currently NAILED_IT, revert to whatever time-based state you should be in
-            # if not currently NAILED_IT, then NAIL_IT
-            if self.state != VitState.NAILED_IT:
-                self.state = VitState.NAILED_IT
-                self.snooze_expiration = None
-            else:
-                self.state = VitState.UNMEDICATED
-                self.update_state_by_time()
-
-            # mapper = {
-            #    VitState.UNMEDICATED: VitState.SOFT_REMINDER,
-            #    VitState.SOFT_REMINDER: VitState.HARD_REMINDER,
-            #    VitState.HARD_REMINDER: VitState.SNOOZE,
-            #    VitState.SNOOZE: VitState.NAILED_IT,
-            #    VitState.NAILED_IT: VitState.UNMEDICATED
-            # }
-            # self.state = mapper.get(self.state)
+            # takes the most urgent medication not taken yet.  once they are all taken (NAILED_IT)
+            # it reverts to whatever time-based state you should be in
+            self.rules.ok(now)
 
+        self.settle_state(now)
+
+        self.record(REC_BUTTON, (BUTTON_OK if event.data[1] == 0x01 else 0) |
+                    (BUTTON_SNOOZE if event.data[2] == 0x01 else 0))
+        self.schedule_next_transition()
         self.add_event(VitEvent(VitMsg.STATE))
 
+    def remote_press(self, ok, snooze):
+        # a press from somewhere other than the device (hc_vitaminder_api.py), queued as the same
+        # event the device's button frame becomes, so it goes through handle_button_press too
+        self.add_event(VitEvent(VitMsg.SERIAL_BUTTON, button_frame(ok, snooze)))
+
     def add_event(self, event):
-        self.msg_lock.acquire()
+        if self.loop is not None:
+            # asyncio mode, the queue belongs to the event loop (safe to call from any thread)
+            self.loop.call_soon_threadsafe(self.msg_queue.put_nowait, event)
+            return
+
+        # blocks while the controller is behind (see VitEventQueue for who is let in anyway)
         self.msg_queue.put(event)
-        self.msg_lock.notify_all()
-        self.msg_lock.release()
 
-    def serial_read_thread(self, debug=False):
+    def serial_read_thread(self):
         while self.alive:
-            msg = self.serial_port.read(int(self.config["msg_size"]))
-            if debug:
-                print("serial_read: looping")
-            if msg is None or len(msg) < int(self.config["msg_size"]):
-                if debug:
-                    print("serial_read: simply a timeout, msg is none")
+            if not self.supervisor.up:
+                self.reconnect_wait()
+                continue
+            port = self.serial_port
+            try:
+                # block for the first byte, then take whatever else already arrived
+                chunk = port.read(max(1, port.in_waiting))
+            except OSError as e:
+                self.link_lost(e, port)
+                continue
+            log.debug("serial_read: looping")
+            if not chunk:
+                log.debug("serial_read: simply a timeout")
+                # the line went quiet, a half frame sitting in the decoder is never finishing
+                self.decoder.flush_partial()
             else:
-                if debug:
-                    print("serial_read: have a message")
-                # create a message event and push it to the queue
-                msg_type = None
-                if msg[0] == 0x01:
-                    msg_type = VitMsg.SERIAL_HEARTBEAT_RSP
-                elif msg[0] == 0x03:
-                    msg_type = VitMsg.SERIAL_STATE_RSP
-                elif msg[0] == 0x04:
-                    msg_type = VitMsg.SERIAL_BOOT
-                elif msg[0] == 0x06:
-                    msg_type = VitMsg.SERIAL_BUTTON
-                e = VitEvent(msg_type, msg)
-                self.add_event(e)
-        if debug:
-            print("serial_read: end")
-
-    def dummy_thread(self, debug=False):
-        dummy_sleep_sec = int(self.config["dummy_thread_sleep_sec"])
-        if debug:
-            print("dummy() sleeping for", dummy_sleep_sec, "seconds")
+                self.handle_serial_bytes(chunk)
+        log.debug("serial_read: end")
+
+    def handle_serial_bytes(self, chunk):
+        self.metrics.bytes_in(len(chunk))
+        for msg_type, frame in self.decoder.feed(chunk):
+            log.debug("serial_read: have a message")
+            # frame is a view into the decoder's buffer, the event gets its own copy
+            self.add_event(VitEvent(msg_type, bytes(frame)))
+
+    def reconnect_wait(self):
+        # threaded mode, on the serial reader: one backoff delay, then one attempt
+        delay = self.supervisor.next_delay()
+        self.alive_lock.acquire()
+        self.alive_lock.wait(delay)
+        self.alive_lock.release()
+        if self.alive and not self.supervisor.up:
+            self.reopen_port()
+
+    def dummy_thread(self):
+        dummy_sleep_sec = self.cfg.dummy_thread_sleep_sec
+        log.debug("dummy() sleeping for %s seconds", dummy_sleep_sec)
         self.alive_lock.acquire()
         self.alive_lock.wait(dummy_sleep_sec)
         self.alive_lock.release()
 
-        if debug:
-            print("dummy() adding EXIT msg")
+        log.debug("dummy() adding EXIT msg")
         self.add_event(VitEvent(event_id=VitMsg.EXIT))
 
-    def heartbeat_thread(self, debug=False):
+    def wake_all(self):
+        # wake everybody up so they can exit cleanly
+        self.alive_lock.acquire()
+        self.alive_lock.notify_all()
+        self.alive_lock.release()
+        if self.alive_event is not None:
+            self.alive_event.set()
+
+    def handle_event(self, e):
+        # every state change goes through one of the handlers below, so this is the one
+        # place that sees them all (and times them)
+        started = perf_counter()
+        old_state = self.state
+
+        self.dispatch_event(e)
+
+        if self.state != old_state:
+            self.metrics.transition(old_state, self.state)
+            self.record(REC_TRANSITION, old_state.value)
+            for listener in self.transition_listeners:
+                listener(self, old_state)
+        self.metrics.event_handled(e.event_id.name, perf_counter() - started)
+        if self.state_slot is not None:
+            self.state_slot.update(self, e.event_id)
+
+    def dispatch_event(self, e):
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("ctl: %s %s %s", self.name, e.event_id, e.data)
+
+        if e.event_id == VitMsg.EXIT:
+            log.debug("ctl got exit message")
+            if self.journal is not None:
+                self.journal.close()
+            if self.trace is not None:
+                self.trace.close()
+            if self.heartbeat_timer is not None:
+                self.heartbeat_timer.cancel()
+            self.stop_animation()
+            self.msg_queue.close()
+            self.alive = False
+            self.wake_all()
+        else:
+            if e.event_id == VitMsg.HEARTBEAT:
+                self.handle_heartbeat(force=e.data is True)
+            elif e.event_id == VitMsg.STATE:
+                self.send_set_led_message()
+            elif e.event_id == VitMsg.ANIMATE:
+                if self.animator.running:
+                    self.animate()
+            elif e.event_id == VitMsg.CLOCK:
+                self.handle_clock(e)
+            elif e.event_id == VitMsg.REQUEST_TIMEOUT:
+                self.handle_request_timeout(e.data)
+            elif e.event_id == VitMsg.SERIAL_BOOT:
+                # device booted, send them current state info (whatever it showed before is gone).
+                # it may have been flashed with other firmware, so the protocol is negotiated again
+                self.led_echo_acked = None
+                self.send_hello()
+                self.send_set_led_message(repaint=True)
+            elif e.event_id in (VitMsg.SERIAL_STATE_RSP, VitMsg.SERIAL_HEARTBEAT_RSP):
+                self.handle_led_response(e)
+            elif e.event_id == VitMsg.SERIAL_HELLO_RSP:
+                self.handle_hello_response(e)
+            elif e.event_id == VitMsg.SERIAL_BUTTON:
+                # they pressed a button, DO SOMETHING!
+                self.handle_button_press(e)
+            elif e.event_id == VitMsg.LINK_DOWN:
+                # nothing in flight is getting an answer now, the retries would only be held back
+                self.requests.drop_all()
+            elif e.event_id == VitMsg.LINK_UP:
+                self.handle_link_up()
+            elif e.event_id == VitMsg.RELOAD:
+                self.apply_config(e.data)
+
+    def ctl_thread(self):
+        # keep reading messages for as long as we're alive, most urgent first
         while self.alive:
-            if debug:
-                print("hb() adding heartbeat message")
-            self.add_event(VitEvent(VitMsg.HEARTBEAT))
-            self.alive_lock.acquire()
-            self.alive_lock.wait(int(self.config["heartbeat_thread_sleep_sec"]))
-            self.alive_lock.release()
+            e = self.msg_queue.get(timeout=self.cfg.ctl_thread_sleep_sec)
+            if e is not None:
+                self.handle_event(e)
+            else:
+                log.debug("ctl done waiting")
+
+        log.debug("ctl end")
+
+    # asyncio mode - same controller, reader and clock as the threads above,
+    # but as coroutines sharing one event loop (and zero extra OS threads on posix)
+
+    async def sleep_async(self, seconds):
+        # the coroutine version of alive_lock.wait(), returns early when somebody calls wake_all()
+        import asyncio
+
+        try:
+            await asyncio.wait_for(self.alive_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
 
-        if debug:
-            print("hb() end")
+    async def ctl_task(self):
+        while self.alive:
+            e = await self.msg_queue.get_async()
+            self.handle_event(e)
 
-    def ctl_thread(self, debug=False, print_msg=True):
-        # acquire the lock
-        self.msg_lock.acquire()
+        log.debug("ctl end")
 
-        # keep reading messages for as long as we're alive
+    async def serial_read_task(self):
+        timeout = self.cfg.comm_read_timeout
         while self.alive:
-            # process messages
-            while not self.msg_queue.empty():
-                e = self.msg_queue.get()
-                if debug or print_msg:
-                    print("ctl: ", e.event_id)
-
-                if e.event_id == VitMsg.EXIT:
-                    if debug:
-                        print("ctl got exit message")
-                    self.alive = False
-                    # wake everybody up so they can exit cleanly
-                    self.alive_lock.acquire()
-                    self.alive_lock.notify_all()
-                    self.alive_lock.release()
-                else:
-                    if debug:
-                        print("ctl got non-exit message:", str(e.data))
-                    if e.event_id == VitMsg.HEARTBEAT:
-                        self.serial_port.write(bytes([0, 1, 1, 1, 1, 1, 1, 1]))
-                    elif e.event_id == VitMsg.STATE:
-                        self.send_set_led_message()
-                    elif e.event_id == VitMsg.SERIAL_BOOT:
-                        # device booted, send them current state info
-                        self.send_set_led_message()
-                    elif e.event_id == VitMsg.SERIAL_BUTTON:
-                        # they pressed a button, DO SOMETHING!
-                        self.handle_button_press(e)
-
-            # wait for new messages (temporarily releases the lock)
-            if self.alive:
-                self.msg_lock.wait(int(self.config["ctl_thread_sleep_sec"]))
-                if debug:
-                    print("ctl done waiting")
-
-        # release the lock
-        self.msg_lock.release()
-        if debug:
-            print("ctl end")
+            if not self.supervisor.up:
+                await self.sleep_async(self.supervisor.next_delay())
+                if self.alive and not self.supervisor.up:
+                    self.reopen_port()
+                continue
+            transport = self.transport
+            if transport is None or transport.closed:
+                await self.sleep_async(timeout)
+                continue
+            chunk = await transport.read_any(timeout)
+            log.debug("serial_read: looping")
+            if not chunk:
+                log.debug("serial_read: simply a timeout")
+                self.decoder.flush_partial()
+            else:
+                self.handle_serial_bytes(chunk)
+                # backpressure, stop reading while the controller is behind
+                await self.msg_queue.wait_for_room()
+        log.debug("serial_read: end")
+
+    async def run_async(self, timers=True):
+        # timers=False leaves the scheduler (clock and heartbeats) to somebody else (see VitaminderHub)
+
+        # lazy import keeps the threaded path free of asyncio and the transport module
+        import asyncio
+        from hc_vitaminder_aio import AsyncSerialPort
+        from hc_vitaminder_queue import AsyncVitEventQueue
+        from hc_vitaminder_sched import VitScheduler
+
+        self.loop = asyncio.get_running_loop()
+        self.alive_event = asyncio.Event()
+        self.msg_queue = AsyncVitEventQueue(EVENT_PRIORITIES, COALESCED_EVENTS, maxsize=self.cfg.event_queue_size,
+                                            unbounded=TIMER_EVENTS)
+
+        own_scheduler = None
+        if timers:
+            own_scheduler = VitScheduler()
+            own_scheduler.attach_loop(self.loop)
+            self.start_clock(own_scheduler)
+
+        if self.serial_port is not None:
+            self.transport = AsyncSerialPort(self.serial_port, on_lost=self.link_lost)
+        tasks = [
+            self.ctl_task(),
+            self.serial_read_task(),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            if own_scheduler is not None:
+                own_scheduler.stop()
+            if self.transport is not None:
+                self.transport.close()
+            self.transport = None
+            self.loop = None
 
 
 class VitEvent:
+    __slots__ = ("event_id", "data")
+
     def __init__(self, event_id, data=None):
         self.event_id = event_id
         self.data = data
@@ -346,6 +1088,47 @@ class VitMsg(Enum):
     SERIAL_BUTTON = auto()
     SERIAL_HEARTBEAT_RSP = auto()
     SERIAL_STATE_RSP = auto()
+    CLOCK = auto()
+    REQUEST_TIMEOUT = auto()
+    SERIAL_HELLO_RSP = auto()
+    ANIMATE = auto()
+    LINK_DOWN = auto()
+    LINK_UP = auto()
+    RELOAD = auto()
+
+
+# first byte of an inbound frame -> the event it turns into
+FRAME_TYPES = {
+    0x01: VitMsg.SERIAL_HEARTBEAT_RSP,
+    0x03: VitMsg.SERIAL_STATE_RSP,
+    0x04: VitMsg.SERIAL_BOOT,
+    0x06: VitMsg.SERIAL_BUTTON,
+    0x09: VitMsg.SERIAL_HELLO_RSP,
+    0x0B: VitMsg.SERIAL_STATE_RSP,
+    0x0D: VitMsg.SERIAL_HEARTBEAT_RSP,
+}
+
+
+# controller queue priority per event, anything not listed is PRIO_NORMAL
+EVENT_PRIORITIES = {
+    VitMsg.EXIT: PRIO_URGENT,
+    VitMsg.SERIAL_BUTTON: PRIO_INPUT,
+    VitMsg.SERIAL_BOOT: PRIO_INPUT,
+    VitMsg.LINK_DOWN: PRIO_INPUT,
+    VitMsg.LINK_UP: PRIO_INPUT,
+    VitMsg.HEARTBEAT: PRIO_LOW,
+}
+
+# events that only need handling once however many are waiting, they act on current state
+COALESCED_EVENTS = (VitMsg.STATE, VitMsg.HEARTBEAT)
+
+# what the scheduler's timers queue, let in even when the queue is full (see VitEventQueue)
+TIMER_EVENTS = (VitMsg.CLOCK, VitMsg.REQUEST_TIMEOUT, VitMsg.ANIMATE, VitMsg.HEARTBEAT)
+
+
+# read once at start up (journal, decoder, outbox), a reload only warns when they change
+RESTART_SETTINGS = ("msg_size", "journal_dir", "journal_fsync_sec", "journal_fsync_batch", "journal_snapshot_every",
+                    "journal_max_records", "link_outbox_size", "config_watch_sec")
 
 
 class VitState(Enum):
@@ -356,54 +1139,218 @@ class VitState(Enum):
     NAILED_IT = auto()
 
 
-if __name__ == "__main__":
+# rules engine level (hc_vitaminder_rules) -> the state the device shows, and back
+LEVEL_STATES = {
+    LEVEL_NAILED: VitState.NAILED_IT,
+    LEVEL_UNMEDICATED: VitState.UNMEDICATED,
+    LEVEL_SNOOZED: VitState.SNOOZE,
+    LEVEL_SOFT: VitState.SOFT_REMINDER,
+    LEVEL_HARD: VitState.HARD_REMINDER,
+}
+STATE_LEVELS = {state: level for level, state in LEVEL_STATES.items()}
 
-    # load configuration
-    config_file = "hc-vitaminder.ini"
-    if len(sys.argv) < 2:
-        print("no config file specified, using default:", config_file)
-    else:
-        config_file = sys.argv[1]
-        print("using config file:", config_file)
 
-    configuration = configparser.ConfigParser()
-    configuration.read(config_file)
-    configuration = configuration["DEFAULT"]
+def run_threads(v):
+    from hc_vitaminder_sched import VitScheduler
+    from hc_vitaminder_metrics import scheduler_collector
 
-    v = Vitaminder(config=configuration)
-    v.connect()
+    # the clock goes first: its first event sends the device its state, and the controller
+    # should find that waiting.  heartbeats are scheduler timers too, only when the link is quiet
+    scheduler = VitScheduler()
+    registry.add_collector(scheduler_collector(scheduler))
+    v.start_clock(scheduler)
 
     ctl_thread = threading.Thread(target=v.ctl_thread)
-    print("main starting control thread")
+    log.info("main starting control thread")
     ctl_thread.start()
 
     serial_thread = threading.Thread(target=v.serial_read_thread)
-    print("main starting serial_read")
+    log.info("main starting serial_read")
     serial_thread.start()
 
     # dummy_thread = threading.Thread(target=v.dummy_thread)
     # print("main starting dummy")
     # dummy_thread.start()
 
-    heartbeat_thread = threading.Thread(target=v.heartbeat_thread)
-    print("main starting heartbeat")
-    heartbeat_thread.start()
-
-    time_thread = threading.Thread(target=v.time_update_thread)
-    print("main starting time_update")
-    time_thread.start()
+    sched_thread = threading.Thread(target=scheduler.run)
+    log.info("main starting scheduler")
+    sched_thread.start()
 
     ctl_thread.join()
     # dummy_thread.join()
-    heartbeat_thread.join()
     serial_thread.join()
-    time_thread.join()
+    scheduler.stop()
+    sched_thread.join()
 
+
+if __name__ == "__main__":
+    imported = perf_counter()
+    import argparse
+    from hc_vitaminder_startup import StartupProfile, load_config_snapshot, save_config_snapshot
+    from hc_vitaminder_reload import watch_config
+
+    parser = argparse.ArgumentParser(description="Vitaminder host daemon")
+    parser.add_argument("config_file", nargs="?", default=None)
+    parser.add_argument("--async", dest="use_async", action="store_true",
+                        help="run controller, reader, heartbeat and clock on one asyncio loop instead of threads")
+    parser.add_argument("--hub", action="store_true",
+                        help="drive every [device] section of the config file from this one process")
+    parser.add_argument("--shards", type=int, default=None, metavar="N",
+                        help="with --hub: spread the devices over N worker processes (0 = one per core), "
+                             "see hc_vitaminder_shard.py")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics on http://127.0.0.1:PORT/metrics")
+    parser.add_argument("--api-port", type=int, default=None,
+                        help="serve the local HTTP api (state, remote OK/snooze, event stream) on PORT, "
+                             "see hc_vitaminder_api.py")
+    parser.add_argument("--api-host", default="127.0.0.1",
+                        help="address for --api-port, it has no auth so mind who can reach it")
+    parser.add_argument("--fast-start", action="store_true",
+                        help="single device: use the compiled config saved in <config_file>.snapshot "
+                             "(rebuilt when the config changes) instead of parsing the config file")
+    parser.add_argument("--capture", metavar="PATH", default=None,
+                        help="record every byte on the link to PATH (--hub: a directory, one <device>.vitcap "
+                             "each), see hc_vitaminder_capture.py for dumping and replaying it")
+    parser.add_argument("--profile-startup", action="store_true",
+                        help="log how long the imports, config, connect and first frame to the device took")
+    parser.add_argument("-v", "--verbose", action="count", default=0,
+                        help="-v for every event handled, the default only logs startup and problems")
+    args = parser.parse_args()
+    startup = None
+    if args.profile_startup:
+        startup = StartupProfile(IMPORT_STARTED)
+        startup.mark("imports", imported)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    # load configuration
+    config_file = "hc-vitaminder.ini"
+    if args.config_file is None:
+        log.info("no config file specified, using default: %s", config_file)
+    else:
+        config_file = args.config_file
+        log.info("using config file: %s", config_file)
+
+    if args.metrics_port is not None:
+        from hc_vitaminder_metrics import MetricsServer
+
+        metrics_server = MetricsServer(args.metrics_port).start()
+        log.info("metrics on http://127.0.0.1:%d/metrics", metrics_server.port)
+
+    if startup is not None:
+        startup.mark("setup")
+
+    def start_api(devices):
+        from hc_vitaminder_api import VitApiServer, api_collector
+
+        server = VitApiServer(devices, args.api_port, host=args.api_host).start()
+        registry.add_collector(api_collector(server))
+        log.info("api on http://%s:%d/state", args.api_host, server.port)
+        return server
+
+    cfg = None
+    if args.fast_start and not args.hub:
+        cfg = load_config_snapshot(config_file)
+
+    if args.hub:
+        import asyncio
+        import configparser
+        from hc_vitaminder_hub import VitaminderHub
+
+        configuration = configparser.ConfigParser()
+        configuration.read(config_file)
+
+        if args.shards is not None:
+            from hc_vitaminder_shard import ShardSupervisor, fleet_collector
+
+            if args.capture is not None:
+                log.warning("--capture is not supported with --shards, not capturing")
+            if args.api_port is not None:
+                log.warning("--api-port is not supported with --shards, no api")
+            supervisor = ShardSupervisor(config_file, configuration, shards=args.shards,
+                                         check_sec=configuration["DEFAULT"].getfloat("shard_check_sec", fallback=1.0),
+                                         log_level=logging.DEBUG if args.verbose else logging.INFO)
+            registry.add_collector(fleet_collector(supervisor))
+            log.info("main sharding %d devices over %d workers", len(supervisor.sections), supervisor.shards)
+            supervisor.start()
+            try:
+                supervisor.run()
+            except KeyboardInterrupt:
+                pass
+            supervisor.stop()
+            supervisor.close()
+            log.info("main all done")
+            sys.exit(0)
+
+        hub = VitaminderHub(configuration)
+        log.info("main hub driving %d devices", len(hub.devices))
+        if args.capture is not None:
+            from hc_vitaminder_capture import VitTraceWriter
+
+            for v in hub.devices:
+                v.trace = VitTraceWriter(os.path.join(args.capture, "%s.vitcap" % v.name))
+        hub.connect()
+        api = start_api(hub.devices) if args.api_port is not None else None
+        watcher = watch_config(config_file, hub.reload, hub.config_watch_sec)
+        asyncio.run(hub.run_async())
+        watcher.stop()
+        if api is not None:
+            api.stop()
+        hub.disconnect()
+        log.info("main all done")
+        sys.exit(0)
+
+    if cfg is None:
+        import configparser
+
+        configuration = configparser.ConfigParser()
+        configuration.read(config_file)
+        cfg = VitConfig(configuration["DEFAULT"])
+        if args.fast_start:
+            save_config_snapshot(config_file, cfg)
+    if startup is not None:
+        startup.mark("config")
+
+    v = Vitaminder(cfg=cfg)
+    if args.capture is not None:
+        from hc_vitaminder_capture import VitTraceWriter
+
+        v.trace = VitTraceWriter(args.capture)
+        log.info("capturing the link to %s", args.capture)
+    if startup is not None:
+        startup.mark("journal")
+    v.connect()
+    if startup is not None:
+        startup.mark("connect")
+        v.startup = startup
+
+    # edit the config (or kill -HUP) and the running daemon picks it up
+    watcher = watch_config(config_file, lambda configuration: v.reload_config(configuration["DEFAULT"]),
+                           cfg.config_watch_sec)
+    api = start_api([v]) if args.api_port is not None else None
+
+    if args.use_async:
+        import asyncio
+
+        log.info("main starting asyncio loop")
+        asyncio.run(v.run_async())
+    else:
+        run_threads(v)
+    watcher.stop()
+    if api is not None:
+        api.stop()
+        log.info("api: %s", api.stats())
+
+    log.info("link stats: %s", v.requests.stats())
+    log.info("liveness: %s", v.liveness.stats())
     v.disconnect()
-    print("main all done")
+    log.info("main all done")
 
 
 if __name__ == "__xxxmain__":
+    import serial
+
     port_name = "COM5"
     if len(sys.argv) < 2:
         print("no port specified, using default:", port_name)
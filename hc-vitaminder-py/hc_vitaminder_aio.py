@@ -0,0 +1,138 @@
+import asyncio
+import os
+
+
+class AsyncSerialPort:
+    # asyncio transport around an already opened serial.Serial
+    #
+    # on posix the port's file descriptor is registered with the event loop, so bytes are
+    # picked up by the loop itself and no extra thread is needed.  when the port has no
+    # selectable descriptor (Windows COM ports) we fall back to blocking reads in the
+    # loop's default executor.
+    #
+    # on_lost(error, serial_port) is called (once) when reading or writing the port fails,
+    # the transport is closed by then
+    def __init__(self, serial_port, loop=None, on_lost=None):
+        self.serial_port = serial_port
+        self.loop = loop if loop is not None else asyncio.get_running_loop()
+        self.on_lost = on_lost
+        self.buffer = bytearray()
+        self.data_ready = asyncio.Event()
+        self.out_buffer = bytearray()
+        self.fd = None
+        self.closed = False
+        self.saved_timeout = serial_port.timeout
+        # --capture: the port records its own reads and writes, except the ones we do on the descriptor
+        self.trace = getattr(serial_port, "trace", None)
+
+        try:
+            fd = serial_port.fileno()
+            # non-blocking reads, the loop tells us when there is something to read
+            serial_port.timeout = 0
+            self.loop.add_reader(fd, self.on_readable)
+            self.fd = fd
+        except (AttributeError, NotImplementedError, OSError, ValueError):
+            serial_port.timeout = self.saved_timeout
+            self.fd = None
+
+    def on_readable(self):
+        # read the descriptor directly, serial.Serial.read() goes through select() which
+        # tops out at 1024 descriptors and a hub easily has more than that open
+        try:
+            chunk = os.read(self.fd, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            # the device went away under us (EIO once an rfcomm link drops), stop reading
+            # a dead descriptor, the owner reopens the port when it comes back
+            self.lost(e)
+            return
+        if chunk:
+            if self.trace is not None:
+                self.trace.inbound(chunk)
+            self.buffer += chunk
+            self.data_ready.set()
+
+    def on_writable(self):
+        try:
+            sent = os.write(self.fd, self.out_buffer)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError as e:
+            self.lost(e)
+            return
+        del self.out_buffer[:sent]
+        if len(self.out_buffer) == 0:
+            self.loop.remove_writer(self.fd)
+
+    async def read_any(self, timeout=None):
+        # whatever has arrived so far, waiting up to timeout for at least one byte.
+        # an empty result means the line was quiet for the whole timeout
+        if self.closed:
+            return b""
+        if self.fd is None:
+            try:
+                return await self.loop.run_in_executor(None, self.read_blocking)
+            except OSError as e:
+                self.lost(e)
+                return b""
+
+        if len(self.buffer) == 0:
+            self.data_ready.clear()
+            try:
+                await asyncio.wait_for(self.data_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        msg = bytes(self.buffer)
+        self.buffer.clear()
+        return msg
+
+    def read_blocking(self):
+        return self.serial_port.read(max(1, self.serial_port.in_waiting))
+
+    def write(self, data):
+        # never blocks the loop: whatever the port won't take right now is queued and
+        # flushed when the descriptor becomes writable again.  a closed port drops it, the
+        # request tracker notices the missing response
+        if self.closed:
+            return 0
+        if self.fd is None:
+            try:
+                return self.serial_port.write(data)
+            except OSError as e:
+                self.lost(e)
+                raise
+
+        if self.trace is not None:
+            self.trace.outbound(data)
+        if len(self.out_buffer) == 0:
+            try:
+                sent = os.write(self.fd, data)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as e:
+                self.lost(e)
+                raise
+            if sent == len(data):
+                return sent
+            data = data[sent:]
+            self.loop.add_writer(self.fd, self.on_writable)
+        self.out_buffer += data
+        return len(data)
+
+    def lost(self, error):
+        if self.closed:
+            return
+        self.close()
+        if self.on_lost is not None:
+            self.on_lost(error, self.serial_port)
+
+    def close(self):
+        self.closed = True
+        self.data_ready.set()
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.fd = None
+        self.serial_port.timeout = self.saved_timeout
@@ -0,0 +1,221 @@
+import os
+
+import numpy as np
+
+from hc_vitaminder import VitState
+from hc_vitaminder_journal import HEADER, RECORD, REC_SNAPSHOT, REC_TRANSITION, REC_BUTTON, BUTTON_SNOOZE, \
+    journal_files, record_count
+
+# adherence reports over the state journals (see hc_vitaminder_journal)
+#
+# every journal file is read straight into a numpy structured array and the columns of
+# all devices are laid end to end, then sorted once by (device, day) and time inside that.
+# the files alone are not in that order: without an RTC the wall clock can step back when
+# NTP catches up, and a day's events then turn up after the next day's.  every metric below is then a handful of whole-array passes (masks, unique,
+# bincount, reduceat), nothing walks the events one by one in python.
+
+JOURNAL_DTYPE = np.dtype([
+    ("ts", "<f8"),
+    ("day", "<u4"),
+    ("kind", "u1"),
+    ("state", "u1"),
+    ("detail", "u1"),
+    ("reserved", "u1"),
+    ("snooze", "<f8"),
+])
+assert JOURNAL_DTYPE.itemsize == RECORD.size
+
+UNMEDICATED = VitState.UNMEDICATED.value
+SOFT_REMINDER = VitState.SOFT_REMINDER.value
+HARD_REMINDER = VitState.HARD_REMINDER.value
+SNOOZE = VitState.SNOOZE.value
+NAILED_IT = VitState.NAILED_IT.value
+
+DAY_MASK = np.int64(0xFFFFFFFF)
+
+
+class History:
+    # columns of every device's events, snapshots already dropped
+    def __init__(self, names, device, ts, day, kind, state, detail):
+        # (device, day) folded into one sortable int64, the unit most reports count in
+        key = (device.astype(np.int64) << 32) | day.astype(np.int64)
+        order = np.lexsort((ts, key))
+        self.names = names
+        self.key = key[order]
+        self.device = device[order]
+        self.ts = ts[order]
+        self.day = day[order]
+        self.kind = kind[order]
+        self.state = state[order]
+        self.detail = detail[order]
+
+    def __len__(self):
+        return len(self.ts)
+
+    @classmethod
+    def from_records(cls, names, device, records):
+        keep = records["kind"] != REC_SNAPSHOT
+        records = records[keep]
+        return cls(names, device[keep], records["ts"], records["day"], records["kind"], records["state"],
+                   records["detail"])
+
+
+def load_journal(path):
+    # a torn record at the end (the daemon died mid write) is left out, like replay does
+    count = record_count(os.path.getsize(path))
+    if count == 0:
+        return np.zeros(0, dtype=JOURNAL_DTYPE)
+    return np.fromfile(path, dtype=JOURNAL_DTYPE, count=count, offset=HEADER.size)
+
+
+def load_history(journals):
+    # journals: [(device name, active journal path)], archives next to it are picked up too
+    names = []
+    parts = []
+    devices = []
+    for index, (name, path) in enumerate(journals):
+        names.append(name)
+        for f in journal_files(path):
+            records = load_journal(f)
+            parts.append(records)
+            devices.append(np.full(len(records), index, dtype=np.int32))
+    if not parts:
+        return History.from_records(names, np.zeros(0, dtype=np.int32), np.zeros(0, dtype=JOURNAL_DTYPE))
+    return History.from_records(names, np.concatenate(devices), np.concatenate(parts))
+
+
+def journals_from_config(configuration):
+    # same file names the daemon uses: <journal_dir>/<section>.journal, [DEFAULT] when there are no sections
+    sections = configuration.sections() or ["DEFAULT"]
+    journals = []
+    for name in sections:
+        journal_dir = configuration[name].get("journal_dir", fallback="")
+        if journal_dir:
+            journals.append((name, os.path.join(journal_dir, "%s.journal" % name)))
+    return journals
+
+
+def run_starts(keys):
+    # True where a new key starts.  History keeps the keys sorted, so this finds the first
+    # occurrence of every key in one pass
+    starts = np.ones(len(keys), dtype=bool)
+    starts[1:] = keys[1:] != keys[:-1]
+    return starts
+
+
+def first_per_key(h, mask):
+    # (keys, index into h) of the first event matching mask for every device-day
+    idx = np.flatnonzero(mask)
+    keys = h.key[idx]
+    starts = run_starts(keys)
+    return keys[starts], idx[starts]
+
+
+def first_nailed(h):
+    return first_per_key(h, (h.kind == REC_TRANSITION) & (h.state == NAILED_IT))
+
+
+def on_time_by_day(h):
+    # a device-day is on time when it got to NAILED_IT before the hard reminder started.
+    # returns (day ordinals, device-days seen, device-days on time) per calendar day
+    if len(h) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    active_days = (h.key[run_starts(h.key)] & DAY_MASK) - int(h.day.min())
+
+    keys, idx = first_nailed(h)
+    prev = h.detail[idx]
+    on_time = keys[(prev == UNMEDICATED) | (prev == SOFT_REMINDER)]
+    on_time_days = (on_time & DAY_MASK) - int(h.day.min())
+
+    # days are small consecutive integers, count them straight into an array
+    seen = np.bincount(active_days)
+    taken = np.bincount(on_time_days, minlength=len(seen))
+    used = np.flatnonzero(seen)
+    return used + int(h.day.min()), seen[used], taken[used]
+
+
+def soft_to_nailed(h):
+    # seconds from the soft reminder switching on to NAILED_IT, one value per device-day that had both
+    soft_keys, soft_idx = first_per_key(h, (h.kind == REC_TRANSITION) & (h.state == SOFT_REMINDER))
+    nailed_keys, nailed_idx = first_nailed(h)
+    _, a, b = np.intersect1d(soft_keys, nailed_keys, assume_unique=True, return_indices=True)
+    delay = h.ts[nailed_idx[b]] - h.ts[soft_idx[a]]
+    return delay[delay > 0]
+
+
+def snooze_counts(h):
+    # accepted snooze presses per device (presses outside a reminder don't snooze anything)
+    snoozed = (h.kind == REC_BUTTON) & ((h.detail & BUTTON_SNOOZE) != 0) & (h.state == SNOOZE)
+    return np.bincount(h.device[snoozed], minlength=len(h.names))
+
+
+def longest_streaks(h):
+    # longest run of consecutive days that reached NAILED_IT, per device
+    keys, _ = first_nailed(h)
+    best = np.zeros(len(h.names), dtype=np.int64)
+    if len(keys) == 0:
+        return best
+
+    device = keys >> 32
+    day = keys & DAY_MASK
+    starts_run = np.ones(len(keys), dtype=bool)
+    starts_run[1:] = (device[1:] != device[:-1]) | (day[1:] - day[:-1] != 1)
+
+    run_length = np.bincount(np.cumsum(starts_run) - 1)
+    run_device = device[starts_run]
+    first_run = np.flatnonzero(np.r_[True, run_device[1:] != run_device[:-1]])
+    best[run_device[first_run]] = np.maximum.reduceat(run_length, first_run)
+    return best
+
+
+def report(h):
+    days, seen, taken = on_time_by_day(h)
+    delays = soft_to_nailed(h)
+    snoozes = snooze_counts(h)
+    streaks = longest_streaks(h)
+
+    return {
+        "events": len(h),
+        "devices": len(h.names),
+        "device_days": int(seen.sum()),
+        "on_time_rate": float(taken.sum() / seen.sum()) if seen.sum() else None,
+        "on_time_rate_by_day": {int(d): float(t / s) for d, s, t in zip(days, seen, taken)},
+        "soft_to_nailed_median_min": float(np.median(delays) / 60.0) if len(delays) else None,
+        "soft_to_nailed_count": int(len(delays)),
+        "snoozes": int(snoozes.sum()),
+        "snoozes_by_device": dict(zip(h.names, snoozes.tolist())),
+        "longest_streak_days": int(streaks.max()) if len(streaks) else 0,
+        "longest_streak_by_device": dict(zip(h.names, streaks.tolist())),
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+    import configparser
+    import json
+    from datetime import date
+
+    parser = argparse.ArgumentParser(description="Vitaminder adherence report from the state journals")
+    parser.add_argument("config_file", nargs="?", default="hc-vitaminder.ini")
+    parser.add_argument("--json", default=None, help="write the full report (per day and per device) here")
+    parser.add_argument("--last-days", type=int, default=14, help="days of on-time rate to print")
+    args = parser.parse_args()
+
+    configuration = configparser.ConfigParser()
+    configuration.read(args.config_file)
+    history = load_history(journals_from_config(configuration))
+    result = report(history)
+
+    for k in ("events", "devices", "device_days", "on_time_rate", "soft_to_nailed_median_min", "snoozes",
+              "longest_streak_days"):
+        print("%-28s %s" % (k, result[k]))
+    for d, rate in list(result["on_time_rate_by_day"].items())[-args.last_days:]:
+        print("  %s  %5.1f%%" % (date.fromordinal(d), 100.0 * rate))
+    for name in history.names:
+        print("  %-20s snoozes=%-6d longest streak=%d days" % (name, result["snoozes_by_device"][name],
+                                                            result["longest_streak_by_device"][name]))
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
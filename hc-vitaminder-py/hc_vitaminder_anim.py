@@ -0,0 +1,214 @@
+import bisect
+import math
+import time
+
+from hc_vitaminder_metrics import Histogram
+
+# host side LED animation
+#
+# the firmware only knows "show these colors", so blinking, fading and pulsing happen here:
+# a pattern is cut into keyframes (offset into the cycle, vit LED level 0..1), and every
+# keyframe goes out as an ordinary set-LED frame at its time.  at 9600 baud a set-LED frame
+# and its response take ~17 ms, so the keyframe rate is bounded by a token bucket over the
+# bytes we write.  every frame the host sends is charged to the bucket, animation frames
+# only go out when it can pay for them, so heartbeats and state changes always win.  when
+# it can't, the keyframe is dropped and the pattern falls back to half as many keyframes per
+# cycle; a few clean cycles later it tries the finer one again.
+
+PATTERNS = ("solid", "blink", "fade", "pulse")
+
+# pulse never goes fully dark
+PULSE_FLOOR = 0.25
+
+# keyframe lateness, the request buckets are far too coarse for this
+JITTER_BOUNDS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5)
+
+
+class TokenBucket:
+    # rate bytes per second, at most burst bytes saved up.  charge() always succeeds and may
+    # leave the bucket in debt (a heartbeat must go out), but never more than one second's worth
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def can_afford(self, n):
+        return self.refill() >= n
+
+    def charge(self, n):
+        self.refill()
+        self.tokens = max(-self.rate, self.tokens - n)
+
+
+class AnimPattern:
+    def __init__(self, kind, period, on_sec=None):
+        if kind not in PATTERNS:
+            raise ValueError("unknown LED pattern %r, expected one of %s" % (kind, ", ".join(PATTERNS)))
+        self.kind = kind
+        self.period = period
+        # blink only, how long the LED stays on each cycle
+        self.on_sec = on_sec
+
+    @property
+    def animated(self):
+        return self.kind != "solid" and self.period > 0
+
+    def level_at(self, phase):
+        # phase 0..1 through the cycle
+        if self.kind == "fade":
+            return 1.0 - abs(1.0 - 2.0 * phase)
+        if self.kind == "pulse":
+            return PULSE_FLOOR + (1.0 - PULSE_FLOOR) * (0.5 - 0.5 * math.cos(2.0 * math.pi * phase))
+        return 1.0
+
+    def keyframes(self, count):
+        # [(offset sec, level)], a blink is two keyframes whatever the budget
+        if self.kind == "blink":
+            return [(0.0, 1.0), (self.on_sec, 0.0)]
+        count = max(2, count)
+        return [(self.period * i / count, self.level_at(i / count)) for i in range(count)]
+
+
+class VitAnimator:
+    # keyframe clock for one device.  the owner (Vitaminder) does the timers and the writing,
+    # this only decides which keyframe is due, whether the link can take it, and keeps score
+    def __init__(self, bucket, max_fps=20, recover_cycles=3):
+        self.bucket = bucket
+        self.max_fps = max_fps
+        self.recover_cycles = recover_cycles
+
+        self.pattern = None
+        self.plan = None
+        self.started = 0.0
+        self.level = 0
+        self.max_level = 0
+        self.full_count = 0
+        self.cache = {}
+        self.last = None
+        self.cycle = 0
+        self.clean_cycles = 0
+        self.dropped_this_cycle = False
+
+        self.sent = 0
+        self.dropped = 0
+        self.degraded = 0
+        self.lateness = Histogram(JITTER_BOUNDS)
+
+    @property
+    def running(self):
+        return self.pattern is not None
+
+    def start(self, plan, pattern, now, frame_cost):
+        # frame_cost: bytes one keyframe takes, for picking a keyframe count the budget can sustain
+        self.plan = plan
+        self.pattern = pattern
+        self.started = now
+        self.cache = {}
+        self.last = None
+        self.cycle = 0
+        self.clean_cycles = 0
+        self.dropped_this_cycle = False
+
+        self.full_count = max(2, int(pattern.period * self.max_fps))
+        self.max_level = 0
+        while self.full_count >> (self.max_level + 1) >= 2 and pattern.kind != "blink":
+            self.max_level += 1
+
+        sustainable = pattern.period * self.bucket.rate / max(1, frame_cost)
+        self.level = 0
+        while self.level < self.max_level and (self.full_count >> self.level) > sustainable:
+            self.level += 1
+
+    def stop(self):
+        self.pattern = None
+        self.plan = None
+
+    def keyframes(self):
+        # [(offset, LedPlan)] at the current level, built once per level
+        frames = self.cache.get(self.level)
+        if frames is None:
+            frames = [(offset, self.plan.scaled(level))
+                      for offset, level in self.pattern.keyframes(self.full_count >> self.level)]
+            self.cache[self.level] = frames
+        return frames
+
+    def position(self, now):
+        # (cycle, keyframe index, its due time, when the next one is due)
+        frames = self.keyframes()
+        period = self.pattern.period
+        elapsed = max(0.0, now - self.started)
+        cycle = int(elapsed // period)
+        cycle_start = self.started + cycle * period
+        index = bisect.bisect_right([offset for offset, _ in frames], elapsed - cycle * period) - 1
+        due = cycle_start + frames[index][0]
+        if index + 1 < len(frames):
+            next_due = cycle_start + frames[index + 1][0]
+        else:
+            next_due = cycle_start + period
+        return cycle, index, due, next_due
+
+    def step(self, now, frames_for, force=False):
+        # returns (plan, frames to write now or None, when to step again)
+        # frames_for(plan) gives the frames that would take the device there, [] when it already shows it
+        cycle, index, due, next_due = self.position(now)
+        if cycle != self.cycle and self.end_cycle(cycle):
+            cycle, index, due, next_due = self.position(now)
+        if not force and self.last == (cycle, index, self.level):
+            return None, None, next_due
+        self.last = (cycle, index, self.level)
+
+        plan = self.keyframes()[index][1]
+        frames = frames_for(plan)
+        if not frames:
+            return plan, None, next_due
+        if not self.bucket.can_afford(sum(len(f) for f in frames)):
+            if self.drop():
+                # coarser keyframes from here on, step again at the next one of those
+                next_due = self.position(now)[3]
+            return plan, None, next_due
+        self.sent += 1
+        self.lateness.observe(max(0.0, now - due))
+        return plan, frames, next_due
+
+    def drop(self):
+        # True when this moved to a coarser level
+        self.dropped += 1
+        self.dropped_this_cycle = True
+        self.clean_cycles = 0
+        if self.level < self.max_level:
+            self.level += 1
+            self.degraded += 1
+            return True
+        return False
+
+    def end_cycle(self, cycle):
+        # True when a run of clean cycles earned a finer level back
+        self.cycle = cycle
+        if self.dropped_this_cycle:
+            self.dropped_this_cycle = False
+            return False
+        self.clean_cycles += 1
+        if self.clean_cycles >= self.recover_cycles and self.level > 0:
+            self.level -= 1
+            self.clean_cycles = 0
+            return True
+        return False
+
+    def stats(self):
+        return {
+            "pattern": self.pattern.kind if self.pattern is not None else None,
+            "level": self.level,
+            "keyframes_per_cycle": len(self.keyframes()) if self.pattern is not None else 0,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "degraded": self.degraded,
+            "lateness": self.lateness.stats(),
+        }
@@ -0,0 +1,409 @@
+import asyncio
+import itertools
+import json
+import logging
+import threading
+from collections import deque
+from datetime import datetime
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+
+log = logging.getLogger("hc_vitaminder")
+
+# local HTTP API: state queries, remote button presses and a stream of state changes
+#
+#   GET  /state[?device=NAME]   every device's state (or the one asked for), snooze expiry, last contact
+#   POST /ok[?device=NAME]      the OK button, queued as the same event a press on the device becomes
+#   POST /snooze[?device=NAME]  the snooze button
+#   GET  /events[?device=NAME]  Server-Sent Events: a "state" event per device, then a "transition"
+#                               event for every state change
+#
+# the server runs its own asyncio loop on a daemon thread (like the metrics exporter), so clients
+# never hold up a controller.  a transition is encoded once into the VitBroadcast ring and every
+# subscriber sends it from there, each with its own cursor: an idle subscriber is one suspended
+# coroutine and its socket, nothing is queued per subscriber.  one that can't keep up is dropped
+# (its browser reconnects with Last-Event-ID), one that fell behind the ring gets the state again.
+#
+# there is no auth, it listens on localhost unless told otherwise.  requests carrying an Origin
+# that isn't localhost are refused, or any web page could press the buttons through a browser
+
+MAX_HEADER_BYTES = 8192
+MAX_BODY_BYTES = 4096
+LISTEN_BACKLOG = 1024
+# a subscriber with this much unsent is not reading, better to drop it than to buffer for it
+SLOW_SUBSCRIBER_BYTES = 65536
+SSE_RETRY_MS = 3000
+LOCAL_HOSTS = ("127.0.0.1", "localhost", "::1")
+
+BUTTONS = {"/ok": (True, False), "/snooze": (False, True)}
+KEEPALIVE = b": keepalive\n\n"
+SSE_HEAD = (b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+            b"Connection: keep-alive\r\n\r\nretry: %d\n\n" % SSE_RETRY_MS)
+
+
+class ApiError(Exception):
+    def __init__(self, status, message, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers
+
+
+def device_name(v):
+    return v.name or "DEFAULT"
+
+
+def iso(ts):
+    return None if ts is None else datetime.fromtimestamp(ts).isoformat(timespec="seconds")
+
+
+def device_state(v):
+    # called off the controller: every field is a single attribute read, good enough for a snapshot
+    expiration = v.snooze_expiration
+    return {
+        "device": device_name(v),
+        "state": v.state.name,
+        "snooze_expiration": None if expiration is None else expiration.isoformat(timespec="seconds"),
+        "last_contact": iso(v.liveness.last_contact),
+        "link_up": v.supervisor.up,
+    }
+
+
+def sse_message(event, data, event_id=None):
+    head = b"" if event_id is None else b"id: %d\n" % event_id
+    return head + b"event: %s\ndata: %s\n\n" % (event.encode(), json.dumps(data).encode())
+
+
+class VitBroadcast:
+    # the last size messages, numbered (the number is the SSE id).  only touched on the server's loop
+    #
+    # publish() wakes every waiting subscriber through one Event, which is swapped for a new one
+    # so a subscriber never waits on an Event that is already set
+    def __init__(self, size):
+        self.ring = deque(maxlen=size)
+        self.last_id = 0
+        self.changed = asyncio.Event()
+        self.published = 0
+
+    def publish(self, device, message):
+        # device None goes to every subscriber (keepalives)
+        self.last_id += 1
+        if device is not None:
+            self.published += 1
+        self.ring.append((self.last_id, device, message))
+        changed, self.changed = self.changed, asyncio.Event()
+        changed.set()
+
+    def since(self, cursor):
+        # (messages after cursor, whether some of them already fell out of the ring)
+        if cursor >= self.last_id:
+            return [], False
+        first = self.ring[0][0]
+        if cursor < first - 1:
+            return list(self.ring), True
+        return list(itertools.islice(self.ring, cursor + 1 - first, None)), False
+
+
+class VitApiServer:
+    # devices is the controllers' list, the hub's own list so devices it adds later are picked up
+    def __init__(self, devices, port, host="127.0.0.1", keepalive_sec=15.0, buffer_size=256):
+        self.devices = devices
+        self.host = host
+        self.requested_port = port
+        self.keepalive_sec = keepalive_sec
+        self.buffer_size = buffer_size
+
+        self.loop = None
+        self.server = None
+        self.broadcast = None
+        self.stopping = None
+        self.keepalive_timer = None
+        self.handlers = set()
+        self.thread = None
+        self.ready = threading.Event()
+        self.error = None
+        self.bound_port = None
+
+        self.requests = 0
+        self.connections = 0
+        self.subscribers = 0
+        self.presses = 0
+        self.dropped = 0
+        self.resyncs = 0
+
+    @property
+    def port(self):
+        return self.bound_port
+
+    def start(self):
+        # returns once the socket is listening, raises OSError when it can't be
+        self.thread = threading.Thread(target=asyncio.run, args=(self.serve(),), name="api", daemon=True)
+        self.thread.start()
+        self.ready.wait()
+        if self.error is not None:
+            raise self.error
+        return self
+
+    def stop(self):
+        for v in list(self.devices):
+            if self.on_transition in v.transition_listeners:
+                v.transition_listeners.remove(self.on_transition)
+        if self.loop is not None and self.stopping is not None:
+            try:
+                self.loop.call_soon_threadsafe(self.stopping.set)
+            except RuntimeError:
+                pass
+        if self.thread is not None:
+            self.thread.join()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            self.server = await asyncio.start_server(self.handle_connection, self.host, self.requested_port,
+                                                     limit=MAX_HEADER_BYTES, backlog=LISTEN_BACKLOG)
+        except OSError as e:
+            self.error = e
+            self.ready.set()
+            return
+        self.bound_port = self.server.sockets[0].getsockname()[1]
+        self.broadcast = VitBroadcast(self.buffer_size)
+        self.stopping = asyncio.Event()
+        self.watch()
+        self.keepalive_timer = self.loop.call_later(self.keepalive_sec, self.keepalive)
+        self.ready.set()
+
+        await self.stopping.wait()
+        self.keepalive_timer.cancel()
+        self.server.close()
+        # every open connection is closed from here, subscribers find out when woken up
+        for task, writer in list(self.handlers):
+            writer.close()
+        self.broadcast.publish(None, b"")
+        if self.handlers:
+            await asyncio.wait([task for task, _ in self.handlers], timeout=1.0)
+
+    def keepalive(self):
+        # also how a subscriber that went away without a word is noticed: the write fails
+        self.watch()
+        self.broadcast.publish(None, KEEPALIVE)
+        self.keepalive_timer = self.loop.call_later(self.keepalive_sec, self.keepalive)
+
+    def watch(self):
+        # our listener on every device, including any the hub added since we last looked
+        for v in list(self.devices):
+            if self.on_transition not in v.transition_listeners:
+                v.transition_listeners.append(self.on_transition)
+
+    def on_transition(self, v, old_state):
+        # controller's thread: take the snapshot here (it is what just changed), the rest on our loop
+        data = device_state(v)
+        data["from"] = old_state.name
+        data["at"] = v.now().isoformat(timespec="seconds")
+        try:
+            self.loop.call_soon_threadsafe(self.publish_transition, data)
+        except RuntimeError:
+            # our loop is gone, stop() is taking the listener off
+            pass
+
+    def publish_transition(self, data):
+        self.broadcast.publish(data["device"], sse_message("transition", data, self.broadcast.last_id + 1))
+
+    def select(self, query, one=False):
+        name = query.get("device", [None])[0]
+        self.watch()
+        devices = list(self.devices)
+        if name is not None:
+            devices = [v for v in devices if device_name(v) == name]
+            if not devices:
+                raise ApiError(404, "no device %r" % name)
+        elif one and len(devices) != 1:
+            raise ApiError(400, "%d devices, say which one with ?device=NAME" % len(devices))
+        return devices
+
+    async def read_request(self, reader):
+        # (method, target, version, headers), None once the client closed the connection
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise ApiError(431, "request header over %d bytes" % MAX_HEADER_BYTES)
+
+        lines = head.decode("latin-1").split("\r\n")
+        parts = lines[0].split(" ")
+        if len(parts) != 3 or not parts[2].startswith("HTTP/1."):
+            raise ApiError(400, "bad request line")
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, sep, value = line.partition(":")
+            if not sep:
+                raise ApiError(400, "bad header line")
+            headers[name.strip().lower()] = value.strip()
+
+        if "transfer-encoding" in headers:
+            raise ApiError(411, "send a Content-Length")
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise ApiError(400, "bad Content-Length")
+        if length > MAX_BODY_BYTES:
+            raise ApiError(413, "body over %d bytes" % MAX_BODY_BYTES)
+        if length > 0:
+            # nothing takes a body, the device is in the query
+            await reader.readexactly(length)
+        return parts[0], parts[1], parts[2], headers
+
+    async def handle_connection(self, reader, writer):
+        handler = (asyncio.current_task(), writer)
+        self.handlers.add(handler)
+        self.connections += 1
+        try:
+            while True:
+                # a request that couldn't be read whole leaves the stream unusable, that one closes
+                keep_alive = False
+                try:
+                    request = await self.read_request(reader)
+                    if request is None:
+                        break
+                    self.requests += 1
+                    method, target, version, headers = request
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                    url = urlsplit(target)
+                    path = url.path.rstrip("/") or "/"
+                    query = parse_qs(url.query)
+
+                    if path == "/events":
+                        if method != "GET":
+                            raise ApiError(405, "GET only", [("Allow", "GET")])
+                        await self.stream(reader, writer, self.select(query), "device" in query,
+                                          headers.get("last-event-id"))
+                        break
+                    status, body = await self.route(method, path, query, headers)
+                except ApiError as e:
+                    self.respond(writer, e.status, {"error": str(e)}, keep_alive, e.headers)
+                else:
+                    self.respond(writer, status, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections -= 1
+            self.handlers.discard(handler)
+            writer.close()
+
+    def respond(self, writer, status, body, keep_alive, headers=()):
+        data = json.dumps(body).encode() + b"\n"
+        lines = ["HTTP/1.1 %d %s" % (status, HTTPStatus(status).phrase),
+                 "Content-Type: application/json",
+                 "Content-Length: %d" % len(data),
+                 "Connection: %s" % ("keep-alive" if keep_alive else "close")]
+        lines += ["%s: %s" % header for header in headers]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + data)
+
+    async def route(self, method, path, query, headers):
+        if path == "/state":
+            if method != "GET":
+                raise ApiError(405, "GET only", [("Allow", "GET")])
+            devices = self.select(query)
+            if "device" in query:
+                return 200, device_state(devices[0])
+            return 200, {"devices": [device_state(v) for v in devices]}
+
+        if path in BUTTONS:
+            if method != "POST":
+                raise ApiError(405, "POST only", [("Allow", "POST")])
+            origin = headers.get("origin")
+            if origin is not None and urlsplit(origin).hostname not in LOCAL_HOSTS:
+                raise ApiError(403, "not from %s" % origin)
+            v = self.select(query, one=True)[0]
+            ok, snooze = BUTTONS[path]
+            if v.loop is None:
+                # threads mode: add_event blocks while the controller's queue is full, not on our loop
+                await self.loop.run_in_executor(None, v.remote_press, ok, snooze)
+            else:
+                v.remote_press(ok, snooze)
+            self.presses += 1
+            log.info("%s: %s pressed over the api", device_name(v), path[1:])
+            return 202, {"device": device_name(v), "button": path[1:]}
+
+        raise ApiError(404, "no such endpoint, try /state, /ok, /snooze or /events")
+
+    async def stream(self, reader, writer, devices, filtered, last_event_id):
+        names = {device_name(v) for v in devices} if filtered else None
+        broadcast = self.broadcast
+        writer.write(SSE_HEAD)
+
+        # picking up where a reconnecting client left off, as long as the ring still has it
+        cursor = broadcast.last_id
+        resume = None
+        if last_event_id is not None:
+            try:
+                resume = int(last_event_id)
+            except ValueError:
+                pass
+        entries, lost = broadcast.since(resume) if resume is not None and resume <= cursor else ([], True)
+        if lost:
+            self.send_states(writer, devices)
+        else:
+            self.send_entries(writer, entries, names)
+
+        self.subscribers += 1
+        try:
+            while True:
+                changed = broadcast.changed
+                entries, lost = broadcast.since(cursor)
+                if writer.is_closing() or reader.at_eof():
+                    break
+                if entries:
+                    cursor = entries[-1][0]
+                    if lost:
+                        # fell behind the ring, what it missed is summed up by the state now
+                        self.resyncs += 1
+                        self.send_states(writer, devices)
+                    else:
+                        self.send_entries(writer, entries, names)
+                    if writer.transport.get_write_buffer_size() > SLOW_SUBSCRIBER_BYTES:
+                        self.dropped += 1
+                        break
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+
+    def send_states(self, writer, devices):
+        for v in devices:
+            writer.write(sse_message("state", device_state(v)))
+
+    def send_entries(self, writer, entries, names):
+        for _, device, message in entries:
+            if device is None or names is None or device in names:
+                writer.write(message)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "connections": self.connections,
+            "subscribers": self.subscribers,
+            "presses": self.presses,
+            "published": self.broadcast.published if self.broadcast is not None else 0,
+            "dropped": self.dropped,
+            "resyncs": self.resyncs,
+        }
+
+
+def api_collector(server):
+    # the api's own counters on /metrics
+    def collect(text):
+        stats = server.stats()
+        text.add("vitaminder_api_connections", "gauge", "Open connections to the local api.", [],
+                 stats["connections"])
+        text.add("vitaminder_api_subscribers", "gauge", "Clients following /events.", [], stats["subscribers"])
+        text.add("vitaminder_api_requests_total", "counter", "Requests the local api answered.", [],
+                 stats["requests"])
+        text.add("vitaminder_api_presses_total", "counter", "Button presses that came in over the api.", [],
+                 stats["presses"])
+        text.add("vitaminder_api_subscribers_dropped_total", "counter",
+                 "Event stream clients dropped for not reading.", [], stats["dropped"])
+    return collect
@@ -0,0 +1,1527 @@
+import argparse
+import asyncio
+import configparser
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import sys
+import threading
+import time
+
+
+# benchmarks for the host side of the vitaminder, run one with:
+#   python hc_vitaminder_bench.py <name> [options]
+# every benchmark prints a table and can also dump its numbers as json (--json file)
+
+
+def rss_kb(pid="self"):
+    # current resident set size, falls back to our own peak when /proc is not around
+    try:
+        with open("/proc/%s/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_simulator(sim, duration):
+    # child process side of the hub benchmark, keeps the device work off the host's books
+    sim.start()
+    time.sleep(duration)
+    sim.stop()
+
+
+def run_hub(configuration, duration, queue):
+    # child process side of the hub benchmark: a fresh process per size, so the memory it
+    # reports isn't arenas an earlier (bigger or smaller) hub left behind
+    import serial
+    from hc_vitaminder_hub import VitaminderHub
+
+    rss_before = rss_kb()
+    hub = VitaminderHub(configuration)
+    for v in hub.devices:
+        # skip the per-device connect chatter
+        v.port_name = v.cfg.comm_port
+        v.serial_port = serial.Serial(v.port_name, timeout=v.cfg.comm_read_timeout)
+
+    async def run():
+        asyncio.get_running_loop().call_later(duration, hub.stop)
+        await hub.run_async()
+
+    cpu_before = time.process_time()
+    wall_before = time.monotonic()
+    asyncio.run(run())
+    cpu = time.process_time() - cpu_before
+    wall = time.monotonic() - wall_before
+    rss_after = rss_kb()
+    hub.disconnect()
+    queue.put((rss_before, rss_after, cpu, wall))
+
+
+def bench_hub(args):
+    from hc_vitaminder_sim import VitSimulator
+
+    ctx = multiprocessing.get_context("fork")
+    results = []
+    for n in args.devices:
+        sim = VitSimulator(seed=n)
+        for _ in range(n):
+            sim.add_device(latency=0.0, press_every=args.press_interval, boot_delay=0.0)
+
+        configuration = configparser.ConfigParser()
+        configuration.read(args.config)
+        configuration["DEFAULT"]["heartbeat_thread_sleep_sec"] = "1"
+        configuration["DEFAULT"]["journal_dir"] = ""
+        configuration["DEFAULT"]["port_scan_sec"] = "0"
+        for dev in sim.devices:
+            configuration["bench%d" % dev.index] = {"comm_port": dev.port_name}
+
+        device = ctx.Process(target=run_simulator, args=(sim, args.duration + 1))
+        device.start()
+        queue = ctx.Queue()
+        child = ctx.Process(target=run_hub, args=(configuration, args.duration, queue))
+        child.start()
+        rss_before, rss_after, cpu, wall = queue.get()
+        child.join()
+        device.join()
+        sim.close()
+
+        row = {
+            "devices": n,
+            "rss_kb": rss_after,
+            "rss_delta_kb": rss_after - rss_before,
+            "rss_per_device_kb": (rss_after - rss_before) / n,
+            "cpu_sec": cpu,
+            "cpu_pct": 100.0 * cpu / wall,
+        }
+        results.append(row)
+        print("devices=%(devices)4d  rss=%(rss_kb)7d kB  delta=%(rss_delta_kb)6d kB  "
+              "per_dev=%(rss_per_device_kb)6.1f kB  cpu=%(cpu_sec)6.3f s (%(cpu_pct)5.1f%%)" % row)
+    return results
+
+
+class ContentionLock:
+    # drop-in lock for threading.Condition that keeps score of how often and how long
+    # somebody had to wait for it.  reentrant like the RLock a plain Condition() uses, so it
+    # also fits conditions that do get re-taken by their owner
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.acquires = 0
+        self.contended = 0
+        self.wait_sec = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        self.acquires += 1
+        if self.lock.acquire(False):
+            return True
+        if not blocking:
+            return False
+        self.contended += 1
+        t0 = time.perf_counter()
+        got = self.lock.acquire(True, timeout)
+        self.wait_sec += time.perf_counter() - t0
+        return got
+
+    def release(self):
+        self.lock.release()
+
+    # Condition.wait() hooks, re-taking the lock after a wait counts like any other acquire
+    def _is_owned(self):
+        return self.lock._is_owned()
+
+    def _release_save(self):
+        return self.lock._release_save()
+
+    def _acquire_restore(self, state):
+        self.acquires += 1
+        t0 = time.perf_counter()
+        self.lock._acquire_restore(state)
+        waited = time.perf_counter() - t0
+        if waited > 0.00005:
+            self.contended += 1
+            self.wait_sec += waited
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def stats(self):
+        return {
+            "acquires": self.acquires,
+            "contended": self.contended,
+            "contended_pct": 100.0 * self.contended / self.acquires if self.acquires else 0.0,
+            "wait_ms": 1000.0 * self.wait_sec,
+        }
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def bench_config(config_file):
+    configuration = configparser.ConfigParser()
+    configuration.read(config_file)
+    section = configuration["DEFAULT"]
+    section["comm_port"] = "loopback"
+    section["journal_dir"] = ""
+    return section
+
+
+def bench_ctl(args):
+    import gc
+    import tracemalloc
+    from hc_vitaminder import EVENT_PRIORITIES, COALESCED_EVENTS, TIMER_EVENTS
+    from hc_vitaminder_queue import VitEventQueue
+    from hc_vitaminder_sim import LoopbackHost, SimFirmware
+
+    ok_frame = SimFirmware().press(True, False)
+
+    def make_host(on_write=None):
+        host = LoopbackHost(bench_config(args.config), on_write=on_write, timers=False)
+        lock = ContentionLock()
+        host.v.msg_queue = VitEventQueue(EVENT_PRIORITIES, COALESCED_EVENTS, maxsize=host.v.cfg.event_queue_size,
+                                         lock=lock, unbounded=TIMER_EVENTS)
+        return host, lock
+
+    # 1) button -> LED latency, one press at a time
+    led_written = threading.Event()
+    press_at = [0.0]
+    latencies = []
+
+    def on_write(data):
+        if data[0] == 0x02 and not led_written.is_set():
+            latencies.append(time.perf_counter() - press_at[0])
+            led_written.set()
+
+    host, lock = make_host(on_write)
+    host.start()
+    for _ in range(args.presses):
+        led_written.clear()
+        press_at[0] = time.perf_counter()
+        host.port.inject(ok_frame)
+        led_written.wait(1.0)
+    host.stop()
+    latency_lock = lock.stats()
+
+    # 2) throughput, a burst of presses drained as fast as the controller can go
+    handled = [0]
+    host, lock = make_host()
+    v = host.v
+    original = v.handle_event
+
+    def counting_handle_event(e, **kwargs):
+        handled[0] += 1
+        original(e, **kwargs)
+
+    v.handle_event = counting_handle_event
+    host.start()
+    t0 = time.perf_counter()
+    host.port.inject(ok_frame * args.burst)
+    host.wait_for(lambda: v.decoder.frames >= args.burst, timeout=60.0, poll=0.001)
+    host.stop()
+    elapsed = time.perf_counter() - t0
+    burst_lock = lock.stats()
+    burst_queue = v.msg_queue.stats()
+
+    # 3) allocations, same work on one thread so only the event path is traced
+    v = make_host()[0].v
+    n = args.alloc_events
+    gc.collect()
+    gc_before = gc.get_stats()[0]["collections"]
+    tracemalloc.start()
+    snapshot_before = tracemalloc.take_snapshot()
+    base_current, _ = tracemalloc.get_traced_memory()
+    transient = 0
+    for _ in range(n):
+        # peak over one press is what that press needed on top of what was already live
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        v.handle_serial_bytes(ok_frame)
+        while not v.msg_queue.empty():
+            v.handle_event(v.msg_queue.get())
+        # the firmware's responses, so the request table doesn't grow
+        v.handle_serial_bytes(v.serial_port.read(v.serial_port.in_waiting))
+        while not v.msg_queue.empty():
+            v.handle_event(v.msg_queue.get())
+        _, peak = tracemalloc.get_traced_memory()
+        transient += peak - before
+    current, _ = tracemalloc.get_traced_memory()
+    stat_diff = tracemalloc.take_snapshot().compare_to(snapshot_before, "filename")
+    tracemalloc.stop()
+    gc_after = gc.get_stats()[0]["collections"]
+
+    result = {
+        "presses": len(latencies),
+        "button_to_led_p50_ms": 1000.0 * percentile(latencies, 0.50),
+        "button_to_led_p99_ms": 1000.0 * percentile(latencies, 0.99),
+        "button_to_led_max_ms": 1000.0 * max(latencies),
+        "burst_presses": args.burst,
+        "burst_events": handled[0],
+        "burst_sec": elapsed,
+        "events_per_sec": handled[0] / elapsed,
+        "alloc_events": n,
+        "alloc_transient_bytes_per_press": transient / n,
+        "alloc_retained_bytes_per_press": (current - base_current) / n,
+        "alloc_retained_blocks": sum(d.count_diff for d in stat_diff),
+        "gc_gen0_collections": gc_after - gc_before,
+        "lock_latency_run": latency_lock,
+        "lock_burst_run": burst_lock,
+        "queue_burst_run": burst_queue,
+    }
+    for k, val in result.items():
+        print("%-32s %s" % (k, "%.3f" % val if isinstance(val, float) else val))
+    return [result]
+
+
+def compare_results(old_file, results):
+    # percentage change of every numeric field against an earlier --json run
+    with open(old_file) as f:
+        old = json.load(f)["results"]
+    print()
+    print("compared with", old_file)
+    for old_row, new_row in zip(old, results):
+        for k, new_val in new_row.items():
+            old_val = old_row.get(k)
+            if isinstance(new_val, (int, float)) and isinstance(old_val, (int, float)) and old_val:
+                print("%-32s %12.3f -> %12.3f  (%+.1f%%)" % (k, old_val, new_val, 100.0 * (new_val - old_val) / old_val))
+
+
+def corrupted_stream(n_frames, corrupt_rate, seed):
+    # a device -> host stream of valid frames with drops, stray bytes and bit flips mixed in
+    import random
+    from hc_vitaminder_proto import MSG_RSP_HEARTBEAT, MSG_RSP_SET_LED, MSG_BOOT, MSG_BUTTON
+
+    rnd = random.Random(seed)
+    frames = []
+    out = bytearray()
+    for _ in range(n_frames):
+        kind = rnd.random()
+        if kind < 0.45:
+            frame = bytes([MSG_RSP_SET_LED, rnd.randrange(256)] + [rnd.randrange(256) for _ in range(3)] * 2)
+        elif kind < 0.85:
+            frame = bytes([MSG_RSP_HEARTBEAT, rnd.randrange(256)] + [rnd.randrange(256) for _ in range(6)])
+        elif kind < 0.98:
+            frame = bytes([MSG_BUTTON, rnd.randrange(2), rnd.randrange(2)] + [MSG_BUTTON] * 5)
+        else:
+            frame = bytes([MSG_BOOT] * 8)
+        frames.append(frame)
+
+        damaged = bytearray(frame)
+        if rnd.random() < corrupt_rate:
+            what = rnd.randrange(3)
+            pos = rnd.randrange(8)
+            if what == 0:
+                del damaged[pos]
+            elif what == 1:
+                damaged.insert(pos, rnd.randrange(256))
+            else:
+                damaged[pos] ^= 1 << rnd.randrange(8)
+        out += damaged
+    return frames, bytes(out)
+
+
+def count_in_order(expected, decoded):
+    # decoded frames that line up with the frames the device really sent
+    good = 0
+    i = 0
+    for frame in decoded:
+        for j in range(i, min(i + 4, len(expected))):
+            if expected[j] == frame:
+                good += 1
+                i = j + 1
+                break
+    return good
+
+
+def bench_decoder(args):
+    import random
+    from hc_vitaminder import FRAME_TYPES
+    from hc_vitaminder_proto import VitFrameDecoder
+
+    expected, stream = corrupted_stream(args.frames, args.corrupt_rate, args.seed)
+    rnd = random.Random(args.seed)
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        n = rnd.randint(1, args.max_chunk)
+        chunks.append(stream[pos:pos + n])
+        pos += n
+
+    # the old reader: fixed 8 byte reads, whatever lines up with a known ID is a frame
+    legacy = [stream[i:i + 8] for i in range(0, len(stream) - 7, 8) if stream[i] in FRAME_TYPES]
+
+    decoder = VitFrameDecoder(FRAME_TYPES)
+    decoded = []
+    for chunk in chunks:
+        for _, frame in decoder.feed(chunk):
+            decoded.append(bytes(frame))
+
+    # timing pass, nothing kept so we measure the decoder and not the list
+    timing = VitFrameDecoder(FRAME_TYPES)
+    t0 = time.perf_counter()
+    for chunk in chunks:
+        for _ in timing.feed(chunk):
+            pass
+    elapsed = time.perf_counter() - t0
+
+    result = {
+        "frames_sent": len(expected),
+        "stream_bytes": len(stream),
+        "corrupt_rate": args.corrupt_rate,
+        "elapsed_sec": elapsed,
+        "mb_per_sec": len(stream) / elapsed / 1e6,
+        "frames_per_sec": timing.frames / elapsed,
+        "decoder_good_frames": count_in_order(expected, decoded),
+        "decoder_frames": len(decoded),
+        "legacy_good_frames": count_in_order(expected, legacy),
+        "legacy_frames": len(legacy),
+    }
+    result.update(decoder.stats())
+    for k, v in result.items():
+        print("%-22s %s" % (k, "%.3f" % v if isinstance(v, float) else v))
+    return [result]
+
+
+def write_synthetic_journal(path, n_records, snapshot_every, seed):
+    # n_records of plausible history: a day of transitions and presses, repeated
+    import random
+    from hc_vitaminder_journal import HEADER, RECORD, MAGIC, VERSION, REC_SNAPSHOT, REC_TRANSITION, REC_BUTTON
+
+    rnd = random.Random(seed)
+    ts = 1.0e9
+    day = 700000
+    out = bytearray(HEADER.pack(MAGIC, VERSION, RECORD.size, int(time.time())))
+    out += RECORD.pack(ts, day, REC_SNAPSHOT, 1, 0, 0, 0.0)
+    since_snapshot = 0
+    for i in range(n_records - 1):
+        ts += rnd.uniform(600.0, 7200.0)
+        if since_snapshot >= snapshot_every:
+            out += RECORD.pack(ts, day, REC_SNAPSHOT, 5, 0, 0, 0.0)
+            since_snapshot = 0
+            continue
+        if i % 5 == 4:
+            day += 1
+            out += RECORD.pack(ts, day, REC_TRANSITION, 1, 5, 0, 0.0)
+        else:
+            out += RECORD.pack(ts, day, REC_BUTTON, 5, 1, 0, 0.0)
+        since_snapshot += 1
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def bench_journal(args):
+    import os
+    import tempfile
+    from hc_vitaminder_journal import VitJournal, REC_BUTTON
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.journal")
+        for n in args.records:
+            for label, snapshot_every in (("snapshots", args.snapshot_every), ("no_snapshots", n + 1)):
+                write_synthetic_journal(path, n, snapshot_every, args.seed)
+                size = os.path.getsize(path)
+                times = []
+                for _ in range(args.repeat):
+                    journal = VitJournal(path, snapshot_every=snapshot_every, max_records=n + 10)
+                    t0 = time.perf_counter()
+                    journal.open()
+                    times.append(time.perf_counter() - t0)
+                    replayed = journal.replayed
+                    journal.close()
+                row = {
+                    "records": n,
+                    "mode": label,
+                    "file_kb": size // 1024,
+                    "replayed": replayed,
+                    "restart_ms_p50": 1000.0 * percentile(times, 0.5),
+                    "restart_ms_max": 1000.0 * max(times),
+                }
+                results.append(row)
+                print("records=%(records)9d  %(mode)-12s  file=%(file_kb)7d kB  replayed=%(replayed)9d  "
+                      "restart p50=%(restart_ms_p50)8.3f ms  max=%(restart_ms_max)8.3f ms" % row)
+
+        # append cost with and without fsync batching
+        for batch in (1, args.fsync_batch):
+            os.unlink(path)
+            journal = VitJournal(path, fsync_batch=batch)
+            journal.open()
+            t0 = time.perf_counter()
+            for _ in range(args.appends):
+                journal.append(REC_BUTTON, 5, 1, 700000, 0.0)
+            journal.close()
+            elapsed = time.perf_counter() - t0
+            row = {
+                "fsync_batch": batch,
+                "appends": args.appends,
+                "fsyncs": journal.fsyncs,
+                "append_us": 1e6 * elapsed / args.appends,
+            }
+            results.append(row)
+            print("fsync_batch=%(fsync_batch)4d  appends=%(appends)6d  fsyncs=%(fsyncs)6d  "
+                  "per append=%(append_us)8.1f us" % row)
+    return results
+
+
+def synthetic_history(n_devices, n_days, seed):
+    # journal records for n_devices x n_days of plausible use, generated column-wise.
+    # every device-day follows one template of up to 12 events (rollover, reminders, presses),
+    # the day's outcome decides which of them happen
+    import numpy as np
+    from hc_vitaminder_analytics import JOURNAL_DTYPE, UNMEDICATED, SOFT_REMINDER, HARD_REMINDER, SNOOZE, \
+        NAILED_IT
+    from hc_vitaminder_journal import REC_TRANSITION, REC_BUTTON, BUTTON_OK, BUTTON_SNOOZE
+
+    rng = np.random.default_rng(seed)
+    n = n_devices * n_days
+    # outcome per device-day: 0 early, 1 during soft reminder, 2 late, 3 snoozed then late, 4 missed
+    outcome = rng.choice(5, size=n, p=[0.5, 0.25, 0.12, 0.08, 0.05])
+    hour = 3600.0
+    take_early = rng.uniform(8 * hour, 18 * hour, n)
+    take_soft = rng.uniform(18 * hour, 19 * hour, n)
+    snooze_at = rng.uniform(19 * hour, 20 * hour, n)
+    take_late = rng.uniform(20.5 * hour, 23.9 * hour, n)
+
+    early, soft, late, snoozed, missed = [outcome == i for i in range(5)]
+    reminded = ~early
+    hard = late | snoozed | missed
+    taken_late = late | snoozed
+    zero = np.zeros(n)
+    # (kind, state, detail, seconds into the day, happens)
+    template = [
+        (REC_TRANSITION, UNMEDICATED, NAILED_IT, zero + 1.0, np.ones(n, dtype=bool)),
+        (REC_BUTTON, NAILED_IT, BUTTON_OK, take_early, early),
+        (REC_TRANSITION, NAILED_IT, UNMEDICATED, take_early, early),
+        (REC_TRANSITION, SOFT_REMINDER, UNMEDICATED, zero + 18 * hour, reminded),
+        (REC_BUTTON, NAILED_IT, BUTTON_OK, take_soft, soft),
+        (REC_TRANSITION, NAILED_IT, SOFT_REMINDER, take_soft, soft),
+        (REC_TRANSITION, HARD_REMINDER, SOFT_REMINDER, zero + 19 * hour, hard),
+        (REC_BUTTON, SNOOZE, BUTTON_SNOOZE, snooze_at, snoozed),
+        (REC_TRANSITION, SNOOZE, HARD_REMINDER, snooze_at, snoozed),
+        (REC_TRANSITION, HARD_REMINDER, SNOOZE, snooze_at + 900.0, snoozed),
+        (REC_BUTTON, NAILED_IT, BUTTON_OK, take_late, taken_late),
+        (REC_TRANSITION, NAILED_IT, HARD_REMINDER, take_late, taken_late),
+    ]
+
+    device = np.repeat(np.arange(n_devices), n_days)
+    day = np.tile(np.arange(n_days, dtype=np.int64), n_devices) + 737000
+    midnight = (day - 719163) * 86400.0
+
+    slots = len(template)
+    table = np.zeros((n, slots), dtype=JOURNAL_DTYPE)
+    happens = np.zeros((n, slots), dtype=bool)
+    for j, (kind, state, detail, offset, mask) in enumerate(template):
+        table["kind"][:, j] = kind
+        table["state"][:, j] = state
+        table["detail"][:, j] = detail
+        table["ts"][:, j] = midnight + offset
+        table["snooze"][:, j] = np.where(state == SNOOZE, midnight + snooze_at + 900.0, 0.0)
+        happens[:, j] = mask
+    table["day"] = day[:, None]
+
+    # row-major flatten keeps every device-day's events together and in time order
+    records = table[happens]
+    devices = np.repeat(device, happens.sum(axis=1))
+    return records, devices
+
+
+def reference_report(records, devices, n_devices):
+    # the same numbers the slow way, one event at a time, to check the vectorized passes against
+    from hc_vitaminder_analytics import SOFT_REMINDER, UNMEDICATED, SNOOZE, NAILED_IT
+    from hc_vitaminder_journal import REC_TRANSITION, REC_BUTTON, BUTTON_SNOOZE
+
+    seen = set()
+    first_nailed = {}
+    first_soft = {}
+    snoozes = [0] * n_devices
+    for rec, dev in zip(records.tolist(), devices.tolist()):
+        ts, day, kind, state, detail, _, _ = rec
+        key = (dev, day)
+        seen.add(key)
+        if kind == REC_TRANSITION and state == NAILED_IT and key not in first_nailed:
+            first_nailed[key] = (ts, detail)
+        if kind == REC_TRANSITION and state == SOFT_REMINDER and key not in first_soft:
+            first_soft[key] = ts
+        if kind == REC_BUTTON and detail & BUTTON_SNOOZE and state == SNOOZE:
+            snoozes[dev] += 1
+
+    on_time = sum(1 for _, prev in first_nailed.values() if prev in (UNMEDICATED, SOFT_REMINDER))
+    delays = sorted(first_nailed[k][0] - first_soft[k] for k in first_soft
+                    if k in first_nailed and first_nailed[k][0] > first_soft[k])
+
+    streaks = [0] * n_devices
+    run = 0
+    last = None
+    for dev, day in sorted(first_nailed):
+        run = run + 1 if last == (dev, day - 1) else 1
+        streaks[dev] = max(streaks[dev], run)
+        last = (dev, day)
+
+    mid = len(delays) // 2
+    median = delays[mid] if len(delays) % 2 else (delays[mid - 1] + delays[mid]) / 2
+    return {
+        "on_time_rate": on_time / len(seen),
+        "soft_to_nailed_median_min": median / 60.0,
+        "snoozes": sum(snoozes),
+        "longest_streak_days": max(streaks),
+    }
+
+
+def bench_analytics(args):
+    import os
+    import tempfile
+    import numpy as np
+    from hc_vitaminder_analytics import History, load_history, on_time_by_day, soft_to_nailed, snooze_counts, \
+        longest_streaks, report
+    from hc_vitaminder_journal import HEADER, MAGIC, VERSION, RECORD
+
+    n_days = max(1, args.events // (args.devices * 4))
+    t0 = time.perf_counter()
+    records, devices = synthetic_history(args.devices, n_days, args.seed)
+    generate_sec = time.perf_counter() - t0
+    print("generated %d events, %d devices x %d days in %.2f s" % (len(records), args.devices, n_days, generate_sec))
+
+    with tempfile.TemporaryDirectory() as tmp:
+        journals = []
+        bounds = np.searchsorted(devices, np.arange(args.devices + 1))
+        header = HEADER.pack(MAGIC, VERSION, RECORD.size, int(time.time()))
+        for d in range(args.devices):
+            path = os.path.join(tmp, "dev%d.journal" % d)
+            with open(path, "wb") as f:
+                f.write(header)
+                records[bounds[d]:bounds[d + 1]].tofile(f)
+            journals.append(("dev%d" % d, path))
+
+        t0 = time.perf_counter()
+        history = load_history(journals)
+        load_sec = time.perf_counter() - t0
+
+    timings = {}
+    for name, fn in (("on_time_by_day", on_time_by_day), ("soft_to_nailed", soft_to_nailed),
+                     ("snooze_counts", snooze_counts), ("longest_streaks", longest_streaks)):
+        t0 = time.perf_counter()
+        fn(history)
+        timings[name] = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    result = report(history)
+    report_sec = time.perf_counter() - t0
+
+    # the per-event loop on a slice, for a speed comparison and to check the numbers
+    n_ref = min(len(records), args.reference_events)
+    ref_devices = devices[:n_ref]
+    n_ref = int(np.searchsorted(ref_devices, ref_devices[-1]))
+    ref_records, ref_devices = records[:n_ref], devices[:n_ref]
+    ref_count = int(ref_devices[-1]) + 1
+    t0 = time.perf_counter()
+    expected = reference_report(ref_records, ref_devices, ref_count)
+    reference_sec = time.perf_counter() - t0
+    sliced = History.from_records(["dev%d" % d for d in range(ref_count)], ref_devices, ref_records)
+    t0 = time.perf_counter()
+    got = report(sliced)
+    sliced_sec = time.perf_counter() - t0
+    for k, v in expected.items():
+        if abs(got[k] - v) > 1e-9 * max(1.0, abs(v)):
+            raise AssertionError("%s: vectorized %r, reference %r" % (k, got[k], v))
+
+    row = {
+        "events": len(history),
+        "devices": args.devices,
+        "days": n_days,
+        "load_sec": load_sec,
+        "load_mevents_per_sec": len(history) / load_sec / 1e6,
+        "report_sec": report_sec,
+        "report_mevents_per_sec": len(history) / report_sec / 1e6,
+        "reference_events": n_ref,
+        "reference_loop_sec": reference_sec,
+        "vectorized_same_slice_sec": sliced_sec,
+        "speedup": reference_sec / sliced_sec,
+        "on_time_rate": result["on_time_rate"],
+        "soft_to_nailed_median_min": result["soft_to_nailed_median_min"],
+        "snoozes": result["snoozes"],
+        "longest_streak_days": result["longest_streak_days"],
+    }
+    for name, sec in timings.items():
+        row[name + "_sec"] = sec
+    for k, v in row.items():
+        print("%-28s %s" % (k, "%.3f" % v if isinstance(v, float) else v))
+    return [row]
+
+
+def bench_proto(args):
+    from hc_vitaminder import VitEvent, VitMsg, VitState
+    from hc_vitaminder_sim import LoopbackHost, SimFirmware
+
+    # state changes the way the controller makes them, against firmware of either generation.
+    # "split" gives the sys LED its own color, which v1 can only do with one frame per color
+    states = [VitState.SOFT_REMINDER, VitState.HARD_REMINDER, VitState.SNOOZE, VitState.NAILED_IT,
+              VitState.UNMEDICATED]
+    bits_per_byte = 10  # 8N1
+
+    results = []
+    for colors in ("same", "split"):
+        for host, firmware in ((1, 1), (2, 1), (2, 2)):
+            cfg = bench_config(args.config)
+            cfg["protocol_version"] = str(host)
+            if colors == "split":
+                for key in ("unmedicated", "nailed_it", "soft_reminder", "hard_reminder", "snooze"):
+                    cfg["sys_color_" + key] = args.sys_color
+
+            fw = SimFirmware(protocol=firmware)
+            loopback = LoopbackHost(cfg, fw, timers=False).start()
+            v = loopback.v
+
+            # negotiate, old firmware just never answers the HELLO
+            v.send_hello()
+            loopback.wait_for(lambda: v.protocol >= min(host, firmware), timeout=0.5)
+
+            port = loopback.port
+            out_before, in_before, frames_before = port.bytes_written, port.bytes_read, v.metrics.serial_frames_out
+            mismatched = 0
+            t0 = time.perf_counter()
+            for i in range(args.changes):
+                state = states[i % len(states)]
+                plan = v.cfg.led_plan(state)
+                v.state = state
+                v.add_event(VitEvent(VitMsg.STATE))
+                loopback.wait_for(lambda: v.led_echo_acked == plan.echo, poll=0.0002)
+                if tuple(fw.pixels) != plan.pixels or fw.brightness != plan.brightness:
+                    mismatched += 1
+            elapsed = time.perf_counter() - t0
+
+            loopback.stop()
+
+            out_bytes = (port.bytes_written - out_before) / args.changes
+            in_bytes = (port.bytes_read - in_before) / args.changes
+            row = {
+                "colors": colors,
+                "host": host,
+                "firmware": firmware,
+                "protocol": v.protocol,
+                "frames_out": (v.metrics.serial_frames_out - frames_before) / args.changes,
+                "bytes_out": out_bytes,
+                "bytes_in": in_bytes,
+                "air_ms": 1000.0 * (out_bytes + in_bytes) * bits_per_byte / args.baud,
+                "crc_errors": fw.crc_errors,
+                "pixel_mismatches": mismatched,
+                "changes_per_sec": args.changes / elapsed,
+            }
+            results.append(row)
+            print("%(colors)-5s host=v%(host)d fw=v%(firmware)d -> v%(protocol)d  frames=%(frames_out)4.1f  "
+                  "out=%(bytes_out)5.1f B  in=%(bytes_in)5.1f B  air=%(air_ms)6.2f ms  "
+                  "crc_err=%(crc_errors)d  mismatch=%(pixel_mismatches)d" % row)
+    return results
+
+
+def bench_anim(args):
+    from hc_vitaminder import VitEvent, VitMsg, VitState
+    from hc_vitaminder_sim import LoopbackHost
+
+    # LED animation against the simulated device: keyframe lateness (due -> written), the
+    # spacing the device actually sees, and whether the writes stay inside the byte budget.
+    # the "saturated" runs keep the link busy with heartbeats to make the animation back off
+    scenarios = [
+        ("blink", {"pattern_hard_reminder": "blink"}, 0.0),
+        ("pulse", {"pattern_hard_reminder": "pulse", "pattern_period_ms_hard_reminder": "1000"}, 0.0),
+        ("fade", {"pattern_hard_reminder": "fade", "pattern_period_ms_hard_reminder": "2000"}, 0.0),
+        ("pulse saturated", {"pattern_hard_reminder": "pulse", "pattern_period_ms_hard_reminder": "1000"},
+         args.saturate_interval),
+    ]
+
+    results = []
+    for name, settings, heartbeat_interval in scenarios:
+        cfg = bench_config(args.config)
+        cfg["anim_max_fps"] = str(args.fps)
+        for k, val in settings.items():
+            cfg[k] = val
+
+        writes = []
+
+        def on_write(data):
+            if data[0] in (0x02, 0x0A):
+                writes.append(time.perf_counter())
+
+        host = LoopbackHost(cfg, on_write=on_write, start_clock=False).start()
+        v = host.v
+
+        stop = threading.Event()
+        noise = None
+        if heartbeat_interval:
+            def heartbeats():
+                while not stop.wait(heartbeat_interval):
+                    v.add_event(VitEvent(VitMsg.HEARTBEAT, True))
+            noise = threading.Thread(target=heartbeats)
+            noise.start()
+
+        v.state = VitState.HARD_REMINDER
+        t0 = time.perf_counter()
+        out_before = host.port.bytes_written
+        v.add_event(VitEvent(VitMsg.STATE))
+        time.sleep(args.duration)
+        elapsed = time.perf_counter() - t0
+        out_bytes = host.port.bytes_written - out_before
+
+        stop.set()
+        if noise is not None:
+            noise.join()
+        host.stop()
+
+        pattern = v.cfg.led_pattern(VitState.HARD_REMINDER)
+        intervals = [b - a for a, b in zip(writes, writes[1:])]
+        lateness = v.animator.lateness.stats()
+        row = {
+            "scenario": name,
+            "keyframes_per_cycle": len(v.animator.cache.get(v.animator.level, [])),
+            "level": v.animator.level,
+            "sent": v.animator.sent,
+            "dropped": v.animator.dropped,
+            "keyframes_per_sec": len(writes) / elapsed,
+            "bytes_per_sec": out_bytes / elapsed,
+            "budget_bytes_per_sec": v.link_budget.rate,
+            "lateness_mean_ms": 1000.0 * lateness["mean"] if lateness["mean"] is not None else None,
+            "lateness_max_ms": 1000.0 * lateness["max"],
+            "interval_p50_ms": 1000.0 * percentile(intervals, 0.5) if intervals else None,
+            "interval_p99_ms": 1000.0 * percentile(intervals, 0.99) if intervals else None,
+            "period_ms": 1000.0 * pattern.period,
+        }
+        results.append(row)
+        print("%(scenario)-16s kf/cycle=%(keyframes_per_cycle)3d level=%(level)d "
+              "sent=%(sent)5d dropped=%(dropped)4d  "
+              "kf/s=%(keyframes_per_sec)5.1f  B/s=%(bytes_per_sec)6.1f of %(budget_bytes_per_sec)5.0f  "
+              "late mean=%(lateness_mean_ms)5.2f max=%(lateness_max_ms)6.2f ms  "
+              "interval p50=%(interval_p50_ms)7.2f p99=%(interval_p99_ms)7.2f ms" % row)
+    return results
+
+
+def bench_ports(args):
+    # cost of one look at the serial ports: comports() against the discovery cache, on the
+    # real /dev and on a scratch dir holding --nodes fake rfcomm nodes
+    import tempfile
+    import serial.tools.list_ports
+    from hc_vitaminder_ports import PortDiscovery
+
+    def timed(fn, repeat):
+        samples = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - t0)
+        return samples
+
+    results = []
+
+    def report(scenario, samples, **extra):
+        row = {
+            "scenario": scenario,
+            "p50_us": 1e6 * percentile(samples, 0.5),
+            "p99_us": 1e6 * percentile(samples, 0.99),
+        }
+        row.update(extra)
+        results.append(row)
+        print("%-26s p50=%9.1f us  p99=%9.1f us  %s" % (scenario, row["p50_us"], row["p99_us"],
+                                                        " ".join("%s=%s" % kv for kv in sorted(extra.items()))))
+
+    report("comports", timed(serial.tools.list_ports.comports, args.repeat),
+           ports=len(serial.tools.list_ports.comports()))
+
+    if sys.platform.startswith("linux"):
+        def first_dev():
+            PortDiscovery().refresh()
+        report("discovery first scan", timed(first_dev, args.repeat))
+        discovery = PortDiscovery()
+        discovery.refresh()
+        report("discovery no change", timed(discovery.refresh, args.repeat), ports=len(discovery.ports()))
+
+    with tempfile.TemporaryDirectory() as dev_dir:
+        for i in range(args.nodes):
+            open(os.path.join(dev_dir, "rfcomm%d" % i), "w").close()
+        discovery = PortDiscovery(dev_dir=dev_dir, incremental=True)
+        discovery.refresh()
+
+        def replug():
+            # one link drops and comes back: the node is removed and created again
+            path = os.path.join(dev_dir, "rfcomm0")
+            os.remove(path)
+            discovery.refresh()
+            open(path, "w").close()
+            added, removed = discovery.refresh()
+            assert [p.device for p in added] == [path]
+
+        probes = discovery.probes
+        samples = timed(replug, args.repeat)
+        report("replug (2 scans), %d nodes" % args.nodes, samples,
+               probes_per_replug=(discovery.probes - probes) / args.repeat)
+
+    return results
+
+
+def bench_reconnect(args):
+    from hc_vitaminder import VitEvent, VitMsg, VitState
+    from hc_vitaminder_sim import FlakyLink, LoopbackHost, SimFirmware
+
+    # link drops on purpose (FlakyLink): the state changes a few times while it is down, then
+    # the link comes back.  how long until the port is reopened, until the device confirms the
+    # current state, and how many set-LED frames that took (only the latest state should go out)
+    states = [VitState.SOFT_REMINDER, VitState.HARD_REMINDER, VitState.SNOOZE, VitState.NAILED_IT]
+    # every outage logs a warning, that's the point here
+    logging.getLogger("hc_vitaminder").setLevel(logging.ERROR)
+
+    results = []
+    for mode in args.modes:
+        cfg = bench_config(args.config)
+        cfg["reconnect_initial_sec"] = str(args.initial)
+        cfg["reconnect_max_sec"] = str(args.max)
+        # solid colors, an animation would keep writing keyframes after the state is confirmed
+        for key in ("blink_soft_off", "blink_hard_off"):
+            cfg[key] = "0"
+
+        led_writes = []
+
+        def on_write(data):
+            if data[0] in (0x02, 0x0A):
+                led_writes.append(time.perf_counter())
+
+        link = FlakyLink(SimFirmware(), timeout=0.05, on_write=on_write)
+        host = LoopbackHost(cfg, link.firmware, open_port=link.open, mode=mode).start()
+        v = host.v
+
+        def wait_confirmed(deadline):
+            while time.perf_counter() < deadline:
+                if v.supervisor.up and v.led_echo_acked == v.cfg.led_plan(v.state).echo:
+                    return time.perf_counter()
+                time.sleep(0.0005)
+            return None
+
+        wait_confirmed(time.perf_counter() + 2.0)
+        confirm, frames_after, failed = [], [], 0
+        for i in range(args.outages):
+            link.cut()
+            time.sleep(args.outage / (args.changes + 1))
+            for k in range(args.changes):
+                v.state = states[(i * args.changes + k) % len(states)]
+                v.add_event(VitEvent(VitMsg.STATE))
+                time.sleep(args.outage / (args.changes + 1))
+            restored = time.perf_counter()
+            del led_writes[:]
+            link.restore()
+            done = wait_confirmed(restored + args.max + 2.0)
+            if done is None:
+                failed += 1
+                continue
+            confirm.append(done - restored)
+            frames_after.append(len(led_writes))
+
+        alive = host.alive()
+        host.stop()
+
+        link_stats = v.supervisor.stats()
+        row = {
+            "mode": mode,
+            "outages": args.outages,
+            "outage_sec": args.outage,
+            "changes_per_outage": args.changes,
+            "not_recovered": failed,
+            "threads_alive": alive,
+            "confirm_p50_ms": 1000.0 * percentile(confirm, 0.5) if confirm else None,
+            "confirm_p99_ms": 1000.0 * percentile(confirm, 0.99) if confirm else None,
+            "confirm_max_ms": 1000.0 * max(confirm) if confirm else None,
+            "led_frames_after_mean": sum(frames_after) / len(frames_after) if frames_after else None,
+            "led_frames_after_max": max(frames_after) if frames_after else None,
+            "downtime_mean_sec": link_stats["recovery"]["mean"],
+            "reconnect_attempts": link_stats["attempts"],
+            "failed_opens": link.failed_opens,
+            "held": link_stats["held"],
+            "superseded": link_stats["superseded"],
+            "dropped": link_stats["dropped"],
+        }
+        results.append(row)
+        print("%(mode)-7s outages=%(outages)d not recovered=%(not_recovered)d threads alive=%(threads_alive)s  "
+              "restore->confirmed p50=%(confirm_p50_ms)6.1f p99=%(confirm_p99_ms)6.1f ms  "
+              "LED frames after=%(led_frames_after_mean).1f (max %(led_frames_after_max)d)  "
+              "attempts=%(reconnect_attempts)d held=%(held)d superseded=%(superseded)d dropped=%(dropped)d" % row)
+    return results
+
+
+def bench_startup(args):
+    # the daemon's own --profile-startup report, started fresh --runs times per mode against a
+    # simulated device, and how much of the daemon's import each module costs
+    import re
+    import shutil
+    import subprocess
+    import tempfile
+    from hc_vitaminder_sim import VitSimulator
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    phase_re = re.compile(r"([a-z ]+) ([0-9.]+) ms")
+    sim = VitSimulator(seed=1)
+    dev = sim.add_device(latency=0.0, boot_delay=0.0)
+    sim.start()
+    work_dir = tempfile.mkdtemp()
+
+    configuration = configparser.ConfigParser()
+    configuration.read(args.config)
+    configuration["DEFAULT"]["comm_port"] = dev.port_name
+    configuration["DEFAULT"]["journal_dir"] = os.path.join(work_dir, "journal")
+    config_file = os.path.join(work_dir, "bench.ini")
+    with open(config_file, "w") as f:
+        configuration.write(f)
+
+    def one_run(extra):
+        p = subprocess.Popen([sys.executable, os.path.join(here, "hc_vitaminder.py"), config_file,
+                              "--profile-startup"] + extra, cwd=here, stderr=subprocess.PIPE, text=True)
+        phases = None
+        for line in p.stderr:
+            if "startup:" in line:
+                phases = {name.strip(): float(ms) for name, ms in phase_re.findall(line.split("startup:", 1)[1])}
+                break
+        p.kill()
+        p.communicate()
+        return phases
+
+    results = []
+    try:
+        for mode, extra in (("threads", []), ("threads fast-start", ["--fast-start"]),
+                            ("asyncio fast-start", ["--fast-start", "--async"])):
+            # the first fast start only writes the snapshot
+            one_run(extra)
+            runs = [one_run(extra) for _ in range(args.runs)]
+            runs = [phases for phases in runs if phases is not None]
+            row = {"mode": mode, "runs": len(runs)}
+            for name in runs[0] if runs else ():
+                row[name + "_ms"] = percentile([phases.get(name, 0.0) for phases in runs], 0.5)
+            results.append(row)
+            print("%-20s %s" % (mode, "  ".join("%s=%.1f" % (k[:-3], v) for k, v in row.items() if k.endswith("_ms"))))
+    finally:
+        sim.stop()
+        sim.close()
+        shutil.rmtree(work_dir)
+
+    code = ("import time, sys; t = time.perf_counter(); import %s; "
+            "print(time.perf_counter() - t, 'asyncio' in sys.modules, 'serial' in sys.modules)")
+    for module in ("hc_vitaminder", "hc_vitaminder_gui"):
+        samples = []
+        for _ in range(args.runs):
+            out = subprocess.run([sys.executable, "-c", code % module], cwd=here, capture_output=True, text=True)
+            if out.returncode != 0:
+                break
+            sec, has_asyncio, has_serial = out.stdout.split()
+            samples.append(float(sec))
+        if samples:
+            row = {"import": module, "import_ms": 1000.0 * percentile(samples, 0.5),
+                   "loads_asyncio": has_asyncio == "True", "loads_serial": has_serial == "True"}
+            results.append(row)
+            print("import %-18s %6.1f ms  asyncio=%s serial=%s" % (module, row["import_ms"], has_asyncio, has_serial))
+    return results
+
+
+def synthetic_medications(n, seed):
+    # n medications with one to three windows per level, some weekday only, some with hard windows
+    import random
+    from hc_vitaminder_rules import Medication, LEVEL_UNMEDICATED, LEVEL_SOFT, LEVEL_HARD, DAY_US, ALL_DAYS
+
+    rng = random.Random(seed)
+    minute = DAY_US // 1440
+    medications = []
+    for i in range(n):
+        windows = {}
+        for level in (LEVEL_UNMEDICATED, LEVEL_SOFT) + ((LEVEL_HARD,) if rng.random() < 0.5 else ()):
+            windows[level] = tuple((rng.randrange(1440) * minute, rng.randrange(1440) * minute)
+                                   for _ in range(rng.randint(1, 3)))
+        days = ALL_DAYS if rng.random() < 0.5 else frozenset(rng.sample(range(7), rng.randint(1, 6)))
+        medications.append(Medication("med%d" % i, windows, days, rng.choice((300, 600, 900))))
+    return medications
+
+
+def bench_rules(args):
+    # the rules index against scanning every medication's windows at each lookup, per medication count
+    import random
+    from datetime import datetime, timedelta
+    from hc_vitaminder_rules import RuleIndex, VitRules, week_us
+
+    def scan(paints_by_med, when):
+        # what the daemon would do without the index: every window of every medication, each time
+        now = week_us(when)
+        due = []
+        for paints in paints_by_med:
+            level = None
+            for start, stop, painted in paints:
+                if start <= now < stop:
+                    level = painted
+            due.append(level)
+        return tuple(due)
+
+    rng = random.Random(args.seed)
+    base = datetime(2026, 1, 5)
+    instants = [base + timedelta(seconds=rng.uniform(0, 28 * 86400)) for _ in range(args.lookups)]
+
+    results = []
+    for n in args.medications:
+        medications = synthetic_medications(n, args.seed)
+        t0 = time.perf_counter()
+        index = RuleIndex(medications)
+        compile_sec = time.perf_counter() - t0
+        rules = VitRules(index)
+        paints_by_med = [m.paints() for m in medications]
+
+        mismatched = sum(index.levels_at(when) != scan(paints_by_med, when) for when in instants[:args.check])
+
+        t0 = time.perf_counter()
+        for when in instants:
+            rules.level(when)
+        level_sec = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for when in instants:
+            rules.next_transition(when)
+        next_sec = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for when in instants[:args.check]:
+            scan(paints_by_med, when)
+        scan_sec = time.perf_counter() - t0
+
+        row = {
+            "medications": n,
+            "segments": len(index.starts),
+            "compile_ms": 1000.0 * compile_sec,
+            "level_us": 1e6 * level_sec / len(instants),
+            "next_transition_us": 1e6 * next_sec / len(instants),
+            "scan_us": 1e6 * scan_sec / args.check,
+            "mismatched": mismatched,
+        }
+        results.append(row)
+        print("meds=%(medications)4d segments=%(segments)6d compile=%(compile_ms)9.1f ms  level=%(level_us)7.2f us  "
+              "next=%(next_transition_us)6.2f us  scan=%(scan_us)9.2f us  mismatched=%(mismatched)d" % row)
+    return results
+
+
+def bench_replay(args):
+    # wire capture cost and replay speed: a loopback session with --presses button presses is
+    # recorded (or --trace is used as it is), then replayed as fast as the host goes
+    import shutil
+    import tempfile
+    from hc_vitaminder_capture import CaptureSerial, VitTraceWriter, read_trace, replay
+    from hc_vitaminder_sim import LoopbackHost, LoopbackSerial, SimFirmware
+
+    work_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        path = args.trace
+        if path is None:
+            path = os.path.join(work_dir, "bench.vitcap")
+            fw = SimFirmware()
+            port = LoopbackSerial(fw, timeout=0.05)
+            trace = VitTraceWriter(path)
+            host = LoopbackHost(bench_config(args.config), fw, port=CaptureSerial(port, trace))
+            v = host.v
+            v.trace = trace
+            host.start()
+            for _ in range(args.presses):
+                time.sleep(args.press_interval)
+                host.press(True, False)
+            time.sleep(0.2)
+            host.stop()
+            row = dict(v.trace.stats(), scenario="capture", file_bytes=os.path.getsize(path))
+            results.append(row)
+            print("capture  records=%(records)d payload=%(bytes)d B file=%(file_bytes)d B flushes=%(flushes)d" % row)
+
+        records = len(read_trace(path)[1])
+        for speed in args.speeds:
+            v, port, elapsed = replay(path, bench_config(args.config), speed, settle_sec=0.05)
+            stats = port.stats()
+            events = sum(v.metrics.events.values())
+            row = dict(stats, scenario="replay", speed=speed, seconds=elapsed, records=records,
+                       records_per_sec=records / elapsed if elapsed else 0.0, events=events,
+                       events_per_sec=events / elapsed if elapsed else 0.0)
+            results.append(row)
+            print("replay speed=%(speed)-4g %(seconds)8.3f s  %(records_per_sec)10.0f records/s  "
+                  "%(events_per_sec)9.0f events/s  mismatched=%(mismatched_writes)d forced=%(forced)d" % row)
+    finally:
+        shutil.rmtree(work_dir)
+    return results
+
+
+def bench_days(args):
+    # accelerated time: simulated days per wall second against a virtual clock, with the
+    # transitions checked against the schedule (off_schedule has to stay 0)
+    from datetime import date
+    from hc_vitaminder_timesim import DaySimulation, parse_press, sim_config
+
+    results = []
+    presses = [parse_press(p) for p in args.press or ("19:05 snooze", "19:30 ok")]
+    for days in args.days:
+        for animate in (False, True) if args.animate else (False,):
+            sim = DaySimulation(sim_config(bench_config(args.config), animate), days, start=date(2026, 1, 5),
+                                presses=presses, jitter_sec=60.0 * args.jitter_min, skip_prob=args.skip_prob,
+                                seed=args.seed)
+            result = sim.report(sim.run())
+            row = {k: v for k, v in result.items() if k not in ("transition_times", "liveness")}
+            row["animate"] = animate
+            row["heartbeats"] = result["liveness"]["heartbeats_sent"]
+            results.append(row)
+            print("days=%(days)5d animate=%(animate)-5s %(wall_sec)8.2f s  %(days_per_sec)8.0f days/s  "
+                  "%(events_per_sec)8.0f events/s  transitions=%(transitions)d off_schedule=%(off_schedule)d  "
+                  "heartbeats=%(heartbeats)d solitude_errors=%(solitude_errors)d" % row)
+    return results
+
+
+def run_api_device(cfg, queue, stop):
+    # child process side of the api benchmark: one controller (threads mode, loopback device)
+    # with the api in front of it.  its clock starts at 20:00, a hard reminder, and every OK
+    # that nails it moves the clock a day on, so the next clock event rolls back into the
+    # reminder: two real transitions per press, as many presses as the benchmark likes
+    from datetime import datetime, date, time as dt_time
+    from hc_vitaminder import VitEvent, VitMsg, VitState
+    from hc_vitaminder_api import VitApiServer
+    from hc_vitaminder_sim import LoopbackHost
+
+    start = datetime.combine(date.today(), dt_time(20, 0)).timestamp()
+    t0 = time.monotonic()
+    shift = [0.0]
+
+    def clock():
+        return start + shift[0] + time.monotonic() - t0
+
+    def next_day(v, old_state):
+        if v.state == VitState.NAILED_IT:
+            shift[0] += 86400
+            v.add_event(VitEvent(VitMsg.CLOCK))
+
+    host = LoopbackHost(cfg, clock=clock).start()
+    v = host.v
+    # the state only means something once the first clock event ran and the device acked its LEDs
+    if not host.wait_for(lambda: v.led_echo_acked == v.cfg.led_plan(v.state).echo, timeout=5.0):
+        print("the device never acked its LEDs, reporting %s anyway" % v.state.name)
+    server = VitApiServer([v], 0).start()
+    v.transition_listeners.append(next_day)
+
+    queue.put((server.port, v.state.name))
+    stop.wait()
+    server.stop()
+    host.stop()
+    queue.put(server.stats())
+
+
+class ApiClient:
+    # keep-alive HTTP/1.1 client, just enough for the api's JSON answers
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, port):
+        return cls(*await asyncio.open_connection("127.0.0.1", port))
+
+    async def request(self, method, path):
+        self.writer.write(b"%s %s HTTP/1.1\r\nHost: bench\r\nContent-Length: 0\r\n\r\n"
+                          % (method.encode(), path.encode()))
+        head = await self.reader.readuntil(b"\r\n\r\n")
+        length = 0
+        for line in head.split(b"\r\n"):
+            if line.lower().startswith(b"content-length:"):
+                length = int(line.split(b":")[1])
+        body = await self.reader.readexactly(length)
+        return int(head.split(b" ")[1]), body
+
+    def close(self):
+        self.writer.close()
+
+
+async def api_subscriber(port, ready, on_transition):
+    # one /events client: ready once the first state event came in, then every transition
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(b"GET /events HTTP/1.1\r\nHost: bench\r\nAccept: text/event-stream\r\n\r\n")
+    await reader.readuntil(b"\r\n\r\n")
+    event = None
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            if line.startswith(b"event: "):
+                event = line[7:-1]
+            elif line.startswith(b"data: "):
+                if event == b"state" and not ready.done():
+                    ready.set_result(None)
+                elif event == b"transition":
+                    on_transition(json.loads(line[6:])["state"])
+    finally:
+        writer.close()
+
+
+def bench_api(args):
+    # the local api (hc_vitaminder_api.py) in a child process against N idle /events subscribers
+    # here: memory per subscriber, press (POST /ok) to every subscriber having the transition,
+    # and GET /state throughput with all of them connected
+    needed = 2 * max(args.subscribers) + args.state_clients + 64
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    counts = [n for n in sorted(args.subscribers) if 2 * n + args.state_clients + 64 <= soft]
+    if len(counts) < len(args.subscribers):
+        print("open file limit %d, only running %s subscribers" % (soft, counts))
+    logging.getLogger("hc_vitaminder").setLevel(logging.WARNING)
+
+    cfg = bench_config(args.config)
+    # solid colors, blinking would only add keyframes the device side has to answer
+    for key in ("blink_soft_off", "blink_hard_off"):
+        cfg[key] = "0"
+    ctx = multiprocessing.get_context("fork")
+    queue = ctx.Queue()
+    stop = ctx.Event()
+    child = ctx.Process(target=run_api_device, args=(cfg, queue, stop))
+    child.start()
+    port, state = queue.get(timeout=10)
+    if state != "HARD_REMINDER":
+        print("device started in %s instead of HARD_REMINDER, the presses won't nail anything" % state)
+    rss_base = rss_kb(child.pid)
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        seen = {}
+        waiting = {}
+        arrivals = []
+        pressed = [0.0]
+
+        def on_transition(state):
+            seen[state] = seen.get(state, 0) + 1
+            if state == "NAILED_IT":
+                arrivals.append(time.perf_counter() - pressed[0])
+            waiter = waiting.get(state)
+            if waiter is not None and seen[state] >= waiter[0] and not waiter[1].done():
+                waiter[1].set_result(None)
+
+        async def wait_seen(state, n):
+            if seen.get(state, 0) >= n:
+                return True
+            waiting[state] = (n, loop.create_future())
+            try:
+                await asyncio.wait_for(waiting[state][1], args.timeout)
+                return True
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                del waiting[state]
+
+        async def subscribe(ready):
+            try:
+                await api_subscriber(port, ready, on_transition)
+            except (ConnectionError, OSError, asyncio.IncompleteReadError) as e:
+                if not ready.done():
+                    ready.set_exception(e)
+
+        async def state_worker(requests, latencies):
+            client = await ApiClient.connect(port)
+            for _ in range(requests):
+                t = time.perf_counter()
+                status, _ = await client.request("GET", "/state")
+                latencies.append(time.perf_counter() - t)
+                if status != 200:
+                    raise RuntimeError("GET /state answered %d" % status)
+            client.close()
+
+        results = []
+        tasks = []
+        presser = await ApiClient.connect(port)
+        for n in counts:
+            t = time.perf_counter()
+            while len(tasks) < n:
+                # in batches, a few thousand connects at once would overflow the listen backlog
+                batch = [loop.create_future() for _ in range(min(args.batch, n - len(tasks)))]
+                tasks += [asyncio.create_task(subscribe(ready)) for ready in batch]
+                await asyncio.gather(*batch)
+            connect_sec = time.perf_counter() - t
+            rss = rss_kb(child.pid)
+
+            last, posts, missed = [], [], 0
+            del arrivals[:]
+            for _ in range(args.presses):
+                seen.clear()
+                pressed[0] = time.perf_counter()
+                first = len(arrivals)
+                status, _ = await presser.request("POST", "/ok")
+                posts.append(time.perf_counter() - pressed[0])
+                if status != 202 or not await wait_seen("NAILED_IT", n):
+                    missed += 1
+                else:
+                    last.append(max(arrivals[first:]))
+                # the rollover back into the reminder, so the next press has something to nail
+                if not await wait_seen("HARD_REMINDER", n):
+                    missed += 1
+
+            per_client = args.state_requests // args.state_clients
+            latencies = []
+            t = time.perf_counter()
+            await asyncio.gather(*(state_worker(per_client, latencies) for _ in range(args.state_clients)))
+            state_sec = time.perf_counter() - t
+
+            row = {
+                "subscribers": n,
+                "connect_sec": connect_sec,
+                "child_rss_kb": rss,
+                "rss_per_subscriber_kb": (rss - rss_base) / n,
+                "presses": args.presses,
+                "missed": missed,
+                "post_p50_ms": 1000.0 * percentile(posts, 0.5),
+                "fanout_p50_ms": 1000.0 * percentile(arrivals, 0.5) if arrivals else None,
+                "fanout_p99_ms": 1000.0 * percentile(arrivals, 0.99) if arrivals else None,
+                "last_subscriber_p50_ms": 1000.0 * percentile(last, 0.5) if last else None,
+                "last_subscriber_max_ms": 1000.0 * max(last) if last else None,
+                "state_req_per_sec": len(latencies) / state_sec,
+                "state_p99_ms": 1000.0 * percentile(latencies, 0.99),
+            }
+            results.append(row)
+            print("subscribers=%(subscribers)5d  rss=%(child_rss_kb)6d kB (%(rss_per_subscriber_kb)5.1f kB each)  "
+                  "press->all p50=%(last_subscriber_p50_ms)7.2f max=%(last_subscriber_max_ms)7.2f ms  "
+                  "per subscriber p50=%(fanout_p50_ms)6.2f p99=%(fanout_p99_ms)6.2f ms  missed=%(missed)d  "
+                  "GET /state %(state_req_per_sec)6.0f req/s (p99 %(state_p99_ms).2f ms)" % row)
+
+        presser.close()
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return results
+
+    try:
+        results = asyncio.run(run())
+    finally:
+        stop.set()
+        api_stats = queue.get(timeout=10)
+        child.join()
+    print("api: %s" % api_stats)
+    return results
+
+
+BENCHMARKS = {
+    "hub": bench_hub,
+    "decoder": bench_decoder,
+    "ctl": bench_ctl,
+    "journal": bench_journal,
+    "analytics": bench_analytics,
+    "proto": bench_proto,
+    "anim": bench_anim,
+    "ports": bench_ports,
+    "startup": bench_startup,
+    "reconnect": bench_reconnect,
+    "rules": bench_rules,
+    "replay": bench_replay,
+    "days": bench_days,
+    "api": bench_api,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vitaminder host benchmarks")
+    parser.add_argument("--json", default=None, help="also write the results to this json file")
+    parser.add_argument("--compare", default=None, help="print the change against an earlier --json file")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+
+    p = sub.add_parser("hub", help="memory and cpu of one hub process against N simulated devices")
+    p.add_argument("--config", default="hc-vitaminder.ini")
+    p.add_argument("--devices", type=int, nargs="+", default=[1, 10, 50, 100, 200])
+    p.add_argument("--duration", type=float, default=5.0, help="seconds to run each device count")
+    p.add_argument("--press-interval", type=float, default=0.5, help="seconds between button presses per device")
+
+    p = sub.add_parser("decoder", help="frame decoder throughput and recovery on a corrupted byte stream")
+    p.add_argument("--frames", type=int, default=200000)
+    p.add_argument("--corrupt-rate", type=float, default=0.01, help="fraction of frames damaged on the wire")
+    p.add_argument("--max-chunk", type=int, default=64, help="largest read size fed to the decoder")
+    p.add_argument("--seed", type=int, default=1)
+
+    p = sub.add_parser("ctl", help="control loop throughput, button to LED latency, allocations, lock contention")
+    p.add_argument("--config", default="hc-vitaminder.ini")
+    p.add_argument("--presses", type=int, default=2000, help="single presses timed for the latency numbers")
+    p.add_argument("--burst", type=int, default=20000, help="presses queued at once for the throughput number")
+    p.add_argument("--alloc-events", type=int, default=2000)
+
+    p = sub.add_parser("journal", help="restart (journal replay) time against journal size, append cost")
+    p.add_argument("--records", type=int, nargs="+", default=[1000, 10000, 100000, 1000000])
+    p.add_argument("--snapshot-every", type=int, default=1000)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--appends", type=int, default=2000)
+    p.add_argument("--fsync-batch", type=int, default=32)
+    p.add_argument("--seed", type=int, default=1)
+
+    p = sub.add_parser("analytics", help="adherence reports over a synthetic multi-device, multi-year history")
+    p.add_argument("--events", type=int, default=10000000)
+    p.add_argument("--devices", type=int, default=1000)
+    p.add_argument("--reference-events", type=int, default=500000,
+                   help="events also run through a per-event python loop, to compare speed and check results")
+    p.add_argument("--seed", type=int, default=1)
+
+    p = sub.add_parser("proto", help="bytes on air per state change, protocol v1 against v2 batch frames")
+    p.add_argument("--config", default="hc-vitaminder.ini")
+    p.add_argument("--changes", type=int, default=500)
+    p.add_argument("--baud", type=int, default=9600)
+    p.add_argument("--sys-color", default="0,0,64", help="sys LED color for the split runs")
+
+    p = sub.add_parser("anim", help="LED animation keyframe jitter and link budget against a simulated device")
+    p.add_argument("--config", default="hc-vitaminder.ini")
+    p.add_argument("--duration", type=float, default=5.0, help="seconds per scenario")
+    p.add_argument("--fps", type=int, default=20)
+    p.add_argument("--saturate-interval", type=float, default=0.02,
+                   help="seconds between extra heartbeats in the saturated run")
+
+    p = sub.add_parser("ports", help="serial port discovery: comports() against the cached, incremental scan")
+    p.add_argument("--repeat", type=int, default=200)
+    p.add_argument("--nodes", type=int, default=64, help="fake rfcomm nodes in the scratch dev dir")
+
+    p = sub.add_parser("startup", help="daemon start up to first frame (--profile-startup), per mode")
+    p.add_argument("--config", default="hc-vitaminder.ini")
+    p.add_argument("--runs", type=int, default=10)
+
+    p = sub.add_parser("reconnect", help="link drops against a fake port: time to recover, frames after reconnect")
+    p.add_argument("--config", default="hc-vitaminder.ini")
+    p.add_argument("--modes", nargs="+", default=["threads", "async"], choices=["threads", "async"])
+    p.add_argument("--outages", type=int, default=20)
+    p.add_argument("--outage", type=float, default=0.5, help="seconds the link stays down")
+    p.add_argument("--changes", type=int, default=3, help="state changes while it is down")
+    p.add_argument("--initial", type=float, default=0.05, help="reconnect_initial_sec")
+    p.add_argument("--max", type=float, default=0.5, help="reconnect_max_sec")
+
+    p = sub.add_parser("rules", help="medication schedule lookups: the interval index against scanning every window")
+    p.add_argument("--medications", type=int, nargs="+", default=[1, 4, 16, 64])
+    p.add_argument("--lookups", type=int, default=100000)
+    p.add_argument("--check", type=int, default=5000, help="lookups also done by scanning, to compare speed and results")
+    p.add_argument("--seed", type=int, default=1)
+
+    p = sub.add_parser("replay", help="wire capture of a loopback session, then replaying it as fast as possible")
+    p.add_argument("--config", default="hc-vitaminder.ini")
+    p.add_argument("--trace", default=None, help="replay this trace instead of recording one")
+    p.add_argument("--presses", type=int, default=500)
+    p.add_argument("--press-interval", type=float, default=0.02, help="seconds between presses while recording")
+    p.add_argument("--speeds", type=float, nargs="+", default=[0.0, 1.0], help="0 = as fast as possible")
+
+    p = sub.add_parser("days", help="accelerated time: simulated days per second of the real controller")
+    p.add_argument("--config", default="hc-vitaminder.ini")
+    p.add_argument("--days", type=int, nargs="+", default=[30, 365])
+    p.add_argument("--press", action="append", default=None, metavar='"HH:MM[:SS] ok|snooze"')
+    p.add_argument("--jitter-min", type=float, default=30.0)
+    p.add_argument("--skip-prob", type=float, default=0.1)
+    p.add_argument("--animate", action="store_true", help="also run with the LED patterns on")
+    p.add_argument("--seed", type=int, default=1)
+
+    p = sub.add_parser("api", help="local HTTP/SSE api: idle subscribers' memory, press to every subscriber, "
+                                   "GET /state throughput")
+    p.add_argument("--config", default="hc-vitaminder.ini")
+    p.add_argument("--subscribers", type=int, nargs="+", default=[100, 1000, 5000])
+    p.add_argument("--presses", type=int, default=20, help="POST /ok presses timed per subscriber count")
+    p.add_argument("--batch", type=int, default=500, help="subscribers connecting at once")
+    p.add_argument("--state-clients", type=int, default=8, help="keep-alive connections asking GET /state")
+    p.add_argument("--state-requests", type=int, default=4000)
+    p.add_argument("--timeout", type=float, default=10.0, help="seconds to wait for a transition to reach everyone")
+
+    args = parser.parse_args()
+    results = BENCHMARKS[args.benchmark](args)
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump({"benchmark": args.benchmark, "argv": sys.argv[1:], "results": results}, f, indent=2)
+    if args.compare is not None:
+        compare_results(args.compare, results)
@@ -0,0 +1,348 @@
+import argparse
+import logging
+import os
+import struct
+import threading
+import time
+
+log = logging.getLogger("hc_vitaminder")
+
+# wire capture: every read and write on a device's serial port, timestamped, in one binary file
+#
+# file layout, little endian:
+#   header: magic "VITTRACE", version, 6 bytes padding, wall clock start (epoch seconds)
+#   record: d  seconds since the trace started (time.monotonic)
+#           B  direction, DIR_IN (device -> host) or DIR_OUT
+#           H  byte count, then that many bytes
+#
+# writes go out as whole frames, reads are whatever one read returned.  keeping the reads as
+# they came (not re-cut into frames) is what lets a replay hit the decoder the same way,
+# split frames, line noise and resyncs included.
+
+HEADER = struct.Struct("<8sH6xd")
+RECORD = struct.Struct("<dBH")
+MAGIC = b"VITTRACE"
+VERSION = 1
+
+DIR_IN = 0
+DIR_OUT = 1
+
+
+class VitTraceWriter:
+    # appends records to an in-memory buffer and writes it out in bulk, once buffer_bytes have
+    # piled up or flush_sec after the last write, whichever first.  the reader and the controller
+    # both record, so the buffer has a lock.  a crash loses at most the unflushed part
+    def __init__(self, path, buffer_bytes=65536, flush_sec=1.0, clock=time.monotonic):
+        self.path = path
+        self.buffer_bytes = buffer_bytes
+        self.flush_sec = flush_sec
+        self.clock = clock
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.started = clock()
+        self.lock = threading.Lock()
+        self.buffer = bytearray(HEADER.pack(MAGIC, VERSION, time.time()))
+        self.flushed_at = self.started
+
+        self.records = 0
+        self.bytes = 0
+        self.flushes = 0
+
+    def inbound(self, data):
+        self.add(DIR_IN, data)
+
+    def outbound(self, data):
+        self.add(DIR_OUT, data)
+
+    def add(self, direction, data):
+        now = self.clock()
+        with self.lock:
+            if self.fd is None:
+                return
+            self.buffer += RECORD.pack(now - self.started, direction, len(data))
+            self.buffer += data
+            self.records += 1
+            self.bytes += len(data)
+            if len(self.buffer) >= self.buffer_bytes or now - self.flushed_at >= self.flush_sec:
+                self.flush_locked(now)
+
+    def flush(self):
+        with self.lock:
+            if self.fd is not None:
+                self.flush_locked(self.clock())
+
+    def flush_locked(self, now):
+        if self.buffer:
+            os.write(self.fd, self.buffer)
+            self.buffer.clear()
+            self.flushes += 1
+        self.flushed_at = now
+
+    def close(self):
+        with self.lock:
+            if self.fd is None:
+                return
+            self.flush_locked(self.clock())
+            os.close(self.fd)
+            self.fd = None
+
+    def stats(self):
+        return {
+            "records": self.records,
+            "bytes": self.bytes,
+            "flushes": self.flushes,
+        }
+
+
+def read_trace(path):
+    # (wall clock start, [(seconds, direction, bytes)]), a record cut short at the end is left out
+    with open(path, "rb") as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ValueError("%s is not a vitaminder trace" % path)
+    magic, version, started = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("%s is not a version %d vitaminder trace" % (path, VERSION))
+
+    records = []
+    pos = HEADER.size
+    while pos + RECORD.size <= len(data):
+        ts, direction, n = RECORD.unpack_from(data, pos)
+        pos += RECORD.size
+        if pos + n > len(data):
+            break
+        records.append((ts, direction, data[pos:pos + n]))
+        pos += n
+    return started, records
+
+
+class CaptureSerial:
+    # wraps an open serial.Serial, everything read from it or written to it goes to trace.
+    # the asyncio transport reads the descriptor itself and records through .trace
+    def __init__(self, port, trace):
+        self.port = port
+        self.trace = trace
+
+    def read(self, size=1):
+        data = self.port.read(size)
+        if data:
+            self.trace.inbound(data)
+        return data
+
+    def write(self, data):
+        n = self.port.write(data)
+        self.trace.outbound(data)
+        return n
+
+    @property
+    def timeout(self):
+        return self.port.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.port.timeout = value
+
+    def __getattr__(self, name):
+        # in_waiting, isOpen(), close(), fileno() ... straight to the port
+        return getattr(self.port, name)
+
+
+class ReplaySerial:
+    # stand-in for serial.Serial that plays a trace's inbound records back to the host
+    #
+    # speed 1 keeps the original timing (2 twice as fast ...).  speed 0 goes as fast as the
+    # host keeps up: an inbound record is handed out once the host has written as many frames
+    # as the trace had written before it, so responses don't overtake their requests.  if
+    # the host doesn't write what the trace did (it is a different build after all) the
+    # record goes out after one read timeout anyway.  writes are compared against the trace
+    def __init__(self, records, speed=0.0, timeout=1, clock=time.monotonic):
+        self.speed = speed
+        self.timeout = timeout
+        self.clock = clock
+        self.inbound = []
+        self.outbound = []
+        for ts, direction, data in records:
+            if direction == DIR_IN:
+                # with the outbound count the host has to reach first
+                self.inbound.append((ts, len(self.outbound), data))
+            else:
+                self.outbound.append(data)
+
+        self.cond = threading.Condition()
+        self.next_in = 0
+        self.rx = bytearray()
+        self.written = 0
+        self.is_open = True
+        self.started = None
+        self.done = threading.Event()
+        if not self.inbound:
+            self.done.set()
+
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.mismatched_writes = 0
+        self.forced = 0
+
+    @classmethod
+    def open(cls, path, speed=0.0, timeout=1):
+        return cls(read_trace(path)[1], speed, timeout)
+
+    def due_wait(self, now):
+        # seconds until the next inbound record may go out, 0 = now, None = waiting on a write
+        ts, writes_before, _ = self.inbound[self.next_in]
+        if self.speed > 0:
+            return max(0.0, self.started + ts / self.speed - now)
+        return 0.0 if self.written >= writes_before else None
+
+    def release(self, now, force=False):
+        # caller holds the lock: move every record that is due into rx
+        while self.next_in < len(self.inbound):
+            wait = self.due_wait(now)
+            if wait != 0.0 and not force:
+                return wait
+            if wait != 0.0:
+                self.forced += 1
+            force = False
+            self.rx += self.inbound[self.next_in][2]
+            self.next_in += 1
+        return None
+
+    @property
+    def in_waiting(self):
+        with self.cond:
+            if self.started is not None:
+                self.release(self.clock())
+            return len(self.rx)
+
+    def read(self, size=1):
+        with self.cond:
+            now = self.clock()
+            if self.started is None:
+                self.started = now
+            deadline = None if self.timeout is None else now + self.timeout
+            while self.is_open:
+                wait = self.release(now)
+                if len(self.rx) >= size or (self.rx and self.next_in >= len(self.inbound)):
+                    break
+                if self.next_in >= len(self.inbound):
+                    self.done.set()
+                remaining = None if deadline is None else deadline - now
+                if remaining is not None and remaining <= 0:
+                    if self.speed == 0 and self.next_in < len(self.inbound):
+                        # the host never wrote what the trace says came first, don't stall on it
+                        self.release(now, force=True)
+                    break
+                if wait is not None:
+                    remaining = wait if remaining is None else min(wait, remaining)
+                self.cond.wait(remaining)
+                now = self.clock()
+            data = bytes(self.rx[:size])
+            del self.rx[:size]
+            self.bytes_read += len(data)
+            return data
+
+    def write(self, data):
+        with self.cond:
+            if self.written < len(self.outbound) and self.outbound[self.written] != bytes(data):
+                self.mismatched_writes += 1
+            self.written += 1
+            self.bytes_written += len(data)
+            self.cond.notify_all()
+        return len(data)
+
+    def isOpen(self):
+        return self.is_open
+
+    def close(self):
+        with self.cond:
+            self.is_open = False
+            self.cond.notify_all()
+
+    def stats(self):
+        return {
+            "inbound_records": len(self.inbound),
+            "replayed": self.next_in,
+            "bytes_read": self.bytes_read,
+            "writes": self.written,
+            "trace_writes": len(self.outbound),
+            "mismatched_writes": self.mismatched_writes,
+            "forced": self.forced,
+        }
+
+
+def replay(path, config, speed=0.0, settle_sec=0.2, clock=None):
+    # runs a trace through a fresh Vitaminder (reader and controller threads, no journal),
+    # returns (Vitaminder, ReplaySerial, seconds from first read to the last record handled).
+    # clock: the schedule's clock, like Vitaminder's (the wall clock when None)
+    from hc_vitaminder import Vitaminder, VitEvent, VitMsg
+    from hc_vitaminder_sched import VitScheduler
+
+    v = Vitaminder(config=config) if clock is None else Vitaminder(config=config, clock=clock)
+    port = ReplaySerial.open(path, speed, timeout=v.cfg.comm_read_timeout if speed > 0 else 0.05)
+    v.serial_port = port
+    if speed == 0:
+        # the link's byte budget would hold the host to the line speed, which is the one thing
+        # a fast replay is not about
+        v.link_budget.rate = v.link_budget.burst = v.link_budget.tokens = float("inf")
+    # the clock's first event sends HELLO and the LEDs like the live start did, the request
+    # timers make retries happen like they did live
+    scheduler = VitScheduler() if clock is None else VitScheduler(clock=clock)
+    v.start_clock(scheduler)
+    threads = [threading.Thread(target=v.ctl_thread), threading.Thread(target=v.serial_read_thread),
+               threading.Thread(target=scheduler.run)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    port.done.wait()
+    # let the controller get through what the last reads queued
+    while v.msg_queue.qsize():
+        time.sleep(0.001)
+    elapsed = time.perf_counter() - t0
+    time.sleep(settle_sec)
+
+    v.add_event(VitEvent(VitMsg.EXIT))
+    port.close()
+    scheduler.stop()
+    for t in threads:
+        t.join()
+    return v, port, elapsed
+
+
+def dump(path):
+    started, records = read_trace(path)
+    print("trace started %s, %d records" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(started)), len(records)))
+    for ts, direction, data in records:
+        print("%12.6f %s %s" % (ts, "<-" if direction == DIR_IN else "->", data.hex(" ")))
+
+
+if __name__ == "__main__":
+    import configparser
+
+    parser = argparse.ArgumentParser(description="Vitaminder wire traces (recorded with hc_vitaminder.py --capture)")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("dump", help="print every record")
+    p.add_argument("trace")
+    p = sub.add_parser("replay", help="feed the device side of a trace to the host again")
+    p.add_argument("trace")
+    p.add_argument("--config", default="hc-vitaminder.ini")
+    p.add_argument("--section", default="DEFAULT", help="config section of the device the trace is from")
+    p.add_argument("--speed", type=float, default=0.0, help="1 = original timing, 0 = as fast as possible")
+    p.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+
+    if args.command == "dump":
+        dump(args.trace)
+    else:
+        configuration = configparser.ConfigParser()
+        configuration.read(args.config)
+        section = configuration[args.section]
+        section["journal_dir"] = ""
+        v, port, elapsed = replay(args.trace, section, args.speed)
+        log.info("replayed in %.3f s: %s", elapsed, port.stats())
+        log.info("events: %s", v.metrics.events)
+        log.info("decoder: %s", v.decoder.stats())
@@ -1,21 +1,163 @@
-import serial.tools.list_ports
+from collections import deque
+from time import perf_counter
 
 from PyQt5.QtWidgets import QApplication, QMainWindow, QWidget, QLabel, QVBoxLayout, QHBoxLayout,\
-    QComboBox, QPushButton, QColorDialog, QGridLayout, QFrame
+    QComboBox, QPushButton, QColorDialog, QGridLayout, QFrame, QSpinBox, QCheckBox
 from PyQt5.QtGui import QColor
-from PyQt5.QtCore import Qt
-
-from hc_vitaminder import *
+from PyQt5.QtCore import Qt, QObject, QThread, QTimer, QMetaObject, pyqtSignal, pyqtSlot
+
+from hc_vitaminder import FRAME_TYPES, LedPlan, VitMsg
+from hc_vitaminder_link import VitRequestTracker
+from hc_vitaminder_metrics import Histogram
+from hc_vitaminder_ports import PortDiscovery
+from hc_vitaminder_proto import VitFrameDecoder, PIXEL_COUNT, SYS_PIX, rsp_echo
+
+
+class SerialWorker(QObject):
+    # owns the serial port, lives on its own QThread so the UI never waits on the device.
+    #
+    # everything comes in as queued signals (open/close/send, Qt's event queue is the outbox
+    # and frames sent before the port is open wait in self.outbox), everything goes out as
+    # signals the widgets connect to.  the port is opened non-blocking and polled from a timer
+    # on the worker thread: a blocking read would hold up the queued slots behind it, and a
+    # QSocketNotifier doesn't work on Windows COM ports.
+    connected = pyqtSignal(str)
+    disconnected = pyqtSignal(str)
+    failed = pyqtSignal(str)
+    frame_received = pyqtSignal(object, bytes)
+    # brightness, vit rgb, sys rgb, as the latest response echoed them
+    device_state = pyqtSignal(int, object, object)
+    # request ID, seconds
+    round_trip = pyqtSignal(int, float)
+    timed_out = pyqtSignal(int)
+
+    def __init__(self, poll_ms=5, request_timeout_sec=2.0, max_outbox=64):
+        QObject.__init__(self)
+        self.poll_ms = poll_ms
+        self.serial_port = None
+        self.port_name = None
+        self.poll_timer = None
+        self.outbox = deque(maxlen=max_outbox)
+        self.decoder = VitFrameDecoder(FRAME_TYPES)
+        self.requests = VitRequestTracker(timeout_sec=request_timeout_sec)
+
+    @pyqtSlot()
+    def start(self):
+        # runs on the worker thread once it is up, so the timer belongs to it
+        self.poll_timer = QTimer(self)
+        self.poll_timer.timeout.connect(self.poll)
+
+    @pyqtSlot(str)
+    def open_port(self, port_name):
+        # pyserial is only needed once there is a port to open, the window comes up without it
+        import serial
+
+        self.close_port("reconnecting")
+        try:
+            # timeout=0: read() returns whatever is there, write_timeout keeps a wedged port from hanging us
+            self.serial_port = serial.Serial(port_name, timeout=0, write_timeout=1)
+        except (serial.SerialException, ValueError) as e:
+            self.failed.emit(str(e))
+            return
+        self.port_name = port_name
+        self.decoder = VitFrameDecoder(FRAME_TYPES)
+        self.poll_timer.start(self.poll_ms)
+        self.connected.emit(port_name)
+        self.flush()
+
+    @pyqtSlot()
+    @pyqtSlot(str)
+    def close_port(self, reason="closed"):
+        if self.serial_port is None:
+            return
+        import serial
+
+        self.poll_timer.stop()
+        try:
+            self.serial_port.close()
+        except serial.SerialException:
+            pass
+        self.serial_port = None
+        self.requests.drop_all()
+        self.disconnected.emit(reason)
+
+    @pyqtSlot(bytes)
+    def send(self, frame):
+        self.outbox.append(frame)
+        self.flush()
+
+    def flush(self):
+        if self.serial_port is None:
+            return
+        import serial
+
+        while self.outbox and self.serial_port is not None:
+            frame = self.outbox.popleft()
+            try:
+                self.serial_port.write(frame)
+            except serial.SerialException as e:
+                self.close_port(str(e))
+                return
+            self.requests.sent(frame)
+
+    def poll(self):
+        import serial
+
+        try:
+            waiting = self.serial_port.in_waiting
+            chunk = self.serial_port.read(waiting) if waiting else b""
+        except (serial.SerialException, OSError) as e:
+            self.close_port(str(e))
+            return
+        for msg_type, frame in self.decoder.feed(chunk):
+            self.handle_frame(msg_type, bytes(frame))
+        self.expire_requests()
+
+    def handle_frame(self, msg_type, frame):
+        self.frame_received.emit(msg_type, frame)
+        if msg_type in (VitMsg.SERIAL_STATE_RSP, VitMsg.SERIAL_HEARTBEAT_RSP):
+            req, rtt, matched = self.requests.response(frame)
+            if rtt is not None:
+                self.round_trip.emit(req.kind, rtt)
+            echo = rsp_echo(frame)
+            self.device_state.emit(echo[0], tuple(echo[1:4]), tuple(echo[4:7]))
+
+    def expire_requests(self):
+        now = self.requests.clock()
+        for queue in self.requests.in_flight.values():
+            # oldest first, and they all share one timeout
+            while queue and now - queue[0].sent_at > queue[0].timeout:
+                req = queue[0]
+                self.requests.expire(req)
+                self.timed_out.emit(req.kind)
 
 
 class SerialConnectionWidget(QFrame):
-    def __init__(self, parent=None, serial_port=None):
+    # the port is opened and closed by the SerialWorker, this only asks for it.  the port list
+    # comes from a PortDiscovery, its changes arrive on the discovery thread and are queued
+    # over to the UI thread through ports_changed
+    open_requested = pyqtSignal(str)
+    close_requested = pyqtSignal()
+    # added [ListPortInfo], removed [device name]
+    ports_changed = pyqtSignal(object, object)
+
+    def __init__(self, parent=None, worker=None, discovery=None):
         QFrame.__init__(self, parent)
-        self.serial_port = serial_port
+        self.worker = worker
+        self.discovery = discovery
+        self.is_connected = False
         self.port_combobox = None
         self.connect_button = None
+        self.status_label = None
         self.initUI()
 
+        if worker is not None:
+            self.open_requested.connect(worker.open_port)
+            self.close_requested.connect(worker.close_port)
+            worker.connected.connect(self.on_connected)
+            worker.disconnected.connect(self.on_disconnected)
+            worker.failed.connect(self.on_disconnected)
+
     def initUI(self):
         self.setFrameStyle(QFrame.StyledPanel)
 
@@ -26,7 +168,11 @@ class SerialConnectionWidget(QFrame):
         port_layout.addWidget(QLabel("Port"))
 
         self.port_combobox = QComboBox()
-        self.click_refresh()
+        if self.discovery is not None:
+            self.ports_changed.connect(self.on_ports_changed)
+            self.discovery.add_listener(self.ports_changed.emit)
+            # whatever was found so far, a change the listener reports too is harmless
+            self.on_ports_changed(self.discovery.ports(), [])
         port_layout.addWidget(self.port_combobox)
 
         port_refresh_button = QPushButton("Refresh")
@@ -40,6 +186,8 @@ class SerialConnectionWidget(QFrame):
         self.connect_button = QPushButton("Connect")
         self.connect_button.clicked.connect(self.click_connect)
         connect_layout.addWidget(self.connect_button)
+        self.status_label = QLabel("not connected")
+        connect_layout.addWidget(self.status_label)
         connect_frame.setLayout(connect_layout)
 
         layout.addWidget(port_frame)
@@ -48,21 +196,52 @@ class SerialConnectionWidget(QFrame):
         self.setLayout(layout)
 
     def click_refresh(self):
-        if self.port_combobox is not None:
-            self.port_combobox.clear()
-            for p in serial.tools.list_ports.comports():
+        # the list keeps itself current, this just doesn't wait for the next scan
+        if self.discovery is not None:
+            self.discovery.poke()
+
+    def port_index(self, device):
+        for i in range(self.port_combobox.count()):
+            if self.port_combobox.itemText(i).split(" ")[0] == device:
+                return i
+        return -1
+
+    def on_ports_changed(self, added, removed):
+        # edit the list in place so the selected port stays selected
+        for device in removed:
+            i = self.port_index(device)
+            if i >= 0:
+                self.port_combobox.removeItem(i)
+        for p in added:
+            i = self.port_index(p.device)
+            if i >= 0:
+                self.port_combobox.setItemText(i, str(p))
+            else:
                 self.port_combobox.addItem(str(p))
 
     def click_connect(self):
-        print("clicked connect", self.port_combobox.currentText())
-
-        if self.serial_port is None or not self.serial_port.isOpen():
-            port_name = self.port_combobox.currentText().split(" ")[0]
-
-            print("connecting:", port_name)
-            # self.serial_port = serial.Serial(port_name, timeout=int(self.config["comm_read_timeout"]))
-            self.serial_port = serial.Serial(port_name, timeout=1)
-            print("connection status:", self.serial_port.isOpen())
+        if self.is_connected:
+            self.close_requested.emit()
+            return
+
+        port_name = self.port_combobox.currentText().split(" ")[0]
+        if not port_name:
+            return
+        self.connect_button.setEnabled(False)
+        self.status_label.setText("connecting to %s..." % port_name)
+        self.open_requested.emit(port_name)
+
+    def on_connected(self, port_name):
+        self.is_connected = True
+        self.connect_button.setEnabled(True)
+        self.connect_button.setText("Disconnect")
+        self.status_label.setText("connected: %s" % port_name)
+
+    def on_disconnected(self, reason):
+        self.is_connected = False
+        self.connect_button.setEnabled(True)
+        self.connect_button.setText("Connect")
+        self.status_label.setText(reason)
 
 
 class LEDColorWidget(QFrame):
@@ -121,46 +300,153 @@ class LEDColorWidget(QFrame):
             self.icon.setStyleSheet("background-color: " + c.name())
 
 
-class VitaminderGui():
+class DeviceStateWidget(QFrame):
+    # live view: what the device last said it shows, round trips, and how smooth the UI is running
+    ui_tick_ms = 16
+
+    def __init__(self, parent=None, worker=None):
+        QFrame.__init__(self, parent)
+        self.rtt = Histogram()
+        self.last_rtt = None
+        self.frames_in = 0
+        self.timeouts = 0
+        self.presses = 0
+
+        # UI frame pacing, a tick every ui_tick_ms and the worst gap in the last second
+        self.ticks = 0
+        self.last_tick = perf_counter()
+        self.worst_gap = 0.0
+        self.window_start = self.last_tick
+        self.fps = 0.0
+        self.fps_worst_gap = 0.0
+
+        self.brightness_label = QLabel("-")
+        self.vit_icon = QFrame()
+        self.sys_icon = QFrame()
+        self.rtt_label = QLabel("-")
+        self.traffic_label = QLabel("-")
+        self.fps_label = QLabel("-")
+        self.initUI()
+
+        if worker is not None:
+            worker.device_state.connect(self.on_device_state)
+            worker.round_trip.connect(self.on_round_trip)
+            worker.timed_out.connect(self.on_timeout)
+            worker.frame_received.connect(self.on_frame)
+
+        self.tick_timer = QTimer(self)
+        self.tick_timer.timeout.connect(self.tick)
+        self.tick_timer.start(self.ui_tick_ms)
+
+    def initUI(self):
+        self.setFrameStyle(QFrame.StyledPanel)
+        layout = QGridLayout()
+        for icon in (self.vit_icon, self.sys_icon):
+            icon.setFrameStyle(QFrame.StyledPanel)
+            icon.setMinimumSize(10, 10)
+        rows = [("Device brightness", self.brightness_label), ("Vitaminder LED", self.vit_icon),
+                ("System LED", self.sys_icon), ("Round trip", self.rtt_label), ("Traffic", self.traffic_label),
+                ("UI", self.fps_label)]
+        for row, (title, widget) in enumerate(rows):
+            layout.addWidget(QLabel(title), row, 0)
+            layout.addWidget(widget, row, 1)
+        self.setLayout(layout)
+
+    def on_device_state(self, brightness, vit, sys_):
+        self.brightness_label.setText(str(brightness))
+        self.vit_icon.setStyleSheet("background-color: rgb(%d, %d, %d)" % vit)
+        self.sys_icon.setStyleSheet("background-color: rgb(%d, %d, %d)" % sys_)
+
+    def on_round_trip(self, kind, seconds):
+        self.rtt.observe(seconds)
+        self.last_rtt = seconds
+
+    def on_timeout(self, kind):
+        self.timeouts += 1
+
+    def on_frame(self, msg_type, frame):
+        self.frames_in += 1
+        if msg_type == VitMsg.SERIAL_BUTTON:
+            self.presses += 1
+
+    def tick(self):
+        now = perf_counter()
+        self.worst_gap = max(self.worst_gap, now - self.last_tick)
+        self.last_tick = now
+        self.ticks += 1
+        if now - self.window_start < 1.0:
+            return
+        # once a second: refresh the text, cheaper than doing it on every frame
+        self.fps = self.ticks / (now - self.window_start)
+        self.fps_worst_gap = self.worst_gap
+        self.ticks = 0
+        self.worst_gap = 0.0
+        self.window_start = now
+
+        if self.last_rtt is not None:
+            self.rtt_label.setText("last %.1f ms  p50 %.0f ms  p99 %.0f ms" % (
+                1000.0 * self.last_rtt, 1000.0 * self.rtt.percentile(0.5), 1000.0 * self.rtt.percentile(0.99)))
+        self.traffic_label.setText("%d frames in, %d round trips, %d timeouts, %d presses" % (
+            self.frames_in, self.rtt.count, self.timeouts, self.presses))
+        self.fps_label.setText("%.0f fps, worst frame gap %.0f ms" % (self.fps, 1000.0 * self.fps_worst_gap))
+
+
+class VitaminderGui(QObject):
+    send_frame = pyqtSignal(bytes)
+
+    heartbeat_interval_ms = 1000
+
     def __init__(self):
+        QObject.__init__(self)
         self.main_window = None
         self.led_vit_widget = None
         self.led_sys_widget = None
+        self.brightness_box = None
+        self.state_widget = None
+        self.heartbeat_timer = None
+        self.discovery = PortDiscovery()
+
+        # the port and everything on it lives on io_thread
+        self.io_thread = QThread()
+        self.worker = SerialWorker()
+        self.worker.moveToThread(self.io_thread)
+        self.io_thread.started.connect(self.worker.start)
+        self.send_frame.connect(self.worker.send)
+
+    def start(self):
+        self.discovery.start()
+        self.io_thread.start()
+
+    def stop(self):
+        self.discovery.stop()
+        QMetaObject.invokeMethod(self.worker, "close_port", Qt.BlockingQueuedConnection)
+        self.io_thread.quit()
+        self.io_thread.wait()
+
+    @staticmethod
+    def rgb(widget):
+        return widget.color.red(), widget.color.green(), widget.color.blue()
 
     def send_button_clicked(self):
-        # TODO make sure the serial port is connected
-        print("send button clicked")
-
-        print("brightness:", self.led_brightness)
-        print("vit:")
-        print("\tr:", self.led_vit_widget.color.red())
-        print("\tg:", self.led_vit_widget.color.green())
-        print("\tb:", self.led_vit_widget.color.blue())
-        print("sys:")
-        print("\tr:", self.led_sys_widget.color.red())
-        print("\tg:", self.led_sys_widget.color.green())
-        print("\tb:", self.led_sys_widget.color.blue())
-
-
-        #v = self.led_vit_widget.color.
-
-        self.serial_port.write(
-            bytes([1, self.led_brightness,
-                   self.led_vit_widget.color.red(), self.led_vit_widget.color.green(), self.led_vit_widget.color.blue(),
-                   self.led_sys_widget.color.red(), self.led_sys_widget.color.green(), self.led_sys_widget.color.blue()]))
-        print("done sending")
-
-        # TODO handle failed ack
-        rsp = self.serial_port.read(8)
-        if rsp[0] == 0x01:
-            print("have LED response")
+        # same frames the daemon sends: one set-LED per distinct color, masked to its pixels
+        pixels = [self.rgb(self.led_vit_widget)] * PIXEL_COUNT
+        pixels[SYS_PIX] = self.rgb(self.led_sys_widget)
+        plan = LedPlan(self.brightness_box.value(), pixels, 0, 0)
+        for frame in plan.v1_frames:
+            self.send_frame.emit(frame)
+
+    def heartbeat_toggled(self, on):
+        if on:
+            self.heartbeat_timer.start(self.heartbeat_interval_ms)
         else:
-            print("have unknown response")
+            self.heartbeat_timer.stop()
+
+    def send_heartbeat(self):
+        self.send_frame.emit(bytes([0, 1, 1, 1, 1, 1, 1, 1]))
 
     def create_gui(self):
 
-        # port_frame = SerialConnectionWidget(vitaminder=self)
-        port_frame = SerialConnectionWidget()
+        port_frame = SerialConnectionWidget(worker=self.worker, discovery=self.discovery)
 
         self.led_vit_widget = LEDColorWidget(title="Vitaminder LED", color=QColor("#FF0000"))
         self.led_sys_widget = LEDColorWidget(title="System LED")
@@ -171,15 +457,31 @@ class VitaminderGui():
         led_layout.addWidget(self.led_sys_widget)
         led_frame.setLayout(led_layout)
 
+        send_frame = QWidget()
+        send_layout = QHBoxLayout()
+        send_layout.addWidget(QLabel("Brightness"))
+        self.brightness_box = QSpinBox()
+        self.brightness_box.setRange(0, 255)
+        self.brightness_box.setValue(128)
+        send_layout.addWidget(self.brightness_box)
         send_button = QPushButton("Send LED Message")
         send_button.clicked.connect(self.send_button_clicked)
+        send_layout.addWidget(send_button)
+        heartbeat_box = QCheckBox("Heartbeat")
+        self.heartbeat_timer = QTimer()
+        self.heartbeat_timer.timeout.connect(self.send_heartbeat)
+        heartbeat_box.toggled.connect(self.heartbeat_toggled)
+        send_layout.addWidget(heartbeat_box)
+        send_frame.setLayout(send_layout)
 
+        self.state_widget = DeviceStateWidget(worker=self.worker)
 
         central_frame = QWidget()
         central_layout = QVBoxLayout()
         central_layout.addWidget(port_frame)
         central_layout.addWidget(led_frame)
-        central_layout.addWidget(send_button)
+        central_layout.addWidget(send_frame)
+        central_layout.addWidget(self.state_widget)
         central_frame.setLayout(central_layout)
 
         self.main_window = QMainWindow()
@@ -192,6 +494,9 @@ if __name__ == "__main__":
     app = QApplication([])
 
     gui = VitaminderGui()
+    gui.start()
     gui.create_gui()
 
-    app.exit(app.exec_())
+    status = app.exec_()
+    gui.stop()
+    app.exit(status)
@@ -0,0 +1,134 @@
+import asyncio
+import errno
+import logging
+import os
+
+from hc_vitaminder import Vitaminder, VitConfig, VitEvent, VitMsg
+from hc_vitaminder_metrics import registry, scheduler_collector
+from hc_vitaminder_ports import PortDiscovery
+from hc_vitaminder_sched import VitScheduler
+
+log = logging.getLogger("hc_vitaminder")
+
+
+class VitaminderHub:
+    # drives every device listed in a multi-device config from one process
+    #
+    # each section of the config file is one device, values not given in a section fall
+    # back to [DEFAULT].  every device keeps its own Vitaminder (state, snooze expiry and
+    # schedule) but they all share one event loop and one scheduler (boundaries and heartbeats).
+    #
+    # sections: only drive these devices (a shard worker, see hc_vitaminder_shard.py), may be empty
+    def __init__(self, configuration, sections=None):
+        self.configuration = configuration
+        self.partial = sections is not None
+        self.sections = list(sections) if self.partial else configuration.sections()
+        self.devices = [Vitaminder(config=configuration[section]) for section in self.sections]
+        if len(self.devices) == 0 and not self.partial:
+            raise ValueError("hub mode needs at least one [device] section in the config file")
+        self.device_tasks = []
+
+        self.scheduler = VitScheduler()
+        registry.add_collector(scheduler_collector(self.scheduler, "hub"))
+        self.alive = True
+        self.alive_event = None
+
+        # rfcomm ports disappear when the bluetooth link drops and come back when it returns,
+        # port discovery tells us so the device can be reopened (port_scan_sec = 0 turns it off)
+        self.port_scan_sec = self.configuration["DEFAULT"].getfloat("port_scan_sec", fallback=2.0)
+        self.discovery = None
+
+        self.config_watch_sec = self.configuration["DEFAULT"].getfloat("config_watch_sec", fallback=2.0)
+
+    def connect(self):
+        for v in self.devices:
+            if v.serial_port is None:
+                v.connect()
+
+    def disconnect(self):
+        for v in self.devices:
+            v.disconnect()
+
+    def stop(self):
+        for v in self.devices:
+            v.add_event(VitEvent(VitMsg.EXIT))
+        self.alive = False
+        self.scheduler.stop()
+        if self.discovery is not None:
+            self.discovery.stop()
+        if self.alive_event is not None:
+            self.alive_event.set()
+
+    def reload(self, configuration):
+        # config watcher thread: every device's section is compiled and checked before any of
+        # them is swapped in, one bad section keeps the whole hub on the running config
+        devices = {v.name: v for v in self.devices}
+        sections = set(configuration.sections())
+        if not set(devices) <= sections or (not self.partial and sections != set(devices)):
+            log.warning("hub: devices added or removed in the config take effect on the next restart")
+        try:
+            compiled = [(devices[section], VitConfig(configuration[section]))
+                        for section in configuration.sections() if section in devices]
+        except (KeyError, ValueError) as e:
+            log.warning("hub: config not reloaded, keeping the running one: %s", e)
+            return False
+        self.configuration = configuration
+        for v, cfg in compiled:
+            v.add_event(VitEvent(VitMsg.RELOAD, cfg))
+        return True
+
+    def add_devices(self, sections):
+        # on the loop, while run_async() runs: more devices for this hub (a shard taking over a
+        # dead worker's ones).  their journals bring back the state the old process last recorded
+        added = []
+        for section in sections:
+            v = Vitaminder(config=self.configuration[section])
+            self.sections.append(section)
+            self.devices.append(v)
+            v.connect()
+            added.append(v)
+        self.device_tasks.append(asyncio.ensure_future(self.start_devices(added)))
+        return added
+
+    async def start_devices(self, devices):
+        tasks = [asyncio.ensure_future(v.run_async(timers=False)) for v in devices]
+        # same as run_async(): the queues first, then the clock
+        await asyncio.sleep(0)
+        for v in devices:
+            v.start_clock(self.scheduler)
+        await asyncio.gather(*tasks)
+
+    def watch_ports(self, discovery):
+        loop = asyncio.get_running_loop()
+        self.discovery = discovery
+        discovery.add_listener(lambda added, removed: loop.call_soon_threadsafe(self.ports_changed, added, removed))
+
+    def ports_changed(self, added, removed):
+        # runs on the loop.  a port replaced between two scans shows up in both lists, removed goes first.
+        # the device's own reconnect backoff would get there too, this just doesn't wait for it
+        added = set(p.device for p in added)
+        for v in self.devices:
+            names = (v.cfg.comm_port, os.path.realpath(v.cfg.comm_port))
+            if any(name in removed for name in names):
+                v.link_lost(OSError(errno.ENODEV, "%s went away" % v.cfg.comm_port), v.serial_port)
+            if not v.supervisor.up and any(name in added for name in names):
+                v.reopen_port()
+
+    async def run_async(self):
+        self.alive_event = asyncio.Event()
+
+        self.device_tasks = [asyncio.ensure_future(v.run_async(timers=False))
+                             for v in self.devices]
+        # let every device set up its queue before the shared timers start feeding them
+        await asyncio.sleep(0)
+
+        self.scheduler.attach_loop(asyncio.get_running_loop())
+        for v in self.devices:
+            v.start_clock(self.scheduler)
+        if self.port_scan_sec > 0 and self.discovery is None:
+            self.watch_ports(PortDiscovery(interval=self.port_scan_sec).start())
+
+        # waiting for stop() too keeps a shard worker that starts out with no devices running
+        await asyncio.gather(self.alive_event.wait(), *self.device_tasks)
+        # devices added while running
+        await asyncio.gather(*self.device_tasks)
@@ -0,0 +1,282 @@
+import mmap
+import os
+import struct
+import threading
+import time
+
+# append-only state journal, one file per device
+#
+# file layout: a 24 byte header, then fixed size 24 byte records, little endian
+#   header: magic "VITJ", version, record size, creation time (epoch seconds), padding
+#   record: d  wall clock time of the event (epoch seconds)
+#           I  current_date as date.toordinal()
+#           B  kind (see below)
+#           B  state after the event (VitState.value)
+#           B  detail: previous state for transitions, button flags for presses
+#           B  reserved, always 0
+#           d  snooze expiration (epoch seconds), 0 when not snoozing
+#
+# every record carries the complete runtime state, so recovering only needs the newest
+# good record.  snapshots are written every snapshot_every records anyway: replay walks
+# back to the newest one and folds forward from there, which keeps restart time flat no
+# matter how long the history is, and gives the analytics a known state to start from
+# at the top of every file.
+#
+# the fsyncs run on the journal's own sync thread, never on the controller: in --async and
+# --hub modes the controller is the one event loop every device shares, and an SD card can
+# take a second over an fsync.  the controller only appends and hands the thread a dup() of
+# the file descriptor to sync, so a rotation closing the file underneath it is harmless.
+
+HEADER = struct.Struct("<4sHHI12x")
+RECORD = struct.Struct("<dIBBBBd")
+MAGIC = b"VITJ"
+VERSION = 1
+
+REC_SNAPSHOT = 1
+REC_TRANSITION = 2
+REC_BUTTON = 3
+
+# detail bits for REC_BUTTON
+BUTTON_OK = 0x01
+BUTTON_SNOOZE = 0x02
+
+# offset of the kind byte inside a record
+KIND_OFFSET = 12
+
+
+class JournalRecord:
+    __slots__ = ("ts", "day", "kind", "state", "detail", "snooze")
+
+    def __init__(self, ts, day, kind, state, detail, reserved, snooze):
+        self.ts = ts
+        self.day = day
+        self.kind = kind
+        self.state = state
+        self.detail = detail
+        self.snooze = snooze
+
+
+def record_count(size):
+    return max(0, size - HEADER.size) // RECORD.size
+
+
+class VitJournal:
+    def __init__(self, path, fsync_sec=1.0, fsync_batch=32, snapshot_every=1000, max_records=100000):
+        self.path = path
+        self.fsync_sec = fsync_sec
+        self.fsync_batch = fsync_batch
+        self.snapshot_every = snapshot_every
+        self.max_records = max_records
+
+        # set by the owner once timers are available, fsync batches then also flush on a timer
+        self.scheduler = None
+        self.sync_timer = None
+
+        self.lock = threading.Lock()
+        self.fd = None
+        # the sync thread's work: the file's generation -> a dup() of its descriptor
+        self.to_sync = {}
+        self.generation = 0
+        self.wake = threading.Condition(self.lock)
+        self.sync_thread = None
+        self.closing = False
+        self.records = 0
+        self.since_snapshot = 0
+        self.unsynced = 0
+        self.last = None
+
+        self.appended = 0
+        self.fsyncs = 0
+        self.rotations = 0
+        self.replayed = 0
+        self.replay_sec = 0.0
+        self.torn_bytes = 0
+
+    def open(self):
+        # replays whatever is on disk and gets the file ready for appending.
+        # returns the newest record (a JournalRecord) or None for a fresh journal
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        t0 = time.perf_counter()
+        self.last = self.replay()
+        self.replay_sec = time.perf_counter() - t0
+
+        with self.lock:
+            if self.records == 0:
+                self.create()
+            else:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND)
+                self.generation += 1
+        self.sync_thread = threading.Thread(target=self.sync_loop, name="journal-sync", daemon=True)
+        self.sync_thread.start()
+        return self.last
+
+    def replay(self):
+        try:
+            size = os.path.getsize(self.path)
+        except FileNotFoundError:
+            return None
+        if size < HEADER.size:
+            return None
+
+        with open(self.path, "rb") as f:
+            header = f.read(HEADER.size)
+            magic, version, rec_size, _ = HEADER.unpack(header)
+            if magic != MAGIC or version != VERSION or rec_size != RECORD.size:
+                raise ValueError("%s is not a version %d vitaminder journal" % (self.path, VERSION))
+
+            n = record_count(size)
+            whole = HEADER.size + n * RECORD.size
+            if whole != size:
+                # a write that never finished, the partial record goes
+                self.torn_bytes = size - whole
+                os.truncate(self.path, whole)
+            if n == 0:
+                return None
+
+            with mmap.mmap(f.fileno(), whole, access=mmap.ACCESS_READ) as mm:
+                # newest snapshot first, at most snapshot_every records back
+                i = n - 1
+                while i > 0 and mm[HEADER.size + i * RECORD.size + KIND_OFFSET] != REC_SNAPSHOT:
+                    i -= 1
+
+                last = None
+                since_snapshot = 0
+                for rec in RECORD.iter_unpack(mm[HEADER.size + i * RECORD.size:whole]):
+                    if rec[2] == REC_SNAPSHOT:
+                        since_snapshot = 0
+                    elif rec[2] in (REC_TRANSITION, REC_BUTTON):
+                        since_snapshot += 1
+                    else:
+                        continue
+                    last = rec
+                    self.replayed += 1
+
+        self.records = n
+        self.since_snapshot = since_snapshot
+        return JournalRecord(*last) if last is not None else None
+
+    def create(self):
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_TRUNC, 0o644)
+        self.generation += 1
+        os.write(self.fd, HEADER.pack(MAGIC, VERSION, RECORD.size, int(time.time())))
+        self.unsynced += 1
+        self.records = 0
+        self.since_snapshot = 0
+        if self.last is not None:
+            self.write_record(REC_SNAPSHOT, self.last.state, 0, self.last.day, self.last.snooze, self.last.ts)
+        self.sync_locked()
+
+    def append(self, kind, state, detail, day, snooze, ts=None):
+        with self.lock:
+            if self.fd is None:
+                return
+            self.write_record(kind, state, detail, day, snooze, time.time() if ts is None else ts)
+            if kind != REC_SNAPSHOT:
+                self.since_snapshot += 1
+                if self.since_snapshot >= self.snapshot_every:
+                    last = self.last
+                    self.write_record(REC_SNAPSHOT, last.state, 0, last.day, last.snooze, last.ts)
+            if self.records >= self.max_records:
+                self.rotate_locked()
+            elif self.unsynced >= self.fsync_batch:
+                self.sync_locked()
+            elif self.sync_timer is None and self.scheduler is not None:
+                self.sync_timer = self.scheduler.call_later(self.fsync_sec, self.sync)
+
+    def write_record(self, kind, state, detail, day, snooze, ts):
+        os.write(self.fd, RECORD.pack(ts, day, kind, state, detail, 0, snooze))
+        self.last = JournalRecord(ts, day, kind, state, detail, 0, snooze)
+        self.records += 1
+        self.unsynced += 1
+        self.appended += 1
+        if kind == REC_SNAPSHOT:
+            self.since_snapshot = 0
+
+    def sync(self):
+        with self.lock:
+            self.sync_locked()
+
+    def sync_locked(self):
+        # hands what was written so far to the sync thread, returns straight away
+        if self.sync_timer is not None:
+            self.sync_timer.cancel()
+            self.sync_timer = None
+        if self.fd is not None and self.unsynced:
+            if self.generation not in self.to_sync:
+                self.to_sync[self.generation] = os.dup(self.fd)
+                self.wake.notify()
+            self.unsynced = 0
+
+    def sync_loop(self):
+        while True:
+            with self.lock:
+                while not self.to_sync and not self.closing:
+                    self.wake.wait()
+                if not self.to_sync:
+                    return
+                fds = [self.to_sync.pop(generation) for generation in sorted(self.to_sync)]
+            for fd in fds:
+                try:
+                    os.fsync(fd)
+                    self.fsyncs += 1
+                finally:
+                    os.close(fd)
+
+    def rotate_locked(self):
+        # compaction: the full file becomes an archive (kept for the analytics) and the new
+        # active file starts out as one snapshot, so the next restart has nothing to replay
+        self.sync_locked()
+        os.close(self.fd)
+        os.replace(self.path, archive_name(self.path))
+        self.rotations += 1
+        self.create()
+
+    def close(self):
+        # waits for the last fsync, the daemon is on its way out anyway
+        with self.lock:
+            self.sync_locked()
+            if self.fd is not None:
+                os.close(self.fd)
+                self.fd = None
+            self.closing = True
+            self.wake.notify()
+        if self.sync_thread is not None:
+            self.sync_thread.join()
+            self.sync_thread = None
+
+    def stats(self):
+        return {
+            "records": self.records,
+            "appended": self.appended,
+            "fsyncs": self.fsyncs,
+            "rotations": self.rotations,
+            "replayed": self.replayed,
+            "replay_ms": 1000.0 * self.replay_sec,
+            "torn_bytes": self.torn_bytes,
+        }
+
+
+def archive_name(path):
+    # <journal>.<UTC timestamp>, sorts in time order next to the active file.  a second
+    # archive within the same second gets -0002, -0003 ... (padded so -0010 sorts after -0002)
+    stamp = time.strftime("%Y%m%dT%H%M%S", time.gmtime())
+    name = "%s.%s" % (path, stamp)
+    n = 1
+    while os.path.exists(name):
+        n += 1
+        name = "%s.%s-%04d" % (path, stamp, n)
+    return name
+
+
+def journal_files(path):
+    # archives oldest first, then the active file, everything that holds history for a device
+    directory = os.path.dirname(path) or "."
+    base = os.path.basename(path)
+    archives = sorted(f for f in os.listdir(directory) if f.startswith(base + "."))
+    files = [os.path.join(directory, f) for f in archives]
+    if os.path.exists(path):
+        files.append(path)
+    return files
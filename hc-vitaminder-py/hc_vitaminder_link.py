@@ -0,0 +1,180 @@
+import time
+from collections import deque
+
+from hc_vitaminder_proto import MSG_REQ_HEARTBEAT, MSG_REQ_SET_LED, MSG_RSP_HEARTBEAT, MSG_RSP_SET_LED, \
+    MSG_REQ_HELLO, MSG_RSP_HELLO, MSG_REQ_SET_PIXELS, MSG_RSP_SET_PIXELS, MSG_REQ_HEARTBEAT_V2, \
+    MSG_RSP_HEARTBEAT_V2, SEQUENCED, led_echo_matches
+from hc_vitaminder_metrics import Histogram
+
+# which response answers which request
+RESPONSE_FOR = {
+    MSG_RSP_HEARTBEAT: MSG_REQ_HEARTBEAT,
+    MSG_RSP_SET_LED: MSG_REQ_SET_LED,
+    MSG_RSP_HELLO: MSG_REQ_HELLO,
+    MSG_RSP_SET_PIXELS: MSG_REQ_SET_PIXELS,
+    MSG_RSP_HEARTBEAT_V2: MSG_REQ_HEARTBEAT_V2,
+}
+
+# requests whose response echoes the pixels
+LED_REQUESTS = frozenset([MSG_REQ_SET_LED, MSG_REQ_SET_PIXELS])
+
+
+class VitRequest:
+    def __init__(self, frame, sent_at, timeout, attempt):
+        self.frame = frame
+        self.kind = frame[0]
+        self.sent_at = sent_at
+        self.timeout = timeout
+        self.attempt = attempt
+        self.timer = None
+        self.done = False
+
+
+class VitRequestTracker:
+    # in-flight table for the requests we send (heartbeat, set-LED, their v2 versions, HELLO)
+    #
+    # protocol v1 frames carry no sequence number, but the firmware answers strictly in
+    # order, so requests are kept in one FIFO per kind.  set-LED responses echo what the
+    # device now shows, which lets us match them to the request they answer and notice
+    # when an earlier response went missing.  v2 responses name their request by sequence
+    # number, the echo then only tells whether the device shows what we asked for.
+    def __init__(self, timeout_sec=2.0, max_retries=3, backoff=2.0, clock=time.monotonic):
+        self.timeout_sec = timeout_sec
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.clock = clock
+
+        self.in_flight = {kind: deque() for kind in RESPONSE_FOR.values()}
+        self.latency = {kind: Histogram() for kind in RESPONSE_FOR.values()}
+
+        self.sent_count = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.lost_responses = 0
+        self.mismatches = 0
+        self.unsolicited = 0
+        self.gave_up = 0
+
+    def sent(self, frame, attempt=0):
+        # returns the request to put a deadline on, None for frames nobody answers
+        queue = self.in_flight.get(frame[0])
+        if queue is None:
+            return None
+        req = VitRequest(frame, self.clock(), self.timeout_sec * (self.backoff ** attempt), attempt)
+        queue.append(req)
+        self.sent_count += 1
+        if attempt:
+            self.retries += 1
+        return req
+
+    def finish(self, req):
+        req.done = True
+        if req.timer is not None:
+            req.timer.cancel()
+            req.timer = None
+
+    def drop_all(self):
+        # the link went down, nothing in flight is ever getting its answer
+        dropped = 0
+        for queue in self.in_flight.values():
+            while queue:
+                self.finish(queue.popleft())
+                dropped += 1
+        return dropped
+
+    def response(self, rsp):
+        # match a response frame to its request.
+        # returns (request or None, round trip seconds or None, echo matched)
+        queue = self.in_flight.get(RESPONSE_FOR.get(rsp[0]))
+        if not queue:
+            self.unsolicited += 1
+            return None, None, False
+
+        kind = queue[0].kind
+        if kind in SEQUENCED:
+            return self.sequenced_response(queue, rsp)
+
+        match = 0
+        if kind == MSG_REQ_SET_LED:
+            for i, req in enumerate(queue):
+                if led_echo_matches(req.frame, rsp):
+                    match = i
+                    break
+            else:
+                match = None
+
+        if match is None:
+            # device echoes something we never asked for, blame the oldest request
+            req = queue.popleft()
+            self.mismatches += 1
+            matched = False
+        else:
+            # anything queued ahead of the match lost its response on the way back
+            for _ in range(match):
+                self.finish(queue.popleft())
+                self.lost_responses += 1
+            req = queue.popleft()
+            matched = True
+
+        self.finish(req)
+        rtt = self.clock() - req.sent_at
+        self.latency[req.kind].observe(rtt)
+        return req, rtt, matched
+
+    def sequenced_response(self, queue, rsp):
+        for match, req in enumerate(queue):
+            if req.frame[1] == rsp[1]:
+                break
+        else:
+            # answer to a request we already gave up on (and resent under a new number)
+            self.unsolicited += 1
+            return None, None, False
+
+        for _ in range(match):
+            self.finish(queue.popleft())
+            self.lost_responses += 1
+        queue.popleft()
+        matched = True
+        if req.kind in LED_REQUESTS and not led_echo_matches(req.frame, rsp):
+            self.mismatches += 1
+            matched = False
+
+        self.finish(req)
+        rtt = self.clock() - req.sent_at
+        self.latency[req.kind].observe(rtt)
+        return req, rtt, matched
+
+    def expire(self, req):
+        # deadline hit, True when the request was still waiting (and is now dropped)
+        if req.done:
+            return False
+        queue = self.in_flight[req.kind]
+        try:
+            queue.remove(req)
+        except ValueError:
+            return False
+        self.finish(req)
+        self.timeouts += 1
+        return True
+
+    def should_retry(self, req):
+        if req.attempt < self.max_retries:
+            return True
+        self.gave_up += 1
+        return False
+
+    def stats(self):
+        return {
+            "sent": self.sent_count,
+            "in_flight": sum(len(q) for q in self.in_flight.values()),
+            "retries": self.retries,
+            "timeouts": self.timeouts,
+            "lost_responses": self.lost_responses,
+            "mismatches": self.mismatches,
+            "unsolicited": self.unsolicited,
+            "gave_up": self.gave_up,
+            "heartbeat_rtt": self.latency[MSG_REQ_HEARTBEAT].stats(),
+            "set_led_rtt": self.latency[MSG_REQ_SET_LED].stats(),
+            "heartbeat_v2_rtt": self.latency[MSG_REQ_HEARTBEAT_V2].stats(),
+            "set_pixels_rtt": self.latency[MSG_REQ_SET_PIXELS].stats(),
+        }
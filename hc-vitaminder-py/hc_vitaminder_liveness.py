@@ -0,0 +1,90 @@
+from hc_vitaminder_metrics import Histogram
+
+# seconds between two answers from the device, from animation keyframes to a quiet night
+QUIET_BOUNDS = (0.1, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 180.0, 240.0, 270.0, 300.0, 600.0)
+
+
+def retry_span(timeout_sec, max_retries, backoff):
+    # how long a request can take to get through, counting every retry's wait
+    return sum(timeout_sec * backoff ** attempt for attempt in range(max_retries + 1))
+
+
+class VitLiveness:
+    # tracks when the device last heard from us, and when it has to hear from us next
+    #
+    # the firmware turns its sys LED red after solitude_sec without a request from us. any
+    # request it answered resets that timer, not just a heartbeat: set-LED frames and
+    # animation keyframes count too.  so a heartbeat is only needed once the link has been
+    # quiet for quiet_sec.  quiet_sec is solitude_sec minus the margin (the time a heartbeat
+    # and all its retries can take, plus margin_sec to spare), and never more than
+    # max_quiet_sec, the old fixed period.  all times are the controller's clock
+    def __init__(self, solitude_sec, margin_sec, max_quiet_sec, baud, clock):
+        self.clock = clock
+        self.configure(solitude_sec, margin_sec, max_quiet_sec, baud)
+        self.started = clock()
+        self.last_contact = None
+
+        self.contacts = 0
+        self.heartbeats_sent = 0
+        self.heartbeats_skipped = 0
+        self.round_trip_bytes = 16
+        self.quiet = Histogram(QUIET_BOUNDS)
+
+    def configure(self, solitude_sec, margin_sec, max_quiet_sec, baud):
+        self.solitude_sec = solitude_sec
+        self.margin_sec = margin_sec
+        self.max_quiet_sec = max_quiet_sec
+        self.quiet_sec = min(max_quiet_sec, solitude_sec - margin_sec)
+        self.baud = baud
+
+    def contact(self, when):
+        # the device answered a request we sent at when (now minus the round trip)
+        if self.last_contact is not None:
+            if when <= self.last_contact:
+                return
+            self.quiet.observe(when - self.last_contact)
+        self.last_contact = when
+        self.contacts += 1
+
+    def due(self, now):
+        return self.last_contact is None or now >= self.last_contact + self.quiet_sec
+
+    def next_heartbeat(self, now):
+        # when to look again, a heartbeat goes out then unless something got answered meanwhile
+        if self.last_contact is None:
+            return now + self.quiet_sec
+        return max(now, self.last_contact + self.quiet_sec)
+
+    def heartbeat_sent(self, round_trip_bytes):
+        self.heartbeats_sent += 1
+        self.round_trip_bytes = round_trip_bytes
+
+    def heartbeat_skipped(self):
+        self.heartbeats_skipped += 1
+
+    def stats(self):
+        now = self.clock()
+        elapsed = now - self.started
+        # what the old fixed schedule (one every max_quiet_sec) would have sent by now, and what
+        # quiet_sec heartbeats alone would have: the difference to the latter is the heartbeats
+        # other answers stood in for.  a quiet link pays for the safety margin with more
+        # heartbeats than the fixed schedule (one every quiet_sec instead of max_quiet_sec), so
+        # saved only counts fewer than it and extra counts the ones on top
+        fixed = int(elapsed // self.max_quiet_sec) + 1
+        saved = max(0, fixed - self.heartbeats_sent)
+        return {
+            "quiet_sec": self.quiet_sec,
+            "since_contact": None if self.last_contact is None else now - self.last_contact,
+            "longest_quiet": self.quiet.max,
+            "contacts": self.contacts,
+            "heartbeats_sent": self.heartbeats_sent,
+            "heartbeats_skipped": self.heartbeats_skipped,
+            "piggybacked": max(0, int(elapsed // self.quiet_sec) + 1 - self.heartbeats_sent),
+            "fixed_heartbeats": fixed,
+            "heartbeats_saved": saved,
+            "heartbeats_extra": max(0, self.heartbeats_sent - fixed),
+            "bytes_saved": saved * self.round_trip_bytes,
+            # 8N1, both directions share the one bluetooth serial link
+            "airtime_saved_sec": saved * self.round_trip_bytes * 10.0 / self.baud,
+            "quiet_gaps": self.quiet.stats(),
+        }
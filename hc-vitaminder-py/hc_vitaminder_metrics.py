@@ -0,0 +1,338 @@
+import bisect
+import threading
+import time
+import weakref
+
+
+class Histogram:
+    # fixed buckets (seconds), cheap enough to observe on every response
+    default_bounds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, bounds=default_bounds):
+        self.bounds = tuple(bounds)
+        # the last bucket is everything above the largest bound
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, q):
+        # upper bound of the bucket holding the q-th observation, good enough for dashboards
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return self.max
+
+    def stats(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.percentile(0.5),
+            "p99": self.percentile(0.99),
+            "max": self.max,
+        }
+
+
+# event handlers run in microseconds, the request buckets above would put them all in the first one
+HANDLER_BOUNDS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.01, 0.1)
+
+
+class VitMetrics:
+    # per-device counters, updated by the controller itself
+    #
+    # plain ints and dicts on purpose: every update happens on the device's own controller
+    # (thread or task), the exporter only ever reads them, and a scrape that is one event
+    # behind is fine.  no locks on the hot path.  a new event type gets its handler histogram
+    # before its count, so a scrape going by the histograms never looks up a missing one
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self.events = {}
+        self.handler_seconds = {}
+        self.transitions = {}
+        self.serial_bytes_in = 0
+        self.serial_bytes_out = 0
+        self.serial_frames_out = 0
+        self.last_heartbeat_rsp = None
+
+    def event_handled(self, event_name, seconds):
+        hist = self.handler_seconds.get(event_name)
+        if hist is None:
+            hist = self.handler_seconds[event_name] = Histogram(HANDLER_BOUNDS)
+        hist.observe(seconds)
+        self.events[event_name] = self.events.get(event_name, 0) + 1
+
+    def transition(self, old_state, new_state):
+        key = (old_state.name, new_state.name)
+        self.transitions[key] = self.transitions.get(key, 0) + 1
+
+    def bytes_in(self, n):
+        self.serial_bytes_in += n
+
+    def frame_out(self, n):
+        self.serial_frames_out += 1
+        self.serial_bytes_out += n
+
+    def heartbeat_response(self):
+        self.last_heartbeat_rsp = self.clock()
+
+    def since_heartbeat(self):
+        if self.last_heartbeat_rsp is None:
+            return None
+        return self.clock() - self.last_heartbeat_rsp
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace("\"", "\\\"")
+
+
+def labels_text(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join("%s=\"%s\"" % (k, escape_label(v)) for k, v in labels) + "}"
+
+
+class MetricsText:
+    # collects samples per metric family so HELP/TYPE are written once, whatever the device count
+    def __init__(self):
+        self.families = {}
+        self.order = []
+
+    def family(self, name, kind, help_text):
+        fam = self.families.get(name)
+        if fam is None:
+            fam = self.families[name] = (kind, help_text, [])
+            self.order.append(name)
+        return fam[2]
+
+    def add(self, name, kind, help_text, labels, value):
+        if value is None:
+            return
+        self.family(name, kind, help_text).append("%s%s %s" % (name, labels_text(labels), format_value(value)))
+
+    def add_histogram(self, name, help_text, labels, hist):
+        lines = self.family(name, "histogram", help_text)
+        cumulative = 0
+        for bound, count in zip(hist.bounds, hist.counts):
+            cumulative += count
+            lines.append("%s_bucket%s %d" % (name, labels_text(labels + [("le", format_value(bound))]), cumulative))
+        lines.append("%s_bucket%s %d" % (name, labels_text(labels + [("le", "+Inf")]), hist.count))
+        lines.append("%s_sum%s %s" % (name, labels_text(labels), format_value(hist.sum)))
+        lines.append("%s_count%s %d" % (name, labels_text(labels), hist.count))
+
+    def render(self):
+        out = []
+        for name in self.order:
+            kind, help_text, lines = self.families[name]
+            out.append("# HELP %s %s" % (name, help_text))
+            out.append("# TYPE %s %s" % (name, kind))
+            out.extend(lines)
+        return "\n".join(out) + "\n"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
+
+
+class MetricsRegistry:
+    # the devices to report on, held weakly so a dropped Vitaminder just disappears from the output
+    def __init__(self):
+        self.devices = weakref.WeakSet()
+        self.collectors = []
+
+    def add_device(self, v):
+        self.devices.add(v)
+
+    def add_collector(self, collector):
+        # collector(MetricsText) for anything that isn't a device (scheduler, hub, ...)
+        self.collectors.append(collector)
+
+    def render(self):
+        text = MetricsText()
+        for v in sorted(self.devices, key=lambda d: d.name):
+            collect_device(text, v)
+        for collector in self.collectors:
+            collector(text)
+        return text.render()
+
+
+def collect_device(text, v):
+    m = v.metrics
+    dev = [("device", v.name)]
+
+    # by the histograms, see VitMetrics for the order the controller adds them in
+    for event_name in sorted(m.handler_seconds):
+        labels = dev + [("type", event_name)]
+        text.add("vitaminder_events_total", "counter", "Events handled by the controller, by VitMsg type.",
+                 labels, m.events.get(event_name, 0))
+        text.add_histogram("vitaminder_handler_seconds", "Time spent handling one event, by VitMsg type.",
+                           labels, m.handler_seconds[event_name])
+
+    text.add("vitaminder_queue_depth", "gauge", "Events waiting for the controller.", dev, v.msg_queue.qsize())
+    queue = v.msg_queue
+    text.add("vitaminder_queue_high_water", "gauge", "Most events ever waiting at once.", dev, queue.high_water)
+    text.add("vitaminder_queue_coalesced_total", "counter", "Events merged into one already waiting.", dev,
+             queue.coalesced)
+    text.add("vitaminder_queue_blocked_puts_total", "counter", "Times a producer waited for room in the queue.",
+             dev, queue.blocked_puts)
+    text.add("vitaminder_queue_over_bound_total", "counter",
+             "Events let in while the queue was full (timers, EXIT, the controller's own).", dev, queue.over_bound)
+    text.add("vitaminder_state", "gauge", "Current reminder state (1 for the active one).",
+             dev + [("state", v.state.name)], 1)
+    for (old, new) in sorted(m.transitions):
+        text.add("vitaminder_state_transitions_total", "counter", "Reminder state changes.",
+                 dev + [("from", old), ("to", new)], m.transitions[(old, new)])
+
+    text.add("vitaminder_serial_bytes_in_total", "counter", "Bytes read from the device.", dev, m.serial_bytes_in)
+    text.add("vitaminder_serial_bytes_out_total", "counter", "Bytes written to the device.", dev, m.serial_bytes_out)
+    text.add("vitaminder_serial_frames_out_total", "counter", "Frames written to the device.", dev,
+             m.serial_frames_out)
+    text.add("vitaminder_led_writes_skipped_total", "counter", "Set-LED writes skipped, device already showed it.",
+             dev, v.led_writes_skipped)
+    text.add("vitaminder_heartbeat_response_age_seconds", "gauge",
+             "Seconds since the last heartbeat response (absent until the first one).", dev, m.since_heartbeat())
+
+    decoder = v.decoder.stats()
+    text.add("vitaminder_frames_in_total", "counter", "Frames decoded from the device.", dev, decoder["frames"])
+    text.add("vitaminder_resyncs_total", "counter", "Times the decoder lost frame alignment.", dev,
+             decoder["resyncs"])
+    text.add("vitaminder_skipped_bytes_total", "counter", "Bytes dropped while resyncing.", dev,
+             decoder["skipped_bytes"])
+
+    animator = v.animator
+    text.add("vitaminder_anim_keyframes_total", "counter", "LED animation keyframes written.", dev, animator.sent)
+    text.add("vitaminder_anim_keyframes_dropped_total", "counter",
+             "LED animation keyframes dropped, the link budget had no room.", dev, animator.dropped)
+    text.add("vitaminder_anim_level", "gauge", "LED animation degrade level (keyframes per cycle halved this often).",
+             dev, animator.level)
+    text.add_histogram("vitaminder_anim_lateness_seconds", "LED animation keyframe written this late.", dev,
+                       animator.lateness)
+
+    link = v.supervisor
+    text.add("vitaminder_link_up", "gauge", "1 while the serial link is up.", dev, 1 if link.up else 0)
+    text.add("vitaminder_link_losses_total", "counter", "Times the serial link went down.", dev, link.losses)
+    text.add("vitaminder_link_reconnect_attempts_total", "counter", "Tries to reopen the port while it was down.",
+             dev, link.attempts)
+    text.add("vitaminder_link_held_frames_total", "counter", "Set-LED frames held back while the link was down.",
+             dev, link.held)
+    text.add("vitaminder_link_dropped_frames_total", "counter",
+             "Frames written while the link was down and not kept for later.", dev, link.dropped)
+    text.add_histogram("vitaminder_link_recovery_seconds", "How long the serial link was down.", dev,
+                       link.recovery)
+
+    journal = getattr(v, "journal", None)
+    if journal is not None:
+        text.add("vitaminder_journal_records_total", "counter", "Records appended to the state journal.", dev,
+                 journal.appended)
+        text.add("vitaminder_journal_fsyncs_total", "counter", "State journal fsyncs.", dev, journal.fsyncs)
+        text.add("vitaminder_journal_rotations_total", "counter", "State journal files archived.", dev,
+                 journal.rotations)
+
+    liveness = v.liveness
+    since = liveness.stats()
+    text.add("vitaminder_liveness_quiet_seconds", "gauge",
+             "Seconds since the device last answered a request (absent until it first does).", dev,
+             since["since_contact"])
+    text.add("vitaminder_liveness_contacts_total", "counter", "Requests the device answered.", dev,
+             liveness.contacts)
+    text.add("vitaminder_liveness_heartbeats_sent_total", "counter",
+             "Heartbeats sent because the link had been quiet.", dev, liveness.heartbeats_sent)
+    text.add("vitaminder_liveness_heartbeats_saved", "gauge",
+             "Heartbeats the fixed schedule would have sent on top (0 when more than it went out).", dev,
+             since["heartbeats_saved"])
+    text.add("vitaminder_liveness_heartbeats_extra", "gauge",
+             "Heartbeats sent on top of the fixed schedule, the safety margin on a quiet link.", dev,
+             since["heartbeats_extra"])
+    text.add("vitaminder_liveness_airtime_saved_seconds", "gauge",
+             "Link airtime the heartbeats saved against the fixed schedule.", dev, since["airtime_saved_sec"])
+    text.add_histogram("vitaminder_liveness_gap_seconds", "Time between two answers from the device.", dev,
+                       liveness.quiet)
+
+    requests = v.requests
+    text.add("vitaminder_requests_in_flight", "gauge", "Requests waiting for their response.", dev,
+             sum(len(q) for q in requests.in_flight.values()))
+    for name, value in (("retries", requests.retries), ("timeouts", requests.timeouts),
+                        ("lost_responses", requests.lost_responses), ("mismatches", requests.mismatches),
+                        ("gave_up", requests.gave_up)):
+        text.add("vitaminder_request_%s_total" % name, "counter", "Request tracker %s." % name.replace("_", " "),
+                 dev, value)
+    for kind, hist in sorted(requests.latency.items()):
+        text.add_histogram("vitaminder_request_rtt_seconds", "Request to response round trip.",
+                           dev + [("request", "0x%02x" % kind)], hist)
+
+
+def scheduler_collector(scheduler, name="main"):
+    def collect(text):
+        labels = [("scheduler", name)]
+        text.add("vitaminder_scheduler_timers_fired_total", "counter", "Timer callbacks run.", labels, scheduler.fired)
+        text.add("vitaminder_scheduler_wakeups_total", "counter", "Scheduler wakeups.", labels, scheduler.wakeups)
+        text.add("vitaminder_scheduler_pending", "gauge", "Timers waiting in the heap.", labels, len(scheduler.heap))
+    return collect
+
+
+# every Vitaminder registers itself here, the exporter serves whatever is in it
+registry = MetricsRegistry()
+
+
+def metrics_handler():
+    # http.server (and the email/ssl modules behind it) takes longer to import than all of the
+    # daemon's own modules, so it is only loaded once somebody asks for the exporter
+    from http.server import BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/metrics", "/"):
+                self.send_error(404)
+                return
+            body = self.server.registry.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes every few seconds would drown the daemon's own log
+            pass
+
+    return MetricsHandler
+
+
+class MetricsServer:
+    # Prometheus text exporter on a local port, served from its own daemon thread so
+    # scrapes never wait on (or hold up) the controller
+    def __init__(self, port, host="127.0.0.1", metrics_registry=None):
+        from http.server import ThreadingHTTPServer
+
+        self.httpd = ThreadingHTTPServer((host, port), metrics_handler())
+        self.httpd.daemon_threads = True
+        self.httpd.registry = metrics_registry if metrics_registry is not None else registry
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.httpd.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,179 @@
+import logging
+import os
+import sys
+import threading
+
+log = logging.getLogger("hc_vitaminder")
+
+# the device names pyserial's linux comports() globs for
+PORT_PREFIXES = ("ttyS", "ttyUSB", "ttyXRUSB", "ttyACM", "ttyAMA", "rfcomm", "ttyAP")
+
+
+class PortDiscovery:
+    # serial port list kept up to date on a background thread
+    #
+    # comports() probes sysfs for every candidate, including the 32 ttyS* nodes most boxes
+    # have and which are usually not real ports.  on linux we only look at /dev's mtime
+    # each round (one stat), and when it moved we list /dev and probe just the names we
+    # haven't seen before; everything probed is cached, hidden ports included.  elsewhere
+    # it falls back to a full comports() per round.  either way listeners only ever hear
+    # about differences: listener(added [ListPortInfo], removed [device name]), called on
+    # the discovery thread.
+    def __init__(self, interval=2.0, dev_dir="/dev", incremental=None):
+        self.interval = interval
+        self.dev_dir = dev_dir
+        if incremental is None:
+            incremental = sys.platform.startswith("linux") and os.path.isdir(dev_dir)
+        self.incremental = incremental
+
+        self.lock = threading.Lock()
+        self.listeners = []
+        # device -> ListPortInfo, None for nodes that aren't real ports (non-present ttyS*)
+        self.known = {}
+        # device -> node_id(), a node that was removed and created again between two rounds
+        # (rfcomm reconnecting) is still a port that went away and came back
+        self.inodes = {}
+        self.dev_mtime = None
+        self.scanned = threading.Event()
+        self.wake = threading.Event()
+        self.alive = False
+        self.thread = None
+
+        self.scans = 0
+        self.probes = 0
+
+    def add_listener(self, listener):
+        with self.lock:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.lock:
+            self.listeners.remove(listener)
+
+    def ports(self):
+        # the cached list, sorted like comports() would be after a sort
+        with self.lock:
+            return sorted((info for info in self.known.values() if info is not None), key=lambda p: p.device)
+
+    def has(self, device):
+        with self.lock:
+            return self.known.get(device) is not None
+
+    def start(self):
+        self.alive = True
+        self.thread = threading.Thread(target=self.run, name="port-discovery", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.alive = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def poke(self):
+        # scan now instead of at the end of the interval (refresh button)
+        self.wake.set()
+
+    def run(self):
+        while self.alive:
+            try:
+                self.refresh()
+            except OSError as e:
+                log.warning("port discovery: %s", e)
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+    def refresh(self):
+        # one round, returns (added, removed) and tells the listeners when there is anything to tell
+        self.scans += 1
+        if self.incremental:
+            added, removed = self.scan_dev()
+        else:
+            added, removed = self.scan_full()
+        self.scanned.set()
+
+        if added or removed:
+            log.debug("ports added %s removed %s", [p.device for p in added], removed)
+            with self.lock:
+                listeners = list(self.listeners)
+            for listener in listeners:
+                listener(added, removed)
+        return added, removed
+
+    def scan_dev(self):
+        mtime = os.stat(self.dev_dir).st_mtime_ns
+        if mtime == self.dev_mtime:
+            return [], []
+        self.dev_mtime = mtime
+
+        from serial.tools.list_ports_linux import SysFS
+
+        current = {}
+        for name in os.listdir(self.dev_dir):
+            if name.startswith(PORT_PREFIXES):
+                current[os.path.join(self.dev_dir, name)] = None
+
+        # real ports we know about get one stat each to catch a node that was replaced
+        for device in self.inodes:
+            if device in current:
+                try:
+                    current[device] = node_id(device)
+                except OSError:
+                    del current[device]
+
+        with self.lock:
+            gone = [device for device in self.known
+                    if device not in current or (device in self.inodes and current[device] != self.inodes[device])]
+
+        added = []
+        probed = {}
+        for device in set(current).difference(self.known).union(gone):
+            if device not in current:
+                continue
+            info = SysFS(device)
+            self.probes += 1
+            # same filter as comports(): hide non-present internal serial ports
+            if info.subsystem == "platform":
+                probed[device] = None
+                continue
+            probed[device] = info
+            added.append(info)
+
+        with self.lock:
+            removed = [device for device in gone if self.known[device] is not None]
+            for device in gone:
+                del self.known[device]
+                self.inodes.pop(device, None)
+            self.known.update(probed)
+            for device, info in probed.items():
+                if info is not None:
+                    try:
+                        self.inodes[device] = node_id(device)
+                    except OSError:
+                        pass
+        return sorted(added, key=lambda p: p.device), sorted(removed)
+
+    def scan_full(self):
+        import serial.tools.list_ports
+
+        found = {info.device: info for info in serial.tools.list_ports.comports()}
+        self.probes += len(found)
+        with self.lock:
+            added = [info for device, info in found.items() if device not in self.known]
+            removed = [device for device in self.known if device not in found]
+            self.known = found
+        return sorted(added, key=lambda p: p.device), sorted(removed)
+
+    def stats(self):
+        return {
+            "ports": len(self.ports()),
+            "scans": self.scans,
+            "probes": self.probes,
+        }
+
+
+def node_id(path):
+    # inode numbers get reused straight away, the change time tells a new node from the old one
+    st = os.stat(path)
+    return st.st_ino, st.st_ctime_ns
@@ -0,0 +1,273 @@
+# wire protocol helpers, the message layout itself is documented at the top of hc_vitaminder.py
+
+MSG_REQ_HEARTBEAT = 0x00
+MSG_RSP_HEARTBEAT = 0x01
+MSG_REQ_SET_LED = 0x02
+MSG_RSP_SET_LED = 0x03
+MSG_BOOT = 0x04
+MSG_BUTTON = 0x06
+
+# protocol v2, only spoken after a HELLO exchange says the firmware knows it.
+# v2 frames carry a sequence byte after the ID and end in a CRC-8 over everything before it
+MSG_REQ_HELLO = 0x08
+MSG_RSP_HELLO = 0x09
+MSG_REQ_SET_PIXELS = 0x0A
+MSG_RSP_SET_PIXELS = 0x0B
+MSG_REQ_HEARTBEAT_V2 = 0x0C
+MSG_RSP_HEARTBEAT_V2 = 0x0D
+
+PROTO_V1 = 1
+PROTO_V2 = 2
+
+# HELLO capability bits
+CAP_BATCH = 0x01
+
+MSG_SIZE = 8
+PIXEL_COUNT = 4
+SYS_PIX = 0
+VIT_PIX = 1
+
+# host -> device frame lengths, anything not listed is MSG_SIZE
+REQUEST_SIZES = {
+    MSG_REQ_SET_PIXELS: 2 + 1 + 3 * PIXEL_COUNT + 2 + 1,
+    MSG_REQ_HEARTBEAT_V2: 3,
+}
+
+# device -> host frame lengths, anything not listed is MSG_SIZE
+FRAME_SIZES = {
+    MSG_RSP_SET_PIXELS: 10,
+    MSG_RSP_HEARTBEAT_V2: 10,
+}
+
+# v2 requests whose response is matched by sequence number
+SEQUENCED = frozenset([MSG_REQ_SET_PIXELS, MSG_REQ_HEARTBEAT_V2])
+
+
+def crc8_table(poly=0x07):
+    table = []
+    for i in range(256):
+        c = i
+        for _ in range(8):
+            c = ((c << 1) ^ poly) & 0xFF if c & 0x80 else (c << 1) & 0xFF
+        table.append(c)
+    return bytes(table)
+
+
+# CRC-8, polynomial 0x07, init 0 (CRC-8/SMBUS), the firmware has the bitwise version
+CRC8_TABLE = crc8_table()
+
+
+def crc8(data):
+    table = CRC8_TABLE
+    c = 0
+    for b in data:
+        c = table[c ^ b]
+    return c
+
+
+def seal(body):
+    # append the CRC
+    return bytes(body) + bytes([crc8(body)])
+
+
+def sequenced(msg_id, seq, payload=b""):
+    return seal(bytes([msg_id, seq]) + payload)
+
+
+def hello_frame(version=PROTO_V2, caps=CAP_BATCH):
+    # 8 bytes like every v1 frame, so v1 firmware reads it whole and ignores the unknown ID
+    return seal(bytes([MSG_REQ_HELLO, version, caps, 0, 0, 0, 0]))
+
+
+def hello_response(version, caps, pixel_count=PIXEL_COUNT):
+    return seal(bytes([MSG_RSP_HELLO, version, caps, pixel_count, 0, 0, 0]))
+
+
+def set_pixels_payload(brightness, pixels, blink_off=25, blink_on=75):
+    # everything of a SET_PIXELS frame between the sequence byte and the CRC
+    payload = bytearray([brightness])
+    for rgb in pixels:
+        payload += bytes(rgb)
+    payload += bytes([blink_off, blink_on])
+    return bytes(payload)
+
+
+def rsp_echo(rsp):
+    # brightness, vit rgb, sys rgb as a device response reports them
+    if rsp[0] in FRAME_SIZES:
+        return bytes(rsp[2:9])
+    return bytes(rsp[1:8])
+
+
+def valid_any(frame):
+    # heartbeat and set-LED responses carry brightness + colors, any byte value is legal
+    return True
+
+
+def valid_boot(frame):
+    # the firmware fills the whole BOOT frame with 0x04
+    for b in frame[1:]:
+        if b != MSG_BOOT:
+            return False
+    return True
+
+
+def valid_crc(frame):
+    return crc8(frame[:-1]) == frame[-1]
+
+
+def valid_button(frame):
+    # two button flags, then the firmware pads with 0x06
+    if frame[1] > 1 or frame[2] > 1:
+        return False
+    for b in frame[3:]:
+        if b != MSG_BUTTON:
+            return False
+    return True
+
+
+def button_frame(ok, snooze):
+    # what the firmware sends for a press, either button sends both buttons' states
+    return bytes([MSG_BUTTON, 0x01 if ok else 0x00, 0x01 if snooze else 0x00] + [MSG_BUTTON] * 5)
+
+
+def led_echo_matches(frame, rsp):
+    # heartbeat and set-LED responses echo brightness, vit rgb and sys rgb.  a v1 set-LED
+    # frame only says something about the pixels in its mask, a v2 SET_PIXELS frame sets all
+    if frame is None or rsp is None or len(rsp) < 8:
+        return False
+    echo = rsp_echo(rsp)
+    if frame[0] == MSG_REQ_SET_PIXELS:
+        payload = frame[2:-1]
+        vit = payload[1 + 3 * VIT_PIX:4 + 3 * VIT_PIX]
+        sys_ = payload[1 + 3 * SYS_PIX:4 + 3 * SYS_PIX]
+        return echo[0] == payload[0] and echo[1:4] == vit and echo[4:7] == sys_
+    if echo[0] != frame[1]:
+        return False
+    if frame[2] & (1 << VIT_PIX) and echo[1:4] != frame[3:6]:
+        return False
+    if frame[2] & (1 << SYS_PIX) and echo[4:7] != frame[3:6]:
+        return False
+    return True
+
+
+# how much each inbound message ID lets us check about the rest of its frame
+FRAME_VALIDATORS = {
+    MSG_RSP_HEARTBEAT: valid_any,
+    MSG_RSP_SET_LED: valid_any,
+    MSG_BOOT: valid_boot,
+    MSG_BUTTON: valid_button,
+    MSG_RSP_HELLO: valid_crc,
+    MSG_RSP_SET_PIXELS: valid_crc,
+    MSG_RSP_HEARTBEAT_V2: valid_crc,
+}
+
+# frames whose validator checks every byte, these are trusted without looking further ahead
+FULLY_VALIDATED = frozenset([MSG_BOOT, MSG_BUTTON, MSG_RSP_HELLO, MSG_RSP_SET_PIXELS, MSG_RSP_HEARTBEAT_V2])
+
+
+class VitFrameDecoder:
+    # incremental decoder for the device -> host byte stream
+    #
+    # bytes are appended to one preallocated buffer and frames are handed out as memoryview
+    # slices of it, so nothing is allocated per frame.  a slice is only good until the next
+    # feed(), copy it if it has to live longer.
+    #
+    # frame_types maps the first byte of a frame to whatever the caller wants back for it
+    # (the VitMsg), anything else at a frame start means we lost alignment.  we then slide
+    # forward one byte at a time until a known ID starts a frame that passes its validator.
+    # v1 responses can't be checked byte by byte, so those also have to be followed by another
+    # known ID (or by nothing yet) before we believe them.  v2 frames have their CRC.
+    # frame_size is the v1 size, v2 frames that differ are listed in FRAME_SIZES
+    def __init__(self, frame_types, frame_size=8, capacity=4096):
+        self.frame_types = frame_types
+        self.frame_size = frame_size
+        self.buf = bytearray(max(capacity, 2 * frame_size))
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+
+        self.frames = 0
+        self.resyncs = 0
+        self.bad_frames = 0
+        self.bytes_in = 0
+        self.skipped_bytes = 0
+        self.in_sync = True
+
+    def pending(self):
+        return self.end - self.start
+
+    def compact(self):
+        n = self.end - self.start
+        if n and self.start:
+            self.buf[0:n] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = n
+
+    def feed(self, data):
+        # yields (frame_type, memoryview of the frame) for every complete frame found
+        data = memoryview(data)
+        self.bytes_in += len(data)
+        while len(data):
+            if self.end == len(self.buf):
+                self.compact()
+            room = len(self.buf) - self.end
+            chunk = data[:room]
+            self.buf[self.end:self.end + len(chunk)] = chunk
+            self.end += len(chunk)
+            data = data[len(chunk):]
+            yield from self.drain()
+
+    def drain(self):
+        buf = self.buf
+        default_size = self.frame_size
+        sizes = FRAME_SIZES
+        types = self.frame_types
+        validators = FRAME_VALIDATORS
+
+        while self.end > self.start:
+            p = self.start
+            msg_id = buf[p]
+            frame_type = types.get(msg_id)
+            if frame_type is not None:
+                size = sizes.get(msg_id, default_size)
+                if self.end - p < size:
+                    # wait for the rest of it
+                    return
+                frame = self.view[p:p + size]
+                validator = validators.get(msg_id, valid_any)
+                if validator(frame):
+                    follower = p + size
+                    if msg_id in FULLY_VALIDATED or follower >= self.end or buf[follower] in types:
+                        self.start = follower
+                        self.frames += 1
+                        self.in_sync = True
+                        yield frame_type, frame
+                        continue
+                else:
+                    self.bad_frames += 1
+            self.skip_byte()
+
+    def skip_byte(self):
+        if self.in_sync:
+            self.resyncs += 1
+            self.in_sync = False
+        self.start += 1
+        self.skipped_bytes += 1
+
+    def flush_partial(self):
+        # the line went quiet mid-frame, that frame is never going to complete
+        if self.pending():
+            self.bad_frames += 1
+            self.skipped_bytes += self.pending()
+        self.start = 0
+        self.end = 0
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "resyncs": self.resyncs,
+            "bad_frames": self.bad_frames,
+            "bytes_in": self.bytes_in,
+            "skipped_bytes": self.skipped_bytes,
+        }
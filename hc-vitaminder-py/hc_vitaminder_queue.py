@@ -0,0 +1,175 @@
+import threading
+from collections import deque
+
+# priority bands, lower goes first.  FIFO inside a band
+PRIO_URGENT = 0
+PRIO_INPUT = 1
+PRIO_NORMAL = 2
+PRIO_LOW = 3
+BANDS = 4
+
+
+class VitEventQueue:
+    # the controller's inbox
+    #
+    # - one deque per priority band, so EXIT and button presses overtake a backlog of
+    #   heartbeats and responses
+    # - coalescing events (STATE, HEARTBEAT) are only ever pending once: the controller looks
+    #   at the current state when it gets to them, so five queued STATEs would just write
+    #   the same frame five times.  a payload on the newer one goes onto the pending one
+    #   (a forced HEARTBEAT upgrades a plain one waiting)
+    # - bounded: producers block once maxsize events are waiting.  EXIT, coalescing events,
+    #   the unbounded ones and anything the controller queues for itself are always let in,
+    #   otherwise the controller could end up waiting on its own queue.  unbounded is for the
+    #   timers: a scheduler thread blocked here would hold up every device's timers, and each
+    #   timer only ever has one event out, so they can't pile up
+    # - one Condition guards everything, there is no second lock inside like queue.Queue has
+    #
+    # priorities maps event_id -> band (anything missing is PRIO_NORMAL), coalesce and unbounded
+    # are sets of event_ids
+    def __init__(self, priorities, coalesce=(), maxsize=0, lock=None, unbounded=()):
+        self.priorities = priorities
+        self.coalesce = frozenset(coalesce)
+        self.unbounded = self.coalesce | frozenset(unbounded)
+        self.maxsize = maxsize
+        self.cond = threading.Condition(lock if lock is not None else threading.Lock())
+        self.bands = [deque() for _ in range(BANDS)]
+        # event_id -> the coalescing event waiting for it
+        self.pending = {}
+        self.size = 0
+        self.consumer = None
+        self.closed = False
+
+        self.coalesced = 0
+        self.blocked_puts = 0
+        self.over_bound = 0
+        self.high_water = 0
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return self.size == 0
+
+    def full(self):
+        return 0 < self.maxsize <= self.size
+
+    def admit(self, event):
+        # caller holds the lock (or is the event loop).  False when it merged into a pending event
+        event_id = event.event_id
+        if event_id in self.coalesce:
+            waiting = self.pending.get(event_id)
+            if waiting is not None:
+                if event.data is not None:
+                    waiting.data = event.data
+                self.coalesced += 1
+                return False
+            self.pending[event_id] = event
+        if self.full():
+            self.over_bound += 1
+        self.bands[self.priorities.get(event_id, PRIO_NORMAL)].append(event)
+        self.size += 1
+        if self.size > self.high_water:
+            self.high_water = self.size
+        return True
+
+    def take(self):
+        for band in self.bands:
+            if band:
+                event = band.popleft()
+                self.size -= 1
+                if self.pending.get(event.event_id) is event:
+                    del self.pending[event.event_id]
+                return event
+        return None
+
+    def must_wait(self, event):
+        return (self.full() and not self.closed and event.event_id not in self.unbounded
+                and self.priorities.get(event.event_id, PRIO_NORMAL) != PRIO_URGENT
+                and threading.get_ident() != self.consumer)
+
+    def put(self, event, block=True, timeout=None):
+        # False when the event merged into one already waiting, or timed out / was dropped
+        # (block=False) because the queue stayed full
+        with self.cond:
+            if self.must_wait(event):
+                if not block:
+                    return False
+                self.blocked_puts += 1
+                if not self.cond.wait_for(lambda: not self.must_wait(event), timeout):
+                    return False
+            added = self.admit(event)
+            if added:
+                self.cond.notify_all()
+            return added
+
+    def get(self, block=True, timeout=None):
+        # next event by priority, None when nothing came in within timeout
+        with self.cond:
+            self.consumer = threading.get_ident()
+            if self.size == 0:
+                if not block:
+                    return None
+                self.cond.wait_for(lambda: self.size, timeout)
+            was_full = self.full()
+            event = self.take()
+            if was_full and event is not None:
+                # somebody may be waiting for room
+                self.cond.notify_all()
+            return event
+
+    def close(self):
+        # the controller is done, nobody is ever going to make room again
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def stats(self):
+        return {
+            "depth": self.size,
+            "high_water": self.high_water,
+            "coalesced": self.coalesced,
+            "blocked_puts": self.blocked_puts,
+            "over_bound": self.over_bound,
+        }
+
+
+class AsyncVitEventQueue(VitEventQueue):
+    # same bands and coalescing for asyncio mode.  everything runs on the loop (other threads
+    # go through call_soon_threadsafe), so there is nothing to lock, waiting uses asyncio.Events.
+    # put_nowait() always admits, the bound is enforced by the serial reader awaiting
+    # wait_for_room() before it reads more
+    def __init__(self, priorities, coalesce=(), maxsize=0, unbounded=()):
+        # imported here, the threaded daemon never loads asyncio
+        import asyncio
+
+        super().__init__(priorities, coalesce, maxsize, unbounded=unbounded)
+        self.not_empty = asyncio.Event()
+        self.not_full = asyncio.Event()
+        self.not_full.set()
+
+    def put_nowait(self, event):
+        added = self.admit(event)
+        if added:
+            self.not_empty.set()
+            if self.full():
+                self.not_full.clear()
+        return added
+
+    async def get_async(self):
+        while self.size == 0:
+            self.not_empty.clear()
+            await self.not_empty.wait()
+        event = self.take()
+        if not self.full():
+            self.not_full.set()
+        return event
+
+    def close(self):
+        self.closed = True
+        self.not_full.set()
+
+    async def wait_for_room(self):
+        if self.full():
+            self.blocked_puts += 1
+            await self.not_full.wait()
@@ -0,0 +1,101 @@
+import logging
+import os
+import signal
+import threading
+
+log = logging.getLogger("hc_vitaminder")
+
+
+class ConfigWatcher:
+    # re-reads the config file when it changes, on a background thread
+    #
+    # one stat per interval (interval 0 = never look, only poke()), and when the file's mtime or
+    # size moved it is read into a fresh ConfigParser and handed to listener(configuration) on
+    # the watcher thread.  the listener compiles and checks it and decides what to swap in, a
+    # file that doesn't even parse never gets that far.  an editor saving half a file is caught
+    # by the next save changing the mtime again
+    def __init__(self, path, listener, interval=2.0):
+        self.path = path
+        self.listener = listener
+        self.interval = interval
+        self.key = self.file_key()
+        self.wake = threading.Event()
+        self.forced = False
+        self.alive = False
+        self.thread = None
+
+        self.checks = 0
+        self.reloads = 0
+        self.rejected = 0
+
+    def file_key(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size
+
+    def start(self):
+        self.alive = True
+        self.thread = threading.Thread(target=self.run, name="config-watch", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.alive = False
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def poke(self):
+        # read it now whether it changed or not (SIGHUP), safe from a signal handler
+        self.forced = True
+        self.wake.set()
+
+    def run(self):
+        while self.alive:
+            self.wake.wait(self.interval if self.interval > 0 else None)
+            self.wake.clear()
+            if self.alive:
+                self.check()
+
+    def check(self):
+        # one look, True when a changed config went to the listener
+        import configparser
+
+        self.checks += 1
+        forced, self.forced = self.forced, False
+        key = self.file_key()
+        if key is None or (key == self.key and not forced):
+            return False
+        self.key = key
+
+        configuration = configparser.ConfigParser()
+        try:
+            with open(self.path) as f:
+                configuration.read_file(f)
+        except (OSError, configparser.Error) as e:
+            self.rejected += 1
+            log.warning("config %s not reloaded, keeping the running one: %s", self.path, e)
+            return False
+        log.info("config %s changed, reloading", self.path)
+        if self.listener(configuration) is False:
+            self.rejected += 1
+            return False
+        self.reloads += 1
+        return True
+
+    def stats(self):
+        return {
+            "checks": self.checks,
+            "reloads": self.reloads,
+            "rejected": self.rejected,
+        }
+
+
+def watch_config(path, listener, interval):
+    # watcher plus SIGHUP (where there is one), call from the main thread
+    watcher = ConfigWatcher(path, listener, interval).start()
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, lambda signum, frame: watcher.poke())
+    return watcher
@@ -0,0 +1,270 @@
+from bisect import bisect_right
+from datetime import timedelta, time
+from functools import lru_cache
+
+# medication schedules, compiled into one interval index per device
+#
+# every medication has windows for its unmedicated, soft and hard reminder times, the weekdays
+# it is due on and its own snooze length.  all of a device's medications are painted onto one
+# week (in microseconds since monday 00:00) and cut into segments at every window edge: each
+# segment holds what every medication is due for in it.  what is due at an instant and when
+# that next changes are then one bisect each, however many medications and windows there are.
+#
+# on top of the index each device keeps, per medication, whether it was taken today and until
+# when it is snoozed.  the device shows the most urgent of its medications, see VitRules.
+
+# what a medication is up to, higher is more urgent.  the device shows the highest one
+LEVEL_NAILED = 0
+LEVEL_UNMEDICATED = 1
+LEVEL_SNOOZED = 2
+LEVEL_SOFT = 3
+LEVEL_HARD = 4
+
+DAY_US = 86400 * 1000000
+WEEK_US = 7 * DAY_US
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+ALL_DAYS = frozenset(range(7))
+
+# windows painted later win where they overlap
+PAINT_ORDER = (LEVEL_HARD, LEVEL_SOFT, LEVEL_UNMEDICATED)
+
+
+def time_us(t):
+    return ((t.hour * 60 + t.minute) * 60 + t.second) * 1000000 + t.microsecond
+
+
+def week_us(when):
+    return when.weekday() * DAY_US + time_us(when)
+
+
+def parse_windows(value):
+    # "HH:MM:SS-HH:MM:SS[, ...]" -> ((begin_us, end_us), ...), an end at or before the begin runs past midnight
+    windows = []
+    for part in value.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        begin, end = part.split("-")
+        windows.append((time_us(time.fromisoformat(begin.strip())), time_us(time.fromisoformat(end.strip()))))
+    return tuple(windows)
+
+
+def parse_days(value):
+    # "mon,wed,fri", "mon-fri" or "daily" -> weekday numbers (monday 0)
+    value = value.strip().lower()
+    if value in ("", "daily", "all"):
+        return ALL_DAYS
+    days = set()
+    for part in value.split(","):
+        first, _, last = part.strip().partition("-")
+        first = DAYS.index(first.strip()[:3])
+        last = DAYS.index(last.strip()[:3]) if last else first
+        day = first
+        days.add(day)
+        while day != last:
+            day = (day + 1) % 7
+            days.add(day)
+    return frozenset(days)
+
+
+class Medication:
+    # one medication's schedule.  windows maps level -> ((begin_us, end_us), ...); time on a due
+    # day that no window covers is a hard reminder unless hard reminder windows are given, then
+    # the medication isn't due outside its windows at all
+    def __init__(self, name, windows, days=ALL_DAYS, snooze_sec=900):
+        self.name = name
+        self.windows = windows
+        self.days = days
+        self.snooze_delta = timedelta(seconds=snooze_sec)
+
+    def key(self):
+        return (self.name, tuple(sorted(self.windows.items())), tuple(sorted(self.days)), self.snooze_delta)
+
+    def paints(self):
+        # (start, stop, level) spans over the week, a later one wins where they overlap
+        paints = []
+        if LEVEL_HARD not in self.windows:
+            paints.extend((day * DAY_US, (day + 1) * DAY_US, LEVEL_HARD) for day in sorted(self.days))
+        # a window belongs to the day it begins on
+        for level in PAINT_ORDER:
+            for day in sorted(self.days):
+                for begin, end in self.windows.get(level, ()):
+                    start = day * DAY_US + begin
+                    stop = day * DAY_US + end + (DAY_US if end <= begin else 0)
+                    if stop > WEEK_US:
+                        paints.append((start, WEEK_US, level))
+                        paints.append((0, stop - WEEK_US, level))
+                    else:
+                        paints.append((start, stop, level))
+        return paints
+
+    def timeline(self):
+        # (starts, levels) over the week, levels[i] holds from starts[i] to the next start, None = not due
+        paints = self.paints()
+        points = sorted(set([0] + [p for start, stop, _ in paints for p in (start, stop) if p < WEEK_US]))
+        starts, levels = [], []
+        for point in points:
+            level = None
+            for start, stop, painted in paints:
+                if start <= point < stop:
+                    level = painted
+            if not levels or levels[-1] != level:
+                starts.append(point)
+                levels.append(level)
+        return starts, levels
+
+
+def medications_from_config(config):
+    # "medications = a, b" lists them, each with med_<name>_<key> settings.  anything a medication
+    # doesn't set comes from the single-schedule keys, so without a medications key the device
+    # has the one medication the boundary_* keys describe
+    default_unmed = "%s-%s" % (config["boundary_unmedicated_begin"], config["boundary_unmedicated_end"])
+    default_soft = "%s-%s" % (config["boundary_soft_reminder_begin"], config["boundary_soft_reminder_end"])
+    default_snooze = config.getint("snooze_duration_seconds", fallback=900)
+
+    names = [n.strip() for n in config.get("medications", fallback="meds").split(",") if n.strip()]
+    medications = []
+    for name in names:
+        prefix = "med_%s_" % name
+        windows = {LEVEL_UNMEDICATED: parse_windows(config.get(prefix + "unmedicated", fallback=default_unmed)),
+                   LEVEL_SOFT: parse_windows(config.get(prefix + "soft_reminder", fallback=default_soft))}
+        hard = config.get(prefix + "hard_reminder", fallback=None)
+        if hard is not None:
+            windows[LEVEL_HARD] = parse_windows(hard)
+        medications.append(Medication(name, windows, parse_days(config.get(prefix + "days", fallback="daily")),
+                                      config.getint(prefix + "snooze_seconds", fallback=default_snooze)))
+    return medications
+
+
+class RuleIndex:
+    # every medication's timeline merged: starts[i] is where segment i begins (microseconds into
+    # the week), levels[i] is a tuple with each medication's level in it
+    def __init__(self, medications):
+        self.names = tuple(m.name for m in medications)
+        self.snooze_deltas = tuple(m.snooze_delta for m in medications)
+
+        timelines = [m.timeline() for m in medications]
+        points = sorted(set(p for starts, _ in timelines for p in starts) | {0})
+        self.starts = []
+        self.levels = []
+        for point in points:
+            due = tuple(levels[bisect_right(starts, point) - 1] for starts, levels in timelines)
+            if not self.levels or self.levels[-1] != due:
+                self.starts.append(point)
+                self.levels.append(due)
+
+    def __len__(self):
+        return len(self.names)
+
+    def levels_at(self, when):
+        return self.levels[bisect_right(self.starts, week_us(when)) - 1]
+
+    def next_boundary(self, when):
+        # the next instant any medication's due level changes
+        now = week_us(when)
+        i = bisect_right(self.starts, now)
+        nxt = self.starts[i] if i < len(self.starts) else WEEK_US + self.starts[0]
+        return when + timedelta(microseconds=nxt - now)
+
+
+# compiled indexes by schedule, devices on the same schedules share one.  every reload with an
+# edited schedule makes a new key, so only the most recent ones are kept
+INDEX_CACHE_SIZE = 32
+
+
+def compile_rules(medications):
+    return cached_index(tuple(m.key() for m in medications))
+
+
+@lru_cache(maxsize=INDEX_CACHE_SIZE)
+def cached_index(key):
+    # the key holds the whole schedule, the medications are rebuilt from it
+    return RuleIndex([Medication(name, dict(windows), frozenset(days), snooze_delta.total_seconds())
+                      for name, windows, days, snooze_delta in key])
+
+
+class VitRules:
+    # one device's medications for today: the compiled index plus what was taken and snoozed.
+    # everything takes the (naive, local) time to judge by, like the rest of the state code
+    def __init__(self, index):
+        self.index = index
+        self.nailed = [False] * len(index)
+        self.snoozed_until = [None] * len(index)
+
+    def new_day(self):
+        for i in range(len(self.index)):
+            self.nailed[i] = False
+            self.snoozed_until[i] = None
+
+    def levels(self, now):
+        # each medication's level, None when it isn't due.  taken stays taken for the rest of
+        # the day and a snooze runs out its time, whatever the windows do meanwhile
+        due = self.index.levels_at(now)
+        levels = []
+        for i, level in enumerate(due):
+            until = self.snoozed_until[i]
+            if until is not None and now >= until:
+                until = self.snoozed_until[i] = None
+            if self.nailed[i]:
+                level = LEVEL_NAILED
+            elif until is not None:
+                level = LEVEL_SNOOZED
+            levels.append(level)
+        return levels
+
+    def level(self, now):
+        # what the device shows: its most urgent medication, unmedicated when none is due
+        levels = [level for level in self.levels(now) if level is not None]
+        return max(levels) if levels else LEVEL_UNMEDICATED
+
+    def snooze_expiration(self):
+        # the first snooze to run out, None when nothing is snoozed
+        pending = [until for until in self.snoozed_until if until is not None]
+        return min(pending) if pending else None
+
+    def next_transition(self, now):
+        # the next instant level() could change, None when nothing changes before the day is out
+        # (everything taken).  window edges only count while something is neither taken nor snoozed
+        candidates = [until for until in self.snoozed_until if until is not None]
+        if not all(self.nailed[i] or self.snoozed_until[i] is not None for i in range(len(self.index))):
+            candidates.append(self.index.next_boundary(now))
+        return min(candidates) if candidates else None
+
+    def snooze(self, now):
+        # every medication reminding right now is snoozed for its own snooze length
+        levels = self.levels(now)
+        for i, level in enumerate(levels):
+            if level in (LEVEL_SNOOZED, LEVEL_SOFT, LEVEL_HARD):
+                self.snoozed_until[i] = now + self.index.snooze_deltas[i]
+
+    def ok(self, now):
+        # takes the most urgent medication (the one listed first on a tie), once everything due
+        # is taken it puts them all back to their time based levels
+        levels = self.levels(now)
+        open_ = [(level, -i) for i, level in enumerate(levels) if level is not None and level != LEVEL_NAILED]
+        if open_:
+            i = -max(open_)[1]
+            self.nailed[i] = True
+            self.snoozed_until[i] = None
+        else:
+            self.new_day()
+
+    def carry_over(self, old):
+        # a reloaded schedule keeps what was taken and snoozed today, by medication name
+        names = dict(zip(old.index.names, range(len(old.index))))
+        for i, name in enumerate(self.index.names):
+            j = names.get(name)
+            if j is not None:
+                self.nailed[i] = old.nailed[j]
+                self.snoozed_until[i] = old.snoozed_until[j]
+        return self
+
+    def restore(self, level, snooze_expiration=None):
+        # the journal only has the device level: taken means all of them were, snoozed means
+        # all of them are until the expiry
+        self.new_day()
+        if level == LEVEL_NAILED:
+            self.nailed = [True] * len(self.index)
+        elif level == LEVEL_SNOOZED and snooze_expiration is not None:
+            self.snoozed_until = [snooze_expiration] * len(self.index)
@@ -0,0 +1,142 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+
+log = logging.getLogger("hc_vitaminder")
+
+
+class VitTimer:
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        # lazy delete, the scheduler drops it when it reaches the top of the heap
+        self.cancelled = True
+
+
+class VitScheduler:
+    # one heap of wall-clock timers shared by every device in the process
+    #
+    # devices ask for a callback at their next real transition (a boundary, snooze expiry or
+    # the day rollover), so nobody wakes up between transitions.  the scheduler either runs on
+    # its own thread (run()) or rides an asyncio loop (attach_loop()), in which case it keeps
+    # exactly one loop timer armed for whatever is at the top of the heap.
+
+    # the Pi Zero has no RTC and NTP can step the wall clock, so never trust one sleep for
+    # longer than this.  it's one wakeup for the whole scheduler, devices aren't touched.
+    max_sleep_sec = 3600
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Condition()
+        self.alive = True
+
+        self.loop = None
+        self.loop_handle = None
+        self.loop_handle_when = None
+
+        self.fired = 0
+        self.wakeups = 0
+
+    def call_at(self, when, callback, *args):
+        timer = VitTimer(when, callback, args)
+        with self.lock:
+            heapq.heappush(self.heap, (when, next(self.counter), timer))
+            is_first = self.heap[0][2] is timer
+            if is_first:
+                self.lock.notify_all()
+        if is_first and self.loop is not None:
+            self.arm_loop()
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(self.clock() + delay, callback, *args)
+
+    def next_due(self):
+        # when the earliest live timer fires, None if there is nothing scheduled
+        with self.lock:
+            while self.heap and self.heap[0][2].cancelled:
+                heapq.heappop(self.heap)
+            return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now):
+        due = []
+        with self.lock:
+            while self.heap and (self.heap[0][2].cancelled or self.heap[0][0] <= now):
+                timer = heapq.heappop(self.heap)[2]
+                if not timer.cancelled:
+                    due.append(timer)
+        return due
+
+    def run_due(self, now=None):
+        # fire everything that is due, callbacks run without the lock held
+        due = self.pop_due(self.clock() if now is None else now)
+        for timer in due:
+            self.fired += 1
+            timer.callback(*timer.args)
+        return len(due)
+
+    def run(self):
+        # threaded mode, one thread for every device in the process
+        while self.alive:
+            self.wakeups += 1
+            self.run_due()
+
+            self.lock.acquire()
+            if self.alive:
+                wait_sec = self.max_sleep_sec
+                if self.heap:
+                    wait_sec = min(wait_sec, max(0.0, self.heap[0][0] - self.clock()))
+                log.debug("sched() sleeping for %s seconds", wait_sec)
+                self.lock.wait(wait_sec)
+            self.lock.release()
+
+        log.debug("sched() end")
+
+    def stop(self):
+        with self.lock:
+            self.alive = False
+            self.lock.notify_all()
+        if self.loop is not None:
+            self.detach_loop()
+
+    # asyncio mode
+
+    def attach_loop(self, loop):
+        self.loop = loop
+        self.arm_loop()
+
+    def detach_loop(self):
+        if self.loop_handle is not None:
+            self.loop_handle.cancel()
+        self.loop_handle = None
+        self.loop_handle_when = None
+        self.loop = None
+
+    def arm_loop(self):
+        when = self.next_due()
+        if when is None or not self.alive:
+            return
+        if self.loop_handle is not None:
+            if self.loop_handle_when is not None and self.loop_handle_when <= when:
+                return
+            self.loop_handle.cancel()
+        delay = min(self.max_sleep_sec, max(0.0, when - self.clock()))
+        self.loop_handle_when = when
+        self.loop_handle = self.loop.call_later(delay, self.on_loop_timer)
+
+    def on_loop_timer(self):
+        self.loop_handle = None
+        self.loop_handle_when = None
+        self.wakeups += 1
+        self.run_due()
+        if self.loop is not None:
+            self.arm_loop()
@@ -0,0 +1,358 @@
+import logging
+import os
+import queue
+import signal
+import struct
+import threading
+import time
+from multiprocessing import get_context, shared_memory
+
+from hc_vitaminder import VitMsg, VitState
+from hc_vitaminder_supervisor import Backoff
+
+log = logging.getLogger("hc_vitaminder")
+
+# sharded hub: a fleet's devices spread over worker processes, one per core
+#
+# every worker is a VitaminderHub for its share of the config's [device] sections, with its
+# own event loop, scheduler and GIL.  the parent only supervises: it owns a table in shared
+# memory with one fixed width row per device that the workers keep current, so the whole
+# fleet can be looked at (metrics, fleet()) without asking any worker anything.  when a
+# worker dies its devices go to the live workers with the fewest devices and the dead one is
+# started again (empty) after a backoff.  a moved device gets its state back from its journal,
+# so that needs journal_dir: without one it starts over from the schedule, whatever was taken
+# or snoozed today is forgotten (the supervisor warns about that when it starts).
+#
+#   python hc_vitaminder.py --hub --shards 0 fleet.ini
+
+# row: seq (odd while its worker is writing it), then the payload below.
+#      state, flags, shard that wrote it, snooze expiry, last heartbeat response, last update
+#      (epoch seconds, 0 = none)
+SEQ = struct.Struct("<I")
+PAYLOAD = struct.Struct("<BBbxddd")
+ROW_SIZE = SEQ.size + PAYLOAD.size
+
+FLAG_LINK_UP = 1
+
+READ_TRIES = 100
+
+
+class StateTable:
+    # the rows in shared memory.  name=None creates it (the parent), a worker attaches by name.
+    # each row has exactly one writer, the worker running that device, so writes take no lock:
+    # the writer makes seq odd, writes the payload and makes it even again, a reader that
+    # sees seq odd or moved under it reads again.  a worker killed halfway through leaves seq
+    # odd, so the next writer (the worker that adopted the device) sets the parity itself
+    # rather than counting on it
+    def __init__(self, slots, name=None):
+        self.slots = slots
+        self.owner = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=max(1, slots) * ROW_SIZE)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        if self.owner:
+            self.buf[:] = bytes(len(self.buf))
+
+    def write(self, slot, state, flags, shard, snooze, heartbeat, updated):
+        offset = slot * ROW_SIZE
+        writing = SEQ.unpack_from(self.buf, offset)[0] | 1
+        SEQ.pack_into(self.buf, offset, writing)
+        PAYLOAD.pack_into(self.buf, offset + SEQ.size, state, flags, shard, snooze, heartbeat, updated)
+        # 0 means never written, a wrap skips it
+        SEQ.pack_into(self.buf, offset, ((writing + 1) & 0xFFFFFFFF) or 2)
+
+    def read(self, slot):
+        # (state, flags, shard, snooze, heartbeat, updated), None when the row was never written
+        offset = slot * ROW_SIZE
+        for _ in range(READ_TRIES):
+            seq = SEQ.unpack_from(self.buf, offset)[0]
+            if seq & 1:
+                continue
+            row = PAYLOAD.unpack_from(self.buf, offset + SEQ.size)
+            if SEQ.unpack_from(self.buf, offset)[0] == seq:
+                return row if seq else None
+        return None
+
+    def view(self):
+        # the raw rows, no copy (ROW_SIZE bytes each, in slot order)
+        return self.buf
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class StateSlot:
+    # a worker's handle on one device's row, Vitaminder.handle_event() calls update() after every event
+    def __init__(self, table, slot, shard):
+        self.table = table
+        self.slot = slot
+        self.shard = shard
+        self.heartbeat = 0.0
+
+    def update(self, v, event_id):
+        now = v.clock()
+        if event_id == VitMsg.SERIAL_HEARTBEAT_RSP:
+            self.heartbeat = now
+        snooze = v.snooze_expiration.timestamp() if v.snooze_expiration is not None else 0.0
+        self.table.write(self.slot, v.state.value, FLAG_LINK_UP if v.supervisor.up else 0, self.shard,
+                         snooze, self.heartbeat, now)
+
+
+def adopt(hub, table, shard, assigned):
+    # on the worker's loop: run these (section, slot) devices too
+    added = hub.add_devices([section for section, _ in assigned])
+    for v, (section, slot) in zip(added, assigned):
+        v.state_slot = StateSlot(table, slot, shard)
+    log.info("shard %d: took over %s", shard, ", ".join(section for section, _ in assigned))
+
+
+def control_loop(control, hub, loop, table, shard):
+    # worker thread: the parent's orders.  a list of (section, slot) is more devices, None is
+    # stop.  a parent that went away without saying so stops us too
+    parent = os.getppid()
+    while hub.alive:
+        try:
+            msg = control.get(timeout=1.0)
+        except queue.Empty:
+            if os.getppid() != parent:
+                log.warning("shard %d: supervisor is gone, stopping", shard)
+                loop.call_soon_threadsafe(hub.stop)
+                return
+            continue
+        if msg is None:
+            loop.call_soon_threadsafe(hub.stop)
+            return
+        loop.call_soon_threadsafe(adopt, hub, table, shard, msg)
+
+
+async def run_worker(hub, control, table, shard):
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    if hasattr(signal, "SIGTERM"):
+        loop.add_signal_handler(signal.SIGTERM, hub.stop)
+    threading.Thread(target=control_loop, args=(control, hub, loop, table, shard), name="shard-control",
+                     daemon=True).start()
+    await hub.run_async()
+
+
+def shard_worker(shard, config_file, assigned, table_name, slots, control, log_level):
+    # worker process entry point (spawned, so everything comes in by argument)
+    import asyncio
+    import configparser
+    from hc_vitaminder_hub import VitaminderHub
+    from hc_vitaminder_reload import watch_config
+
+    logging.basicConfig(level=log_level, format="%(asctime)s %(levelname)s [shard " + str(shard) + "] %(message)s")
+    # ctrl-c reaches the whole process group, the supervisor is the one to decide
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    configuration = configparser.ConfigParser()
+    configuration.read(config_file)
+    table = StateTable(slots, name=table_name)
+    hub = VitaminderHub(configuration, sections=[section for section, _ in assigned])
+    for v, (section, slot) in zip(hub.devices, assigned):
+        v.state_slot = StateSlot(table, slot, shard)
+    log.info("shard %d driving %d devices", shard, len(hub.devices))
+
+    hub.connect()
+    watcher = watch_config(config_file, hub.reload, hub.config_watch_sec)
+    asyncio.run(run_worker(hub, control, table, shard))
+    watcher.stop()
+    hub.disconnect()
+    table.close()
+
+
+class ShardSupervisor:
+    # the parent process: owns the state table, starts the workers and rebalances when one dies
+    #
+    # shards=0 means one worker per core, never more workers than devices.  devices are dealt
+    # out round robin by config order.  check() runs every check_sec: a dead worker's devices
+    # are handed out to the live workers with the fewest devices (waiting in pending while
+    # none is alive), and the dead one is started again after its backoff, empty, so the pool
+    # keeps its size and takes the devices of the next one to go.  nothing is moved back to
+    # it: a device changes workers only when its worker dies, so the load stays uneven until
+    # the next death fills the empty one up first, or the supervisor restarts.  a worker that
+    # ran longer than the backoff's maximum starts its backoff over
+    def __init__(self, config_file, configuration, shards=0, check_sec=1.0, log_level=logging.INFO,
+                 clock=time.monotonic):
+        self.config_file = config_file
+        self.sections = configuration.sections()
+        if len(self.sections) == 0:
+            raise ValueError("hub mode needs at least one [device] section in the config file")
+        unjournaled = [section for section in self.sections
+                       if not configuration[section].get("journal_dir", fallback="")]
+        if unjournaled:
+            log.warning("no journal_dir for %s: a device moved off a dead shard starts over from its schedule",
+                        ", ".join(unjournaled))
+        self.shards = max(1, min(shards or os.cpu_count() or 1, len(self.sections)))
+        self.check_sec = check_sec
+        self.log_level = log_level
+        self.clock = clock
+        self.ctx = get_context("spawn")
+
+        self.table = StateTable(len(self.sections))
+        # shard -> [(section, slot)] it runs
+        self.assigned = {shard: [] for shard in range(self.shards)}
+        for slot, section in enumerate(self.sections):
+            self.assigned[slot % self.shards].append((section, slot))
+        # shard -> (process, control queue, started)
+        self.workers = {}
+        self.backoff = {shard: Backoff(initial=1.0, maximum=60.0) for shard in range(self.shards)}
+        self.restart_at = {}
+        self.pending = []
+
+        self.alive = True
+        self.wake = threading.Event()
+
+        self.deaths = 0
+        self.restarts = 0
+        self.moved = 0
+
+    def spawn(self, shard):
+        control = self.ctx.Queue()
+        process = self.ctx.Process(target=shard_worker, name="vitaminder-shard%d" % shard, daemon=True,
+                                   args=(shard, self.config_file, list(self.assigned[shard]), self.table.name,
+                                         self.table.slots, control, self.log_level))
+        process.start()
+        self.workers[shard] = (process, control, self.clock())
+        log.info("shard %d started (pid %d) with %d devices", shard, process.pid, len(self.assigned[shard]))
+
+    def start(self):
+        for shard in range(self.shards):
+            self.spawn(shard)
+        if hasattr(signal, "SIGHUP"):
+            # kill -HUP on the supervisor reloads the config everywhere
+            signal.signal(signal.SIGHUP, lambda signum, frame: self.signal_workers(signal.SIGHUP))
+        return self
+
+    def signal_workers(self, signum):
+        for process, _, _ in self.workers.values():
+            if process.is_alive():
+                os.kill(process.pid, signum)
+
+    def check(self):
+        now = self.clock()
+        for shard, (process, control, started) in list(self.workers.items()):
+            if process.is_alive():
+                continue
+            del self.workers[shard]
+            self.deaths += 1
+            orphans, self.assigned[shard] = self.assigned[shard], []
+            self.pending.extend(orphans)
+            backoff = self.backoff[shard]
+            if now - started > backoff.maximum:
+                backoff.reset()
+            self.restart_at[shard] = now + backoff.next()
+            log.warning("shard %d (pid %d) died with exit code %s, %d devices to move",
+                        shard, process.pid, process.exitcode, len(orphans))
+            control.close()
+
+        for shard, when in list(self.restart_at.items()):
+            if now >= when:
+                del self.restart_at[shard]
+                self.restarts += 1
+                self.spawn(shard)
+
+        if self.pending and self.workers:
+            self.rebalance()
+
+    def rebalance(self):
+        # pending devices to the live workers, fewest devices first
+        moves = {}
+        for section, slot in self.pending:
+            shard = min(self.workers, key=lambda s: (len(self.assigned[s]), s))
+            self.assigned[shard].append((section, slot))
+            moves.setdefault(shard, []).append((section, slot))
+        self.pending = []
+        for shard, assigned in moves.items():
+            self.workers[shard][1].put(assigned)
+            self.moved += len(assigned)
+            log.info("moved %d devices to shard %d", len(assigned), shard)
+
+    def run(self):
+        while self.alive:
+            self.wake.wait(self.check_sec)
+            if self.alive:
+                self.check()
+
+    def stop(self, timeout=10.0):
+        self.alive = False
+        self.wake.set()
+        for process, control, _ in self.workers.values():
+            if process.is_alive():
+                control.put(None)
+        deadline = time.monotonic() + timeout
+        for process, _, _ in self.workers.values():
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                log.warning("shard %s did not stop, terminating it", process.name)
+                process.terminate()
+                process.join()
+        self.workers = {}
+
+    def close(self):
+        self.table.close()
+
+    def owner(self):
+        # slot -> shard it is assigned to, None while it waits for a live worker
+        owners = [None] * len(self.sections)
+        for shard, assigned in self.assigned.items():
+            for _, slot in assigned:
+                owners[slot] = shard
+        return owners
+
+    def fleet(self):
+        # every device's row as the workers last wrote it
+        devices = []
+        owners = self.owner()
+        for slot, section in enumerate(self.sections):
+            row = self.table.read(slot)
+            device = {"device": section, "shard": owners[slot], "running": owners[slot] in self.workers}
+            if row is not None:
+                state, flags, shard, snooze, heartbeat, updated = row
+                device.update(state=VitState(state).name, link_up=bool(flags & FLAG_LINK_UP),
+                              snooze_expiration=snooze or None, last_heartbeat=heartbeat or None,
+                              updated=updated)
+            devices.append(device)
+        return devices
+
+    def stats(self):
+        return {
+            "shards": self.shards,
+            "alive": len(self.workers),
+            "pending": len(self.pending),
+            "deaths": self.deaths,
+            "restarts": self.restarts,
+            "moved": self.moved,
+        }
+
+
+def fleet_collector(supervisor):
+    # /metrics for the whole fleet, read from the state table on the parent's side
+    def collect(text):
+        now = time.time()
+        for device in supervisor.fleet():
+            dev = [("device", device["device"])]
+            if "state" in device:
+                text.add("vitaminder_state", "gauge", "Current reminder state (1 for the active one).",
+                         dev + [("state", device["state"])], 1)
+                text.add("vitaminder_link_up", "gauge", "1 while the serial link is up.", dev,
+                         1 if device["link_up"] else 0)
+                if device["last_heartbeat"] is not None:
+                    text.add("vitaminder_heartbeat_response_age_seconds", "gauge",
+                             "Seconds since the last heartbeat response (absent until the first one).", dev,
+                             now - device["last_heartbeat"])
+            if device["shard"] is not None:
+                text.add("vitaminder_device_shard", "gauge", "Worker process the device is assigned to.", dev,
+                         device["shard"])
+        stats = supervisor.stats()
+        text.add("vitaminder_shards_alive", "gauge", "Shard worker processes running.", [], stats["alive"])
+        text.add("vitaminder_shard_deaths_total", "counter", "Shard worker processes that died.", [],
+                 stats["deaths"])
+        text.add("vitaminder_shard_devices_moved_total", "counter", "Devices handed to another shard worker.", [],
+                 stats["moved"])
+    return collect
@@ -0,0 +1,618 @@
+import errno
+import heapq
+import itertools
+import os
+import random
+import selectors
+import threading
+import time
+
+from hc_vitaminder_proto import MSG_REQ_HEARTBEAT, MSG_RSP_HEARTBEAT, MSG_REQ_SET_LED, MSG_RSP_SET_LED, \
+    MSG_BOOT, MSG_REQ_HELLO, MSG_REQ_SET_PIXELS, MSG_RSP_SET_PIXELS, MSG_REQ_HEARTBEAT_V2, \
+    MSG_RSP_HEARTBEAT_V2, MSG_SIZE, PIXEL_COUNT, SYS_PIX, VIT_PIX, REQUEST_SIZES, PROTO_V1, PROTO_V2, CAP_BATCH, \
+    crc8, seal, hello_response, button_frame
+
+# software model of hc-vitaminder-firmware.ino, so the host can be exercised without an
+# Arduino and an HC-05.  each simulated device sits behind a pseudo-terminal, hand the
+# slave side (port_name) to Vitaminder as its comm_port exactly like a real serial port.
+#
+#   python hc_vitaminder_sim.py --devices 50 --write-config sim.ini
+#   python hc_vitaminder.py --hub sim.ini
+
+DEFAULT_BRIGHTNESS = 128
+SOLITUDE_ERROR_SEC = 5 * 60
+# Stream.readBytes() gives up on a partial frame after the default 1000ms timeout
+READ_TIMEOUT_SEC = 1.0
+# the boot light show: 6 rounds of 250ms pink/black/pink
+BOOT_DELAY_SEC = 3.0
+
+
+class SimFirmware:
+    # the sketch's loop(), minus the hardware.  feed it host bytes, get device frames back.
+    # protocol=1 is the original sketch (HELLO goes unanswered), protocol=2 the current one
+    def __init__(self, solitude_sec=SOLITUDE_ERROR_SEC, protocol=PROTO_V2):
+        self.solitude_sec = solitude_sec
+        self.protocol = protocol
+        self.brightness = DEFAULT_BRIGHTNESS
+        self.pixels = [(0, 0, 0)] * PIXEL_COUNT
+        self.req = bytearray()
+        self.req_started = None
+        self.solitude_start = 0.0
+        self.solitude_error_state = False
+
+        self.frames_in = 0
+        self.partial_frames = 0
+        self.unknown_frames = 0
+        self.crc_errors = 0
+
+    def boot(self, now):
+        self.solitude_start = now
+        return bytes([MSG_BOOT] * MSG_SIZE)
+
+    def press(self, ok, snooze):
+        return button_frame(ok, snooze)
+
+    def pixel_echo(self, msg_id):
+        vit = self.pixels[VIT_PIX]
+        sys_ = self.pixels[SYS_PIX]
+        return bytes([msg_id, self.brightness, vit[0], vit[1], vit[2], sys_[0], sys_[1], sys_[2]])
+
+    def pixel_echo_v2(self, msg_id, seq):
+        return seal(bytes([msg_id, seq]) + self.pixel_echo(0)[1:])
+
+    def request_size(self, msg_id):
+        # the v2 sketch peeks at the ID to know how much to read
+        if self.protocol >= PROTO_V2:
+            return REQUEST_SIZES.get(msg_id, MSG_SIZE)
+        return MSG_SIZE
+
+    def clear_pixels(self):
+        self.pixels = [(0, 0, 0)] * PIXEL_COUNT
+
+    def have_contact(self, now):
+        if self.solitude_error_state:
+            self.clear_pixels()
+        self.solitude_start = now
+        self.solitude_error_state = False
+
+    def check_solitude(self, now):
+        if now - self.solitude_start > self.solitude_sec and not self.solitude_error_state:
+            self.solitude_error_state = True
+            self.clear_pixels()
+            self.pixels[SYS_PIX] = (255, 0, 0)
+            return True
+        return False
+
+    def receive(self, data, now):
+        # returns the response frames for whatever complete requests data finished
+        out = []
+        if self.req and now - self.req_started > READ_TIMEOUT_SEC:
+            # readBytes() timed out on the last one
+            self.partial_frames += 1
+            self.req.clear()
+
+        for b in data:
+            if not self.req:
+                self.req_started = now
+            self.req.append(b)
+            if len(self.req) == self.request_size(self.req[0]):
+                rsp = self.handle_request(bytes(self.req), now)
+                self.req.clear()
+                if rsp is not None:
+                    out.append(rsp)
+        return out
+
+    def handle_request(self, req, now):
+        self.frames_in += 1
+        if req[0] == MSG_REQ_HEARTBEAT:
+            self.have_contact(now)
+            return self.pixel_echo(MSG_RSP_HEARTBEAT)
+        elif req[0] == MSG_REQ_SET_LED:
+            self.have_contact(now)
+            self.brightness = req[1]
+            for i in range(PIXEL_COUNT):
+                if req[2] & (0x01 << i):
+                    self.pixels[i] = (req[3], req[4], req[5])
+            return self.pixel_echo(MSG_RSP_SET_LED)
+        elif self.protocol >= PROTO_V2 and req[0] in (MSG_REQ_HELLO, MSG_REQ_SET_PIXELS, MSG_REQ_HEARTBEAT_V2):
+            if crc8(req[:-1]) != req[-1]:
+                self.crc_errors += 1
+                return None
+            if req[0] == MSG_REQ_HELLO:
+                return hello_response(min(req[1], PROTO_V2), CAP_BATCH, PIXEL_COUNT)
+            self.have_contact(now)
+            if req[0] == MSG_REQ_SET_PIXELS:
+                self.brightness = req[2]
+                for i in range(PIXEL_COUNT):
+                    self.pixels[i] = (req[3 + 3 * i], req[4 + 3 * i], req[5 + 3 * i])
+                return self.pixel_echo_v2(MSG_RSP_SET_PIXELS, req[1])
+            return self.pixel_echo_v2(MSG_RSP_HEARTBEAT_V2, req[1])
+        self.unknown_frames += 1
+        return None
+
+
+class SimDevice:
+    def __init__(self, sim, index, latency=0.0, loss=0.0, baud=9600, script=None, press_every=None,
+                 boot_delay=BOOT_DELAY_SEC, solitude_sec=SOLITUDE_ERROR_SEC, protocol=PROTO_V2):
+        import pty
+        import tty
+
+        self.sim = sim
+        self.index = index
+        self.firmware = SimFirmware(solitude_sec=solitude_sec, protocol=protocol)
+        self.latency = latency
+        self.loss = loss
+        self.byte_sec = 10.0 / baud if baud else 0.0
+        self.script = list(script or [])
+        self.press_every = press_every
+        self.boot_delay = boot_delay
+
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        # we keep our own handle on the slave so the master never sees a hang-up when the
+        # host closes and reopens the port
+        self.port_name = os.ttyname(self.slave)
+
+        self.line_free_at = 0.0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.dropped_in = 0
+        self.dropped_out = 0
+        self.overflow = 0
+        self.presses = 0
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+    def lossy(self, data, direction):
+        if self.loss <= 0:
+            return data
+        rnd = self.sim.random
+        kept = bytes(b for b in data if rnd.random() >= self.loss)
+        if direction == "in":
+            self.dropped_in += len(data) - len(kept)
+        else:
+            self.dropped_out += len(data) - len(kept)
+        return kept
+
+    def start(self, now):
+        self.sim.call_at(now + self.boot_delay, self.on_boot)
+        for delay, ok, snooze in self.script:
+            self.sim.call_at(now + self.boot_delay + delay, self.on_press, ok, snooze)
+        if self.press_every:
+            self.sim.call_at(now + self.boot_delay + self.press_every, self.on_random_press)
+
+    def send(self, frame):
+        # the HC-05 link: latency, then the bytes take their time on a 9600 baud line
+        now = time.monotonic()
+        when = max(now + self.latency, self.line_free_at) + len(frame) * self.byte_sec
+        self.line_free_at = when
+        self.sim.call_at(when, self.deliver, frame)
+
+    def deliver(self, frame):
+        data = self.lossy(frame, "out")
+        try:
+            n = os.write(self.master, data)
+        except BlockingIOError:
+            n = 0
+        self.bytes_out += n
+        self.overflow += len(data) - n
+
+    def on_boot(self):
+        now = time.monotonic()
+        self.send(self.firmware.boot(now))
+        self.schedule_solitude_check()
+
+    def on_press(self, ok, snooze):
+        self.presses += 1
+        self.send(self.firmware.press(ok, snooze))
+
+    def on_random_press(self):
+        # mostly OK, sometimes snooze
+        rnd = self.sim.random
+        if rnd.random() < 0.7:
+            self.on_press(True, False)
+        else:
+            self.on_press(False, True)
+        self.sim.call_at(time.monotonic() + self.press_every, self.on_random_press)
+
+    def schedule_solitude_check(self):
+        self.sim.call_at(self.firmware.solitude_start + self.firmware.solitude_sec + 0.001, self.on_solitude_check)
+
+    def on_solitude_check(self):
+        now = time.monotonic()
+        if self.firmware.check_solitude(now) or self.firmware.solitude_error_state:
+            return
+        # contact since we scheduled this one, look again later
+        self.schedule_solitude_check()
+
+    def on_readable(self):
+        try:
+            data = os.read(self.master, 4096)
+        except (BlockingIOError, InterruptedError):
+            return
+        self.bytes_in += len(data)
+        now = time.monotonic()
+        was_error = self.firmware.solitude_error_state
+        for rsp in self.firmware.receive(self.lossy(data, "in"), now):
+            self.send(rsp)
+        if was_error and not self.firmware.solitude_error_state:
+            self.schedule_solitude_check()
+
+    def stats(self):
+        return {
+            "port": self.port_name,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "dropped_in": self.dropped_in,
+            "dropped_out": self.dropped_out,
+            "overflow": self.overflow,
+            "presses": self.presses,
+            "frames_in": self.firmware.frames_in,
+            "partial_frames": self.firmware.partial_frames,
+            "crc_errors": self.firmware.crc_errors,
+            "solitude_error": self.firmware.solitude_error_state,
+            "brightness": self.firmware.brightness,
+            "pixels": self.firmware.pixels,
+        }
+
+
+class VitSimulator:
+    # runs any number of SimDevices on one thread: a selector for host bytes and a heap for
+    # everything timed (boot, delayed responses, scripted presses, solitude checks)
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.devices = []
+        self.selector = selectors.DefaultSelector()
+        self.heap = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.alive = False
+        self.thread = None
+        # lets call_at() from another thread cut the current select() short
+        self.wake_r, self.wake_w = os.pipe()
+        os.set_blocking(self.wake_r, False)
+        os.set_blocking(self.wake_w, False)
+        self.selector.register(self.wake_r, selectors.EVENT_READ, None)
+
+    def add_device(self, **kwargs):
+        dev = SimDevice(self, len(self.devices), **kwargs)
+        self.devices.append(dev)
+        self.selector.register(dev.master, selectors.EVENT_READ, dev)
+        if self.alive:
+            dev.start(time.monotonic())
+        return dev
+
+    def call_at(self, when, callback, *args):
+        with self.lock:
+            heapq.heappush(self.heap, (when, next(self.counter), callback, args))
+        if self.thread is not None and threading.current_thread() is not self.thread:
+            try:
+                os.write(self.wake_w, b"x")
+            except BlockingIOError:
+                pass
+
+    def press(self, index, ok=True, snooze=False):
+        # scripted press from the outside (load tests)
+        self.call_at(time.monotonic(), self.devices[index].on_press, ok, snooze)
+
+    def run(self):
+        while self.alive:
+            with self.lock:
+                timeout = None
+                if self.heap:
+                    timeout = max(0.0, self.heap[0][0] - time.monotonic())
+            for key, _ in self.selector.select(timeout=0.5 if timeout is None else min(timeout, 0.5)):
+                if key.data is None:
+                    try:
+                        os.read(self.wake_r, 4096)
+                    except BlockingIOError:
+                        pass
+                else:
+                    key.data.on_readable()
+
+            now = time.monotonic()
+            while True:
+                with self.lock:
+                    if not self.heap or self.heap[0][0] > now:
+                        break
+                    _, _, callback, args = heapq.heappop(self.heap)
+                callback(*args)
+
+    def start(self):
+        self.alive = True
+        now = time.monotonic()
+        for dev in self.devices:
+            dev.start(now)
+        self.thread = threading.Thread(target=self.run, name="vit-sim", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.alive = False
+        try:
+            os.write(self.wake_w, b"x")
+        except BlockingIOError:
+            pass
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):
+        self.stop()
+        for dev in self.devices:
+            self.selector.unregister(dev.master)
+            dev.close()
+        self.selector.unregister(self.wake_r)
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+    def stats(self):
+        return [dev.stats() for dev in self.devices]
+
+
+class LoopbackSerial:
+    # in-memory stand-in for serial.Serial wired straight to a SimFirmware: no pty, no
+    # latency, no line speed.  good for measuring the host on its own (see hc_vitaminder_bench.py)
+    def __init__(self, firmware=None, timeout=1, on_write=None):
+        self.firmware = firmware if firmware is not None else SimFirmware()
+        self.timeout = timeout
+        self.on_write = on_write
+        self.rx = bytearray()
+        self.cond = threading.Condition()
+        self.is_open = True
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+    def inject(self, data):
+        # bytes "from the device"
+        with self.cond:
+            self.rx += data
+            self.cond.notify_all()
+
+    @property
+    def in_waiting(self):
+        return len(self.rx)
+
+    def read(self, size=1):
+        with self.cond:
+            if len(self.rx) < size and self.is_open:
+                deadline = None if self.timeout is None else time.monotonic() + self.timeout
+                while len(self.rx) < size and self.is_open:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            data = bytes(self.rx[:size])
+            del self.rx[:size]
+            self.bytes_read += len(data)
+            return data
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        if self.on_write is not None:
+            self.on_write(data)
+        for rsp in self.firmware.receive(data, time.monotonic()):
+            self.inject(rsp)
+        return len(data)
+
+    def isOpen(self):
+        return self.is_open
+
+    def close(self):
+        with self.cond:
+            self.is_open = False
+            self.cond.notify_all()
+
+
+class LoopbackHost:
+    # a Vitaminder in this process driving a simulated device over a LoopbackSerial, on the
+    # threads the daemon would give it: controller, serial reader and a scheduler for its
+    # timers.  the benchmarks and the tests all run the host this way
+    #
+    # port: the port to use instead of a fresh LoopbackSerial (a CaptureSerial, ...)
+    # open_port: connect through this instead (FlakyLink.open), reconnects go through it too
+    # timers: False leaves the scheduler out, start_clock: False attaches it without the clock
+    # (no state from the time of day, no heartbeats).  mode "async" runs controller and reader
+    # on an asyncio loop on one thread.  change v as needed between the constructor and start()
+    def __init__(self, config, firmware=None, port=None, open_port=None, on_write=None, timeout=0.05,
+                 clock=None, timers=True, start_clock=True, mode="threads"):
+        from hc_vitaminder import Vitaminder
+        from hc_vitaminder_sched import VitScheduler
+
+        self.firmware = firmware if firmware is not None else SimFirmware()
+        self.v = Vitaminder(config=config) if clock is None else Vitaminder(config=config, clock=clock)
+        if open_port is not None:
+            self.v.open_port = open_port
+            self.v.connect()
+        else:
+            self.v.serial_port = port if port is not None else LoopbackSerial(self.firmware, timeout, on_write)
+        self.scheduler = None
+        if timers:
+            self.scheduler = VitScheduler() if clock is None else VitScheduler(clock=clock)
+        self.start_clock = start_clock
+        self.mode = mode
+        self.threads = []
+
+    @property
+    def port(self):
+        return self.v.serial_port
+
+    def start(self):
+        v = self.v
+        if self.mode == "async":
+            import asyncio
+
+            async def run():
+                if self.scheduler is not None:
+                    self.scheduler.attach_loop(asyncio.get_running_loop())
+                await v.run_async(timers=False)
+            self.threads.append(threading.Thread(target=asyncio.run, args=(run(),)))
+        else:
+            self.threads += [threading.Thread(target=v.ctl_thread), threading.Thread(target=v.serial_read_thread)]
+        if self.scheduler is not None:
+            self.threads.append(threading.Thread(target=self.scheduler.run))
+        for t in self.threads:
+            t.start()
+        if self.mode == "async":
+            self.wait_for(lambda: v.loop is not None)
+        if self.scheduler is not None:
+            if self.start_clock:
+                v.start_clock(self.scheduler)
+            else:
+                v.scheduler = self.scheduler
+        return self
+
+    def wait_for(self, predicate, timeout=1.0, poll=0.0005):
+        # True once predicate() holds, False when timeout seconds went by first
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(poll)
+        return True
+
+    def press(self, ok=True, snooze=False):
+        # a button press "from the device"
+        self.port.inject(self.firmware.press(ok, snooze))
+
+    def alive(self):
+        return all(t.is_alive() for t in self.threads)
+
+    def stop(self, timeout=5.0):
+        from hc_vitaminder import VitEvent, VitMsg
+
+        self.v.add_event(VitEvent(VitMsg.EXIT))
+        host_threads = self.threads[:-1] if self.scheduler is not None else self.threads
+        for t in host_threads:
+            t.join(timeout)
+        if self.scheduler is not None:
+            self.scheduler.stop()
+            self.threads[-1].join(timeout)
+
+
+class FlakyLink:
+    # a bluetooth link that drops on purpose.  open() hands out LoopbackSerial ports onto the
+    # one firmware; cut() makes every open port fail reads and writes with EIO, the way a
+    # dropped rfcomm link does, and open() fails until restore()
+    def __init__(self, firmware=None, timeout=1, on_write=None):
+        self.firmware = firmware if firmware is not None else SimFirmware()
+        self.timeout = timeout
+        self.on_write = on_write
+        self.up = True
+        self.ports = []
+        self.lock = threading.Lock()
+
+        self.opens = 0
+        self.failed_opens = 0
+        self.cuts = 0
+
+    def open(self):
+        with self.lock:
+            if not self.up:
+                self.failed_opens += 1
+                raise OSError(errno.EHOSTDOWN, "could not open port: link down")
+            self.opens += 1
+            port = FlakySerial(self, self.firmware, self.timeout, self.on_write)
+            self.ports.append(port)
+            return port
+
+    def cut(self):
+        with self.lock:
+            self.up = False
+            self.cuts += 1
+            ports, self.ports = self.ports, []
+        for port in ports:
+            port.fail()
+
+    def restore(self):
+        with self.lock:
+            self.up = True
+
+
+class FlakySerial(LoopbackSerial):
+    def __init__(self, link, firmware, timeout, on_write):
+        LoopbackSerial.__init__(self, firmware, timeout, on_write)
+        self.link = link
+        self.failed = False
+
+    def fail(self):
+        with self.cond:
+            self.failed = True
+            self.cond.notify_all()
+
+    @property
+    def in_waiting(self):
+        if self.failed:
+            raise OSError(errno.EIO, "Input/output error")
+        return len(self.rx)
+
+    def read(self, size=1):
+        with self.cond:
+            if len(self.rx) < size:
+                self.cond.wait_for(lambda: self.failed or len(self.rx) >= size or not self.is_open, self.timeout)
+            if self.failed:
+                raise OSError(errno.EIO, "Input/output error")
+            data = bytes(self.rx[:size])
+            del self.rx[:size]
+            self.bytes_read += len(data)
+            return data
+
+    def write(self, data):
+        if self.failed:
+            raise OSError(errno.EIO, "Input/output error")
+        return LoopbackSerial.write(self, data)
+
+
+def write_hub_config(sim, base_config, out_file):
+    import configparser
+
+    configuration = configparser.ConfigParser()
+    configuration.read(base_config)
+    for dev in sim.devices:
+        configuration["sim%d" % dev.index] = {"comm_port": dev.port_name}
+    with open(out_file, "w") as f:
+        configuration.write(f)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Simulated vitaminder devices on pseudo-terminals")
+    parser.add_argument("--devices", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds before each device frame goes out")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability of losing each byte, both directions")
+    parser.add_argument("--baud", type=int, default=9600, help="0 for an infinitely fast line")
+    parser.add_argument("--press-every", type=float, default=None, help="random button press every N seconds")
+    parser.add_argument("--boot-delay", type=float, default=BOOT_DELAY_SEC)
+    parser.add_argument("--solitude-sec", type=float, default=SOLITUDE_ERROR_SEC)
+    parser.add_argument("--protocol", type=int, default=PROTO_V2, choices=[PROTO_V1, PROTO_V2],
+                        help="firmware generation to simulate, 1 ignores HELLO")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--config", default="hc-vitaminder.ini", help="base config for --write-config")
+    parser.add_argument("--write-config", default=None, help="write a hub config listing every simulated port")
+    args = parser.parse_args()
+
+    simulator = VitSimulator(seed=args.seed)
+    for _ in range(args.devices):
+        simulator.add_device(latency=args.latency, loss=args.loss, baud=args.baud, press_every=args.press_every,
+                             boot_delay=args.boot_delay, solitude_sec=args.solitude_sec, protocol=args.protocol)
+
+    for d in simulator.devices:
+        print("sim%d %s" % (d.index, d.port_name))
+    if args.write_config is not None:
+        write_hub_config(simulator, args.config, args.write_config)
+        print("hub config written to", args.write_config)
+
+    simulator.start()
+    try:
+        while True:
+            time.sleep(10)
+            frames = sum(d.firmware.frames_in for d in simulator.devices)
+            errors = sum(1 for d in simulator.devices if d.firmware.solitude_error_state)
+            print("frames in:", frames, "devices in solitude error:", errors)
+    except KeyboardInterrupt:
+        pass
+    simulator.close()
@@ -0,0 +1,103 @@
+import logging
+import os
+from time import perf_counter
+
+log = logging.getLogger("hc_vitaminder")
+
+# bump whenever VitConfig (or anything it holds) changes shape, old snapshots are then rebuilt
+SNAPSHOT_VERSION = 3
+
+# the modules whose classes end up in the pickled VitConfig or whose code computed what it
+# holds (led frames, compiled rules, retry spans).  editing any of them invalidates the snapshot
+SNAPSHOT_MODULES = ("hc_vitaminder.py", "hc_vitaminder_anim.py", "hc_vitaminder_liveness.py",
+                    "hc_vitaminder_proto.py", "hc_vitaminder_rules.py", "hc_vitaminder_startup.py")
+
+
+class StartupProfile:
+    # where the time goes between starting python and the device getting its first frame.
+    # mark(name) closes the phase that started at the previous mark, the first mark should be
+    # taken before the heavy imports (the top of the main module)
+    def __init__(self, started=None):
+        self.started = perf_counter() if started is None else started
+        self.last = self.started
+        self.phases = []
+        self.reported = False
+
+    def mark(self, name, now=None):
+        if now is None:
+            now = perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def interpreter_sec(self):
+        # python's own start up to self.started, linux only, in clock ticks (usually 10 ms)
+        try:
+            with open("/proc/self/stat") as f:
+                # the command name may hold spaces, the fields after it don't
+                fields = f.read().rsplit(")", 1)[1].split()
+            with open("/proc/uptime") as f:
+                uptime = float(f.read().split()[0])
+        except (OSError, IndexError, ValueError):
+            return None
+        age = uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK")
+        return max(0.0, age - (perf_counter() - self.started))
+
+    def report(self):
+        # logs the phases once, returns them as {name: seconds}
+        if self.reported:
+            return None
+        self.reported = True
+        phases = list(self.phases)
+        interpreter = self.interpreter_sec()
+        if interpreter is not None:
+            phases.insert(0, ("interpreter", interpreter))
+        total = sum(sec for _, sec in phases)
+        log.info("startup: %s, total %.1f ms",
+                 ", ".join("%s %.1f ms" % (name, 1000.0 * sec) for name, sec in phases), 1000.0 * total)
+        return dict(phases)
+
+
+def snapshot_path(config_file):
+    return config_file + ".snapshot"
+
+
+def snapshot_key(config_file):
+    # the snapshot is only good for this exact config file and this code
+    st = os.stat(config_file)
+    here = os.path.dirname(os.path.abspath(__file__))
+    code = tuple(os.stat(os.path.join(here, name)).st_mtime_ns for name in SNAPSHOT_MODULES)
+    return SNAPSHOT_VERSION, os.path.abspath(config_file), st.st_mtime_ns, st.st_size, code
+
+
+def load_config_snapshot(config_file):
+    # the compiled VitConfig for the [DEFAULT] section, None when there is no usable snapshot.
+    # skips configparser and all the string parsing, one small file read instead
+    import pickle
+
+    try:
+        key = snapshot_key(config_file)
+        with open(snapshot_path(config_file), "rb") as f:
+            saved_key, cfg = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError, TypeError) as e:
+        log.info("config snapshot not usable, reading the config: %s", e)
+        return None
+    if saved_key != key:
+        log.info("config changed since the snapshot, reading the config")
+        return None
+    return cfg
+
+
+def save_config_snapshot(config_file, cfg):
+    import pickle
+
+    path = snapshot_path(config_file)
+    tmp = path + ".tmp"
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump((snapshot_key(config_file), cfg), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError as e:
+        # a read-only config dir just means no snapshot, next start reads the config again
+        log.info("config snapshot not saved: %s", e)
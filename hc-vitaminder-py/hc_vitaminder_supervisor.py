@@ -0,0 +1,139 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from hc_vitaminder_metrics import Histogram
+from hc_vitaminder_proto import MSG_REQ_SET_LED, MSG_REQ_SET_PIXELS, PIXEL_COUNT
+
+log = logging.getLogger("hc_vitaminder")
+
+# link outages last anywhere from a blip to the device being out of range all evening
+RECOVERY_BOUNDS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 3600.0)
+
+ALL_PIXELS = (1 << PIXEL_COUNT) - 1
+
+
+class Backoff:
+    # exponential, capped, with jitter so a hub full of devices behind one flaky adapter
+    # doesn't hammer it in lockstep: each delay is drawn from [1 - jitter, 1] of the nominal one
+    def __init__(self, initial=0.5, maximum=30.0, factor=2.0, jitter=0.5, rng=None):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.rng = rng if rng is not None else random.Random()
+        self.attempt = 0
+
+    def next(self):
+        delay = min(self.maximum, self.initial * self.factor ** self.attempt)
+        self.attempt += 1
+        return delay * (1.0 - self.jitter * self.rng.random())
+
+    def reset(self):
+        self.attempt = 0
+
+
+def led_mask(frame):
+    # pixels a set-LED frame paints, None for anything else
+    if frame[0] == MSG_REQ_SET_PIXELS:
+        return ALL_PIXELS
+    if frame[0] == MSG_REQ_SET_LED:
+        return frame[2] & ALL_PIXELS
+    return None
+
+
+class VitLinkSupervisor:
+    # link state of one device: up, or down since when
+    #
+    # the serial reader (thread or task) reports a dead port with lost(), then keeps asking
+    # next_delay() how long to wait before trying to open it again, and calls recovered()
+    # once that worked.  writes made while the link is down go to hold(): set-LED frames are
+    # kept in a small bounded outbox where a newer frame replaces the older ones it paints
+    # over, so after the reconnect the device only gets the current state, not the evening's
+    # history.  heartbeats and the like are dropped, they would only be stale by then.
+    def __init__(self, backoff=None, outbox_size=8, clock=time.monotonic):
+        self.backoff = backoff if backoff is not None else Backoff()
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.up = True
+        self.down_since = None
+        self.last_error = None
+        self.outbox = deque(maxlen=outbox_size)
+
+        self.losses = 0
+        self.attempts = 0
+        self.recoveries = 0
+        self.held = 0
+        self.superseded = 0
+        self.dropped = 0
+        self.recovery = Histogram(RECOVERY_BOUNDS)
+
+    def lost(self, error):
+        # True for the report that took the link down, later ones (the other thread noticing) are ignored
+        with self.lock:
+            if not self.up:
+                return False
+            self.up = False
+            self.down_since = self.clock()
+            self.last_error = error
+            self.losses += 1
+            self.backoff.reset()
+            return True
+
+    def next_delay(self):
+        self.attempts += 1
+        return self.backoff.next()
+
+    def recovered(self):
+        # seconds the link was down, None when it wasn't
+        with self.lock:
+            if self.up:
+                return None
+            self.up = True
+            downtime = self.clock() - self.down_since
+            self.down_since = None
+            self.recoveries += 1
+            self.recovery.observe(downtime)
+            return downtime
+
+    def hold(self, frame):
+        mask = led_mask(frame)
+        with self.lock:
+            if mask is None:
+                self.dropped += 1
+                return
+            kept = deque(maxlen=self.outbox.maxlen)
+            for old in self.outbox:
+                if led_mask(old) & ~mask:
+                    kept.append(old)
+                else:
+                    self.superseded += 1
+            if len(kept) == kept.maxlen:
+                self.dropped += 1
+            kept.append(frame)
+            self.outbox = kept
+            self.held += 1
+
+    def take_held(self):
+        with self.lock:
+            frames = list(self.outbox)
+            self.outbox.clear()
+            return frames
+
+    def down_for(self):
+        with self.lock:
+            return None if self.up else self.clock() - self.down_since
+
+    def stats(self):
+        return {
+            "up": self.up,
+            "losses": self.losses,
+            "attempts": self.attempts,
+            "recoveries": self.recoveries,
+            "held": self.held,
+            "superseded": self.superseded,
+            "dropped": self.dropped,
+            "recovery": self.recovery.stats(),
+        }
@@ -0,0 +1,258 @@
+import argparse
+import configparser
+import json
+import logging
+import random
+import time
+from datetime import datetime, date, timedelta
+
+from hc_vitaminder import Vitaminder, VitEvent, VitMsg, VitState
+from hc_vitaminder_rules import week_us
+from hc_vitaminder_sched import VitScheduler
+from hc_vitaminder_sim import SimFirmware
+
+log = logging.getLogger("hc_vitaminder")
+
+# accelerated time: months of schedule against a real Vitaminder in seconds
+#
+# the device's clock and its scheduler run on a VirtualClock, which only moves when the
+# simulation jumps it to the next timer.  between jumps every queued event is handled on this
+# one thread, and the simulated firmware answers each frame on the spot.  so the controller,
+# the rules, the decoder and the request tracker are all the real ones, only waiting is skipped.
+#
+#   python hc_vitaminder_timesim.py --days 365 --press "19:05 snooze" --press "19:30 ok"
+
+def local_midnight(day):
+    # epoch seconds of the day's local midnight.  days aren't all 86400 s long, the ones a DST
+    # change falls on are an hour longer or shorter
+    return datetime.combine(day, datetime.min.time()).timestamp()
+
+
+class VirtualClock:
+    # epoch seconds that only move when told to, pass it as clock= (it is callable)
+    def __init__(self, start):
+        self.now = float(start)
+
+    def __call__(self):
+        return self.now
+
+    def advance_to(self, when):
+        # never backwards, a timer that is already due fires at the current time
+        if when > self.now:
+            self.now = when
+
+
+class DirectSerial:
+    # a port whose device answers as soon as it is written to: the firmware's responses go
+    # straight into the Vitaminder's decoder (and from there onto its queue)
+    def __init__(self, v, firmware, clock):
+        self.v = v
+        self.firmware = firmware
+        self.clock = clock
+        self.is_open = True
+        self.frames_written = 0
+
+    def write(self, data):
+        self.frames_written += 1
+        for rsp in self.firmware.receive(data, self.clock()):
+            self.v.handle_serial_bytes(rsp)
+        return len(data)
+
+    def isOpen(self):
+        return self.is_open
+
+    def close(self):
+        self.is_open = False
+
+
+def parse_press(value):
+    # "HH:MM[:SS] ok|snooze" -> (seconds after midnight, ok, snooze)
+    when, _, button = value.strip().partition(" ")
+    parts = [int(p) for p in when.split(":")]
+    seconds = parts[0] * 3600 + parts[1] * 60 + (parts[2] if len(parts) > 2 else 0)
+    button = button.strip().lower()
+    if button not in ("ok", "snooze"):
+        raise ValueError("press %r: the button is ok or snooze" % value)
+    return seconds, button == "ok", button == "snooze"
+
+
+def sim_config(config, animate=False):
+    # the device with its journal off and, unless asked for, no blinking: a blink keyframe a
+    # second all evening would be most of the work and tells nothing about the schedule
+    section = config
+    section["comm_port"] = "timesim"
+    section["journal_dir"] = ""
+    if not animate:
+        for key in ("unmedicated", "nailed_it", "soft_reminder", "hard_reminder", "snooze"):
+            section["pattern_" + key] = "solid"
+    return section
+
+
+class DaySimulation:
+    # presses: [(seconds after midnight, ok, snooze)] pressed every day, each moved by up to
+    # jitter_sec either way and the whole day's presses left out with skip_prob (a forgotten day)
+    def __init__(self, config, days, start=None, presses=(), jitter_sec=0.0, skip_prob=0.0, seed=None):
+        self.start_day = start if start is not None else date.today()
+        self.start = local_midnight(self.start_day)
+        self.end = local_midnight(self.start_day + timedelta(days=days))
+        self.days = days
+        self.presses = sorted(presses)
+        self.jitter_sec = jitter_sec
+        self.skip_prob = skip_prob
+        self.rng = random.Random(seed)
+
+        self.clock = VirtualClock(self.start)
+        self.scheduler = VitScheduler(clock=self.clock)
+        self.v = Vitaminder(config=config, clock=self.clock)
+        # the link's byte budget fills up with virtual time too, or --animate starves
+        self.v.link_budget.clock = self.clock
+        self.v.link_budget.updated = self.clock()
+        self.firmware = SimFirmware(solitude_sec=self.v.cfg.device_solitude_sec)
+        self.firmware.have_contact(self.start)
+        self.port = DirectSerial(self.v, self.firmware, self.clock)
+        self.v.serial_port = self.port
+
+        self.transitions = []
+        self.off_schedule = []
+        self.pressed = 0
+        self.skipped_days = 0
+        self.events = 0
+        self.solitude_errors = 0
+
+    def plan_day(self, day):
+        # the day's presses go on the scheduler at its start, so the heap stays one day deep.
+        # press times are local wall clock times on the day, whatever DST does to it
+        midnight = datetime.combine(day, datetime.min.time())
+        next_day = day + timedelta(days=1)
+        if local_midnight(next_day) < self.end:
+            self.scheduler.call_at(local_midnight(next_day), self.plan_day, next_day)
+        if self.presses and self.rng.random() < self.skip_prob:
+            self.skipped_days += 1
+            return
+        for seconds, ok, snooze in self.presses:
+            offset = self.rng.uniform(-self.jitter_sec, self.jitter_sec) if self.jitter_sec else 0.0
+            when = (midnight + timedelta(seconds=seconds)).timestamp()
+            self.scheduler.call_at(when + offset, self.press, ok, snooze)
+
+    def press(self, ok, snooze):
+        self.pressed += 1
+        self.v.handle_serial_bytes(self.firmware.press(ok, snooze))
+
+    def on_schedule(self, now, snooze_expiration):
+        # a transition nobody pressed for has to land exactly on a window edge, the end of a
+        # snooze or midnight, anything else means the boundary scheduling went wrong.  right after
+        # the clocks go forward, an edge in the skipped hour (02:30 on that night) lands here too
+        when = datetime.fromtimestamp(now)
+        if when.time() == datetime.min.time() or when == snooze_expiration:
+            return True
+        starts = self.v.cfg.rules.starts
+        before = datetime.fromtimestamp(now - 1)
+        if when - before > timedelta(seconds=1):
+            return any(week_us(before) < start <= week_us(when) for start in starts)
+        return week_us(when) in starts
+
+    def drain(self):
+        v = self.v
+        while True:
+            e = v.msg_queue.get(block=False)
+            if e is None:
+                return
+            before = v.state
+            snooze_expiration = v.snooze_expiration
+            v.handle_event(e)
+            self.events += 1
+            if v.state != before:
+                now = self.clock()
+                self.transitions.append((now, before, v.state, e.event_id))
+                if e.event_id == VitMsg.CLOCK and not self.on_schedule(now, snooze_expiration):
+                    self.off_schedule.append((now, before, v.state))
+
+    def run(self):
+        self.v.start_clock(self.scheduler)
+        self.plan_day(self.start_day)
+
+        t0 = time.perf_counter()
+        while True:
+            self.drain()
+            when = self.scheduler.next_due()
+            if when is None or when >= self.end:
+                break
+            self.clock.advance_to(when)
+            # the device went this long without a request, a red sys LED if that was too long
+            if self.firmware.check_solitude(self.clock()):
+                self.solitude_errors += 1
+            self.scheduler.run_due(self.clock())
+        self.v.add_event(VitEvent(VitMsg.EXIT))
+        self.drain()
+        return time.perf_counter() - t0
+
+    def report(self, wall_sec):
+        by_time = {}
+        for now, before, after, event_id in self.transitions:
+            key = "%s -> %s" % (before.name, after.name)
+            when = datetime.fromtimestamp(now).strftime("%H:%M:%S")
+            counts = by_time.setdefault(key, {})
+            counts[when] = counts.get(when, 0) + 1
+        return {
+            "days": self.days,
+            "wall_sec": wall_sec,
+            "days_per_sec": self.days / wall_sec if wall_sec else 0.0,
+            "events": self.events,
+            "events_per_sec": self.events / wall_sec if wall_sec else 0.0,
+            "frames_out": self.port.frames_written,
+            "presses": self.pressed,
+            "skipped_days": self.skipped_days,
+            "transitions": len(self.transitions),
+            "off_schedule": len(self.off_schedule),
+            "solitude_errors": self.solitude_errors,
+            "liveness": {k: v for k, v in self.v.liveness.stats().items() if k != "quiet_gaps"},
+            "nailed_days": sum(1 for _, _, after, _ in self.transitions if after == VitState.NAILED_IT),
+            "transition_times": by_time,
+        }
+
+
+def print_report(result, top=4):
+    print("%(days)d days in %(wall_sec).2f s: %(days_per_sec).0f days/s, %(events_per_sec).0f events/s, "
+          "%(transitions)d transitions, %(off_schedule)d off schedule, %(presses)d presses, "
+          "%(solitude_errors)d solitude errors" % result)
+    print("  heartbeats: %(heartbeats_sent)d sent, %(piggybacked)d covered by other answers, %(heartbeats_saved)d "
+          "saved and %(heartbeats_extra)d extra against the fixed schedule (%(airtime_saved_sec).1f s airtime "
+          "saved), longest quiet %(longest_quiet).0f s"
+          % result["liveness"])
+    for key, counts in sorted(result["transition_times"].items()):
+        common = sorted(counts.items(), key=lambda kv: (-kv[1], kv[0]))[:top]
+        print("  %-32s %s" % (key, "  ".join("%s x%d" % kv for kv in common)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a Vitaminder's schedule through months of virtual time")
+    parser.add_argument("--config", default="hc-vitaminder.ini")
+    parser.add_argument("--section", default="DEFAULT", help="config section of the device to simulate")
+    parser.add_argument("--days", type=int, default=90)
+    parser.add_argument("--start", default=None, help="first day, YYYY-MM-DD (default today)")
+    parser.add_argument("--press", action="append", default=[], metavar='"HH:MM[:SS] ok|snooze"',
+                        help="a button press every day, can be given more than once")
+    parser.add_argument("--jitter-min", type=float, default=0.0, help="move each press by up to this many minutes")
+    parser.add_argument("--skip-prob", type=float, default=0.0, help="chance of a day without any presses")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--animate", action="store_true", help="keep the LED patterns (slow, a keyframe each blink)")
+    parser.add_argument("--journal-dir", default="", help="write the device's journal here, for the analytics")
+    parser.add_argument("--json", default=None, help="also write the report to this json file")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+
+    configuration = configparser.ConfigParser()
+    configuration.read(args.config)
+    section = sim_config(configuration[args.section], args.animate)
+    if args.journal_dir:
+        section["journal_dir"] = args.journal_dir
+
+    sim = DaySimulation(section, args.days,
+                        start=date.fromisoformat(args.start) if args.start else None,
+                        presses=[parse_press(p) for p in args.press],
+                        jitter_sec=60.0 * args.jitter_min, skip_prob=args.skip_prob, seed=args.seed)
+    result = sim.report(sim.run())
+    print_report(result)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
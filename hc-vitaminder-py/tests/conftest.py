@@ -0,0 +1,52 @@
+import configparser
+import os
+import sys
+import time
+from datetime import datetime
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+# the modules are scripts next to each other, not a package
+sys.path.insert(0, ROOT)
+
+# a Monday evening, a hard reminder with the shipped schedule
+EVENING = datetime(2026, 1, 5, 20, 0)
+
+
+class RunningClock:
+    # wall clock seconds that start at a fixed moment and run at real speed, so tests don't
+    # depend on the time of day they run at.  jump() moves it on (a day, to the next window ...)
+    def __init__(self, start=EVENING):
+        self.start = start.timestamp()
+        self.t0 = time.monotonic()
+        self.offset = 0.0
+
+    def __call__(self):
+        return self.start + self.offset + time.monotonic() - self.t0
+
+    def jump(self, seconds):
+        self.offset += seconds
+
+
+def load_section(**overrides):
+    # the shipped config's DEFAULT section on a loopback port, without a journal
+    configuration = configparser.ConfigParser()
+    configuration.read(os.path.join(ROOT, "hc-vitaminder.ini"))
+    section = configuration["DEFAULT"]
+    section["comm_port"] = "loopback"
+    section["journal_dir"] = ""
+    for key, value in overrides.items():
+        section[key] = str(value)
+    return section
+
+
+@pytest.fixture
+def section():
+    return load_section()
+
+
+@pytest.fixture
+def clock():
+    return RunningClock()
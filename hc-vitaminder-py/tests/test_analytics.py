@@ -0,0 +1,77 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from hc_vitaminder import VitState
+from hc_vitaminder_analytics import JOURNAL_DTYPE, History, report
+from hc_vitaminder_journal import VitJournal, REC_BUTTON, REC_TRANSITION, BUTTON_SNOOZE
+
+MONDAY = 739621
+EVENING = 1767639600.0
+
+
+def history(rows, names=("dev",)):
+    # rows: (device, ts, day, kind, state, detail)
+    records = np.zeros(len(rows), dtype=JOURNAL_DTYPE)
+    for i, (_, ts, day, kind, state, detail) in enumerate(rows):
+        records[i] = (ts, day, kind, state, detail, 0, 0.0)
+    device = np.array([row[0] for row in rows], dtype=np.int32)
+    return History.from_records(list(names), device, records)
+
+
+def day_rows(device, day, soft_at, nailed_at, prev=VitState.SOFT_REMINDER):
+    return [(device, soft_at, day, REC_TRANSITION, VitState.SOFT_REMINDER.value, VitState.UNMEDICATED.value),
+            (device, nailed_at, day, REC_TRANSITION, VitState.NAILED_IT.value, prev.value)]
+
+
+def test_report_over_two_devices():
+    rows = []
+    for i in range(3):
+        rows += day_rows(0, MONDAY + i, EVENING + i * 86400, EVENING + i * 86400 + 600)
+    rows += day_rows(1, MONDAY, EVENING, EVENING + 1200, prev=VitState.HARD_REMINDER)
+    rows.append((1, EVENING + 60, MONDAY, REC_BUTTON, VitState.SNOOZE.value, BUTTON_SNOOZE))
+    result = report(history(rows, ("a", "b")))
+
+    assert result["device_days"] == 4
+    assert result["on_time_rate"] == 0.75
+    assert result["soft_to_nailed_count"] == 4
+    assert result["soft_to_nailed_median_min"] == 10.0
+    assert result["snoozes_by_device"] == {"a": 0, "b": 1}
+    assert result["longest_streak_by_device"] == {"a": 3, "b": 1}
+
+
+def test_clock_stepping_back_across_midnight():
+    # tuesday's soft reminder, then NTP puts the clock back into monday evening for a while
+    rows = day_rows(0, MONDAY, EVENING, EVENING + 600)
+    rows.append((0, EVENING + 86400, MONDAY + 1, REC_TRANSITION, VitState.SOFT_REMINDER.value,
+                 VitState.UNMEDICATED.value))
+    rows.append((0, EVENING + 900, MONDAY, REC_BUTTON, VitState.NAILED_IT.value, 0))
+    rows.append((0, EVENING + 86400 + 300, MONDAY + 1, REC_TRANSITION, VitState.NAILED_IT.value,
+                 VitState.SOFT_REMINDER.value))
+    result = report(history(rows))
+
+    assert result["device_days"] == 2
+    assert result["on_time_rate"] == 1.0
+    assert result["soft_to_nailed_count"] == 2
+    assert result["soft_to_nailed_median_min"] == 7.5
+    assert result["longest_streak_days"] == 2
+
+
+def test_report_from_journal_files(tmp_path):
+    from hc_vitaminder_analytics import load_history
+
+    path = str(tmp_path / "dev.journal")
+    journal = VitJournal(path, max_records=3)
+    journal.open()
+    for i in range(4):
+        day = MONDAY + i
+        journal.append(REC_TRANSITION, VitState.SOFT_REMINDER.value, VitState.UNMEDICATED.value, day, 0.0,
+                       ts=EVENING + i * 86400)
+        journal.append(REC_TRANSITION, VitState.NAILED_IT.value, VitState.SOFT_REMINDER.value, day, 0.0,
+                       ts=EVENING + i * 86400 + 120)
+    journal.close()
+
+    result = report(load_history([("dev", path)]))
+    assert result["events"] == 8
+    assert result["longest_streak_days"] == 4
+    assert result["soft_to_nailed_median_min"] == 2.0
@@ -0,0 +1,65 @@
+import threading
+import time
+
+from hc_vitaminder import VitEvent, VitMsg, VitState
+from hc_vitaminder_sim import LoopbackHost
+
+from conftest import load_section
+
+PULSE = {"pattern_hard_reminder": "pulse", "pattern_period_ms_hard_reminder": "1000", "anim_max_fps": "20"}
+
+
+def animate(clock, duration, heartbeat_interval=0.0):
+    # the pulse from bench anim: returns the host and the times set-LED frames hit the wire
+    writes = []
+
+    def on_write(data):
+        if data[0] in (0x02, 0x0A):
+            writes.append(time.perf_counter())
+
+    host = LoopbackHost(load_section(**PULSE), on_write=on_write, clock=clock, start_clock=False).start()
+    v = host.v
+    stop = threading.Event()
+
+    def heartbeats():
+        while not stop.wait(heartbeat_interval):
+            v.add_event(VitEvent(VitMsg.HEARTBEAT, True))
+
+    noise = threading.Thread(target=heartbeats)
+    try:
+        if heartbeat_interval:
+            noise.start()
+        v.state = VitState.HARD_REMINDER
+        v.add_event(VitEvent(VitMsg.STATE))
+        time.sleep(duration)
+    finally:
+        stop.set()
+        if noise.is_alive():
+            noise.join()
+        host.stop()
+    return host, writes
+
+
+def test_pulse_keyframes_are_on_time(clock):
+    host, writes = animate(clock, 1.5)
+    animator = host.v.animator
+    assert animator.level == 0
+    assert animator.dropped == 0
+    lateness = animator.lateness.stats()
+    assert lateness["count"] >= 20
+    assert lateness["max"] < 0.025
+
+    # 20 fps, so a keyframe every 50 ms
+    intervals = sorted(b - a for a, b in zip(writes, writes[1:]))
+    assert len(intervals) >= 20
+    assert abs(intervals[len(intervals) // 2] - 0.05) < 0.005
+    assert intervals[len(intervals) // 10] > 0.03
+    assert intervals[-2] < 0.08
+
+
+def test_saturated_link_makes_the_pulse_back_off(clock):
+    host, writes = animate(clock, 2.0, heartbeat_interval=0.02)
+    animator = host.v.animator
+    # same pattern and budget as above, which starts and stays at level 0
+    assert animator.level > 0
+    assert len(writes) < 30
@@ -0,0 +1,98 @@
+import http.client
+import json
+import socket
+
+import pytest
+
+from hc_vitaminder import VitState
+from hc_vitaminder_api import VitApiServer, VitBroadcast
+from hc_vitaminder_sim import LoopbackHost
+
+
+def test_broadcast_since_a_cursor():
+    broadcast = VitBroadcast(3)
+    for i in range(5):
+        broadcast.publish("dev", b"m%d" % i)
+    assert broadcast.since(5) == ([], False)
+    assert [entry_id for entry_id, _, _ in broadcast.since(3)[0]] == [4, 5]
+    assert broadcast.since(2) == (list(broadcast.ring), False)
+    # 1 and 2 fell out of the ring
+    assert broadcast.since(0) == (list(broadcast.ring), True)
+    assert broadcast.published == 5
+
+
+@pytest.fixture
+def api(section, clock):
+    host = LoopbackHost(section, clock=clock).start()
+    server = VitApiServer([host.v], 0).start()
+    assert host.wait_for(lambda: host.v.led_echo_acked == host.v.cfg.led_plan(host.v.state).echo)
+    yield host, server
+    server.stop()
+    host.stop()
+
+
+def request(server, method, path, headers=None):
+    conn = http.client.HTTPConnection("127.0.0.1", server.port, timeout=5)
+    try:
+        conn.request(method, path, headers=headers or {})
+        rsp = conn.getresponse()
+        return rsp.status, json.loads(rsp.read())
+    finally:
+        conn.close()
+
+
+def test_state_and_remote_ok(api):
+    host, server = api
+    status, body = request(server, "GET", "/state")
+    assert status == 200
+    assert [d["state"] for d in body["devices"]] == ["HARD_REMINDER"]
+    assert body["devices"][0]["link_up"] is True
+
+    status, body = request(server, "POST", "/ok")
+    assert (status, body) == (202, {"device": "DEFAULT", "button": "ok"})
+    assert host.wait_for(lambda: host.v.state == VitState.NAILED_IT)
+    assert request(server, "GET", "/state?device=DEFAULT")[1]["state"] == "NAILED_IT"
+
+
+def test_refused_requests(api):
+    host, server = api
+    assert request(server, "POST", "/ok", {"Origin": "http://example.com"})[0] == 403
+    assert request(server, "GET", "/ok")[0] == 405
+    assert request(server, "GET", "/state?device=nope")[0] == 404
+    assert request(server, "GET", "/nowhere")[0] == 404
+    assert host.v.state == VitState.HARD_REMINDER
+    assert server.presses == 0
+
+
+def sse_events(sock):
+    # the response head, then (event, data) for every SSE message, keepalives skipped
+    buf = b""
+    while b"\r\n\r\n" not in buf:
+        buf += sock.recv(4096)
+    head, buf = buf.split(b"\r\n\r\n", 1)
+    yield head
+    while True:
+        while b"\n\n" not in buf:
+            chunk = sock.recv(4096)
+            assert chunk, "stream closed"
+            buf += chunk
+        message, buf = buf.split(b"\n\n", 1)
+        fields = dict(line.split(b": ", 1) for line in message.split(b"\n") if b": " in line)
+        if b"event" in fields:
+            yield fields[b"event"].decode(), json.loads(fields[b"data"])
+
+
+def test_events_stream_state_then_transitions(api):
+    host, server = api
+    with socket.create_connection(("127.0.0.1", server.port), timeout=5) as sock:
+        sock.sendall(b"GET /events HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        events = sse_events(sock)
+        assert next(events).startswith(b"HTTP/1.1 200 OK\r\n")
+        # a new subscriber starts with every device's state
+        event, data = next(events)
+        assert (event, data["state"]) == ("state", "HARD_REMINDER")
+
+        host.press(ok=True)
+        event, data = next(events)
+        assert event == "transition"
+        assert (data["from"], data["state"]) == ("HARD_REMINDER", "NAILED_IT")
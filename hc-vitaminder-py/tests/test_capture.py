@@ -0,0 +1,52 @@
+import os
+
+from hc_vitaminder import VitState
+from hc_vitaminder_capture import CaptureSerial, VitTraceWriter, DIR_IN, DIR_OUT, read_trace, replay
+from hc_vitaminder_sim import LoopbackHost, LoopbackSerial, SimFirmware
+
+
+def capture(path, section, clock, presses):
+    fw = SimFirmware()
+    trace = VitTraceWriter(path)
+    host = LoopbackHost(section, fw, port=CaptureSerial(LoopbackSerial(fw, timeout=0.05), trace), clock=clock)
+    v = host.v
+    v.trace = trace
+    host.start()
+    try:
+        assert host.wait_for(lambda: v.led_echo_acked == v.cfg.led_plan(v.state).echo)
+        for ok, snooze in presses:
+            acked = v.requests.stats()["set_led_rtt"]["count"] + v.requests.stats()["set_pixels_rtt"]["count"]
+            host.press(ok, snooze)
+            assert host.wait_for(lambda: v.requests.stats()["set_led_rtt"]["count"] +
+                                 v.requests.stats()["set_pixels_rtt"]["count"] > acked)
+    finally:
+        host.stop()
+    return v
+
+
+def test_trace_holds_both_directions(tmp_path, section, clock):
+    path = str(tmp_path / "session.vitcap")
+    v = capture(path, section, clock, [(True, False)])
+    started, records = read_trace(path)
+    assert len(records) == v.trace.stats()["records"]
+    assert {direction for _, direction, _ in records} == {DIR_IN, DIR_OUT}
+    assert [ts for ts, _, _ in records] == sorted(ts for ts, _, _ in records)
+
+    # a record cut short by a crash is left out
+    with open(path, "ab") as f:
+        f.write(b"\x00\x01\x02")
+    assert len(read_trace(path)[1]) == len(records)
+
+
+def test_replay_ends_where_the_session_did(tmp_path, section, clock):
+    path = str(tmp_path / "session.vitcap")
+    live = capture(path, section, clock, [(False, True), (True, False)])
+    assert live.state == VitState.NAILED_IT
+
+    v, port, _ = replay(path, section, settle_sec=0.05, clock=clock)
+    stats = port.stats()
+    assert stats["replayed"] == stats["inbound_records"]
+    assert stats["mismatched_writes"] == 0
+    assert v.state == live.state
+    assert v.led_echo_acked == live.led_echo_acked
+    assert os.path.getsize(path) > 0
@@ -0,0 +1,34 @@
+from hc_vitaminder import VitState
+from hc_vitaminder_sim import LoopbackHost
+
+
+def confirmed(v, state):
+    return v.state == state and v.led_echo_acked == v.cfg.led_plan(state).echo
+
+
+def test_ok_press_reaches_the_leds(section, clock):
+    host = LoopbackHost(section, clock=clock).start()
+    v = host.v
+    try:
+        assert host.wait_for(lambda: confirmed(v, VitState.HARD_REMINDER))
+        host.press(ok=True)
+        assert host.wait_for(lambda: confirmed(v, VitState.NAILED_IT))
+        assert tuple(host.firmware.pixels) == v.cfg.led_plan(VitState.NAILED_IT).pixels
+        assert host.alive()
+    finally:
+        host.stop()
+
+
+def test_burst_of_presses_is_drained(section, clock):
+    host = LoopbackHost(section, clock=clock).start()
+    v = host.v
+    try:
+        assert host.wait_for(lambda: confirmed(v, VitState.HARD_REMINDER))
+        host.port.inject(host.firmware.press(True, False) * 2000)
+        assert host.wait_for(lambda: v.decoder.frames >= 2000, timeout=10.0)
+        # whatever the presses added up to, the device ends up showing it
+        assert host.wait_for(lambda: v.msg_queue.qsize() == 0 and confirmed(v, v.state), timeout=5.0)
+        assert host.alive()
+    finally:
+        host.stop()
+    assert not any(t.is_alive() for t in host.threads)
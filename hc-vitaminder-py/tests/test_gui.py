@@ -0,0 +1,136 @@
+import os
+import time
+
+import pytest
+
+pytest.importorskip("PyQt5")
+# no display needed, the widgets render offscreen
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import QMetaObject, QObject, QThread, QTimer, Qt, Q_ARG, pyqtSignal
+from PyQt5.QtWidgets import QApplication
+
+from hc_vitaminder import LedPlan, VitMsg
+from hc_vitaminder_gui import DeviceStateWidget, SerialWorker
+from hc_vitaminder_proto import PIXEL_COUNT, button_frame
+from hc_vitaminder_sim import LoopbackSerial, SimFirmware, VitSimulator
+
+HEARTBEAT = bytes([0, 1, 1, 1, 1, 1, 1, 1])
+
+
+@pytest.fixture(scope="module")
+def app():
+    return QApplication.instance() or QApplication([])
+
+
+class QuietPort:
+    # takes every frame, never answers
+    def __init__(self):
+        self.written = []
+        self.in_waiting = 0
+
+    def write(self, data):
+        self.written.append(bytes(data))
+        return len(data)
+
+    def read(self, size=1):
+        return b""
+
+
+def record(signal):
+    seen = []
+    signal.connect(lambda *args: seen.append(args))
+    return seen
+
+
+def test_frames_wait_for_the_port_then_responses_come_back_as_signals(app):
+    worker = SerialWorker()
+    states = record(worker.device_state)
+    trips = record(worker.round_trip)
+
+    plan = LedPlan(77, [(10, 20, 30)] * PIXEL_COUNT, 0, 0)
+    for frame in plan.v1_frames:
+        worker.send(frame)
+    assert len(worker.outbox) == len(plan.v1_frames)
+
+    firmware = SimFirmware()
+    worker.serial_port = port = LoopbackSerial(firmware, timeout=0)
+    worker.flush()
+    assert not worker.outbox
+    assert port.bytes_written == 8 * len(plan.v1_frames)
+
+    worker.poll()
+    assert states[-1] == (77, (10, 20, 30), (10, 20, 30))
+    assert [kind for kind, _ in trips] == [0x02] * len(plan.v1_frames)
+    assert not any(worker.requests.in_flight.values())
+
+
+def test_a_frame_split_over_two_polls_is_parsed_once(app):
+    worker = SerialWorker()
+    frames = record(worker.frame_received)
+    worker.serial_port = port = LoopbackSerial(SimFirmware(), timeout=0)
+
+    press = button_frame(True, False)
+    port.inject(press[:3])
+    worker.poll()
+    assert frames == []
+    port.inject(press[3:])
+    worker.poll()
+    assert frames == [(VitMsg.SERIAL_BUTTON, bytes(press))]
+
+
+def test_unanswered_requests_time_out_and_the_outbox_is_bounded(app):
+    worker = SerialWorker(request_timeout_sec=0.02, max_outbox=4)
+    timeouts = record(worker.timed_out)
+    for _ in range(10):
+        worker.send(HEARTBEAT)
+    assert len(worker.outbox) == 4
+
+    worker.serial_port = port = QuietPort()
+    worker.flush()
+    assert len(port.written) == 4
+    time.sleep(0.03)
+    worker.poll()
+    assert timeouts == [(0x00,)] * 4
+
+
+class Flood(QObject):
+    send = pyqtSignal(bytes)
+
+
+def test_ui_keeps_60_fps_while_the_device_is_busy(app):
+    # the worker on its thread against a simulated device on a pty, heartbeats every 5 ms and
+    # button presses every 10 ms, the window's own frame pacing has to stay at its 16 ms tick
+    sim = VitSimulator(seed=1)
+    dev = sim.add_device(latency=0.0, boot_delay=0.0, press_every=0.01)
+    sim.start()
+
+    thread = QThread()
+    worker = SerialWorker()
+    worker.moveToThread(thread)
+    thread.started.connect(worker.start)
+    widget = DeviceStateWidget(worker=worker)
+    widget.show()
+    flood = Flood()
+    flood.send.connect(worker.send)
+    heartbeats = QTimer()
+    heartbeats.timeout.connect(lambda: flood.send.emit(HEARTBEAT))
+
+    thread.start()
+    try:
+        QMetaObject.invokeMethod(worker, "open_port", Qt.QueuedConnection, Q_ARG(str, dev.port_name))
+        heartbeats.start(5)
+        QTimer.singleShot(2500, app.quit)
+        app.exec_()
+    finally:
+        heartbeats.stop()
+        QMetaObject.invokeMethod(worker, "close_port", Qt.BlockingQueuedConnection)
+        thread.quit()
+        thread.wait()
+        sim.close()
+
+    assert widget.frames_in > 50
+    assert widget.presses > 20
+    assert widget.rtt.count > 20
+    assert widget.fps >= 55
+    assert widget.fps_worst_gap < 0.05
@@ -0,0 +1,76 @@
+import configparser
+import os
+import threading
+
+import hc_vitaminder_journal
+from hc_vitaminder_journal import VitJournal, HEADER, RECORD, REC_TRANSITION, journal_files
+
+from conftest import ROOT
+
+
+def first_ts(path):
+    with open(path, "rb") as f:
+        return RECORD.unpack_from(f.read(HEADER.size + RECORD.size), HEADER.size)[0]
+
+
+def test_shipped_config_keeps_the_journal_off():
+    configuration = configparser.ConfigParser()
+    configuration.read(os.path.join(ROOT, "hc-vitaminder.ini"))
+    assert configuration["DEFAULT"]["journal_dir"] == ""
+
+
+def test_archives_within_one_second_stay_in_order(tmp_path, monkeypatch):
+    # a dozen rotations stamped with the same second, -0010 has to come after -0002
+    monkeypatch.setattr(hc_vitaminder_journal.time, "strftime", lambda fmt, t=None: "20260105T200000")
+    path = str(tmp_path / "dev.journal")
+    journal = VitJournal(path, snapshot_every=1000, max_records=4)
+    journal.open()
+    for i in range(48):
+        journal.append(REC_TRANSITION, 3, 1, 739000, 0.0, ts=1000.0 + i)
+    journal.close()
+
+    files = journal_files(path)
+    assert len(files) > 10
+    assert os.path.basename(files[-1]) == "dev.journal"
+    stamps = [first_ts(f) for f in files]
+    assert stamps == sorted(stamps)
+
+
+def test_reopen_restores_the_newest_record(tmp_path):
+    path = str(tmp_path / "dev.journal")
+    journal = VitJournal(path)
+    journal.open()
+    for i in range(10):
+        journal.append(REC_TRANSITION, 1 + i % 5, 0, 739000 + i, 0.0, ts=1000.0 + i)
+    journal.close()
+
+    rec = VitJournal(path).open()
+    assert (rec.ts, rec.day, rec.state) == (1009.0, 739009, 5)
+
+
+def test_a_slow_fsync_never_holds_up_the_appends(tmp_path, monkeypatch):
+    # the card takes its time over every fsync, the appends still go straight through
+    release = threading.Event()
+    callers = []
+    real_fsync = os.fsync
+
+    def slow_fsync(fd):
+        callers.append(threading.current_thread())
+        release.wait(5.0)
+        real_fsync(fd)
+
+    monkeypatch.setattr(hc_vitaminder_journal.os, "fsync", slow_fsync)
+    path = str(tmp_path / "dev.journal")
+    journal = VitJournal(path, fsync_batch=4, max_records=50)
+    journal.open()
+    for i in range(200):
+        journal.append(REC_TRANSITION, 3, 2, 740000, 0.0, ts=1767639600.0 + i)
+    assert journal.appended >= 200
+    assert journal.rotations > 0
+    release.set()
+    journal.close()
+
+    assert callers
+    assert threading.current_thread() not in callers
+    assert journal.fsyncs == len(callers)
+    assert sum(os.path.getsize(f) for f in journal_files(path)) > 200 * RECORD.size
@@ -0,0 +1,60 @@
+import time
+
+import pytest
+
+from hc_vitaminder import VitEvent, VitMsg, VitState
+from hc_vitaminder_sim import FlakyLink, LoopbackHost, SimFirmware
+
+from conftest import load_section
+
+LED_REQUESTS = (0x02, 0x0A)
+HEARTBEAT_REQUESTS = (0x00, 0x0C)
+
+
+def confirmed(v):
+    return v.supervisor.up and v.led_echo_acked == v.cfg.led_plan(v.state).echo
+
+
+@pytest.mark.parametrize("mode", ["threads", "async"])
+def test_outage_sends_only_the_newest_state_after_link_up(clock, mode):
+    # solid colors, an animation would keep writing keyframes after the state is confirmed
+    section = load_section(reconnect_initial_sec=0.01, reconnect_max_sec=0.05, blink_soft_off=0, blink_hard_off=0)
+    writes = []
+    link = FlakyLink(SimFirmware(), timeout=0.05, on_write=lambda data: writes.append(data[0]))
+    host = LoopbackHost(section, link.firmware, open_port=link.open, clock=clock, mode=mode).start()
+    v = host.v
+    try:
+        assert host.wait_for(lambda: confirmed(v))
+        link.cut()
+        assert host.wait_for(lambda: not v.supervisor.up)
+        del writes[:]
+
+        before = v.supervisor.stats()
+        for i, state in enumerate((VitState.SOFT_REMINDER, VitState.SNOOZE, VitState.NAILED_IT)):
+            # one at a time, STATE events coalesce in the queue
+            v.state = state
+            v.add_event(VitEvent(VitMsg.STATE))
+            assert host.wait_for(lambda: v.supervisor.stats()["held"] > before["held"] + i)
+            v.add_event(VitEvent(VitMsg.HEARTBEAT, True))
+            assert host.wait_for(lambda: v.supervisor.stats()["dropped"] > before["dropped"] + i)
+        assert v.supervisor.stats()["superseded"] >= before["superseded"] + 2
+        assert len(v.supervisor.outbox) == 1
+        time.sleep(0.1)
+        # nothing reached the wire while the link was down
+        assert not [msg for msg in writes if msg in HEARTBEAT_REQUESTS + LED_REQUESTS]
+
+        del writes[:]
+        link.restore()
+        assert host.wait_for(lambda: confirmed(v))
+        assert v.state == VitState.NAILED_IT
+        assert tuple(link.firmware.pixels) == v.cfg.led_plan(VitState.NAILED_IT).pixels
+        # the held frames for the earlier states never reach the device
+        assert len([msg for msg in writes if msg in LED_REQUESTS]) == 1
+
+        stats = v.supervisor.stats()
+        assert stats["recoveries"] == 1
+        assert stats["recovery"]["count"] == 1
+        assert stats["recovery"]["max"] >= 0.1
+        assert host.alive()
+    finally:
+        host.stop()
@@ -0,0 +1,152 @@
+import pytest
+
+from hc_vitaminder import VitEvent, VitMsg, Vitaminder
+from hc_vitaminder_sim import LoopbackSerial, SimFirmware
+
+from conftest import EVENING, load_section
+
+
+def drain(v):
+    while True:
+        e = v.msg_queue.get(block=False)
+        if e is None:
+            return
+        v.handle_event(e)
+
+
+def test_round_trips_and_contact_share_the_schedule_clock(clock):
+    # no threads: the heartbeat is answered straight away, then the schedule's clock jumps
+    # before the host reads the answer.  the round trip has to include the jump and the
+    # contact has to land on when the heartbeat went out, both on the same clock
+    v = Vitaminder(config=load_section(), clock=clock)
+    port = v.serial_port = LoopbackSerial(SimFirmware(), timeout=0.05)
+    sent_at = clock()
+    v.send_heartbeat()
+    (req,) = [req for queue in v.requests.in_flight.values() for req in queue]
+    assert req.sent_at == pytest.approx(sent_at, abs=0.01)
+
+    clock.jump(30.0)
+    v.handle_serial_bytes(port.read(port.in_waiting))
+    drain(v)
+    assert v.requests.stats()["heartbeat_rtt"]["max"] >= 30.0
+    assert v.liveness.last_contact == pytest.approx(sent_at, abs=0.01)
+
+
+class ManualClock:
+    def __init__(self, start=EVENING):
+        self.now = start.timestamp()
+
+    def __call__(self):
+        return self.now
+
+
+class Timer:
+    def __init__(self, when):
+        self.when = when
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Timers:
+    # stands in for VitScheduler: keeps the timers, nothing fires by itself
+    def __init__(self, clock):
+        self.clock = clock
+
+    def call_at(self, when, callback, *args):
+        return Timer(when)
+
+    def call_later(self, delay, callback, *args):
+        return Timer(self.clock() + delay)
+
+
+@pytest.fixture
+def link():
+    clock = ManualClock()
+    v = Vitaminder(config=load_section(), clock=clock)
+    port = v.serial_port = LoopbackSerial(SimFirmware(), timeout=0.05)
+    v.scheduler = Timers(clock)
+    v.schedule_heartbeat(clock())
+    return v, port, clock
+
+
+def answer(v, port):
+    v.handle_serial_bytes(port.read(port.in_waiting))
+    drain(v)
+
+
+def set_led(v, port):
+    # what a state change does: new frames out, the device acks them
+    v.led_echo_acked = None
+    v.send_set_led_message()
+    answer(v, port)
+
+
+def fire_heartbeat(v, port, clock):
+    clock.now = v.heartbeat_timer.when
+    v.add_event(VitEvent(VitMsg.HEARTBEAT))
+    drain(v)
+    answer(v, port)
+
+
+def test_a_set_led_ack_defers_the_heartbeat(link):
+    v, port, clock = link
+    quiet = v.liveness.quiet_sec
+    clock.now += quiet - 60.0
+    set_led(v, port)
+    contact = v.liveness.last_contact
+    assert contact == clock.now
+
+    fire_heartbeat(v, port, clock)
+    assert port.in_waiting == 0
+    assert (v.liveness.heartbeats_sent, v.liveness.heartbeats_skipped) == (0, 1)
+    # next look is a full quiet time after the ack, not after the skipped heartbeat
+    assert v.heartbeat_timer.when == contact + quiet
+
+
+def test_a_quiet_link_heartbeats_before_the_solitude_timer_can_run_out(link):
+    v, port, clock = link
+    set_led(v, port)
+    contact = v.liveness.last_contact
+    fire_heartbeat(v, port, clock)
+    assert v.liveness.heartbeats_sent == 1
+    sent_after = v.liveness.last_contact - contact
+    # the heartbeat and every retry of it fit before device_solitude_sec, with heartbeat_margin_sec to spare
+    assert sent_after == v.liveness.quiet_sec
+    assert sent_after + v.cfg.liveness_margin_sec <= v.cfg.device_solitude_sec
+    assert v.liveness.quiet_sec == 260.0
+
+
+def test_an_idle_link_pays_extra_heartbeats_and_saves_none(link):
+    v, port, clock = link
+    end = clock.now + 86400.0
+    while v.heartbeat_timer.when <= end:
+        fire_heartbeat(v, port, clock)
+    clock.now = end
+    stats = v.liveness.stats()
+    assert stats["heartbeats_sent"] == 86400 // 260
+    assert stats["fixed_heartbeats"] == 86400 // 300 + 1
+    assert stats["heartbeats_saved"] == 0 and stats["airtime_saved_sec"] == 0
+    assert stats["heartbeats_extra"] == stats["heartbeats_sent"] - stats["fixed_heartbeats"]
+    assert stats["heartbeats_skipped"] == 0
+
+
+def test_a_busy_link_counts_what_its_answers_stood_in_for(link):
+    v, port, clock = link
+    start = clock.now
+    end = start + 3600.0
+    for minute in range(1, 61):
+        led_at = start + 60.0 * minute
+        while v.heartbeat_timer.when < led_at:
+            fire_heartbeat(v, port, clock)
+        clock.now = led_at
+        set_led(v, port)
+    stats = v.liveness.stats()
+    assert clock.now == end
+    assert stats["heartbeats_sent"] == 0
+    # a look quiet_sec after the last answer, which is 20 s before the next set-LED: every 240 s
+    assert stats["heartbeats_skipped"] == len(range(260, 3600, 240))
+    assert stats["piggybacked"] == 3600 // 260 + 1
+    assert stats["heartbeats_saved"] == stats["fixed_heartbeats"] == 3600 // 300 + 1
+    assert stats["heartbeats_extra"] == 0
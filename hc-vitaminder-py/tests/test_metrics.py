@@ -0,0 +1,27 @@
+from hc_vitaminder import Vitaminder
+from hc_vitaminder_metrics import HANDLER_BOUNDS, Histogram, MetricsText, collect_device
+
+from conftest import load_section
+
+
+def scrape(v):
+    text = MetricsText()
+    collect_device(text, v)
+    return text.render()
+
+
+def test_scrape_between_histogram_and_count():
+    # where a scrape can land while the controller handles a new event type for the first time
+    v = Vitaminder(config=load_section())
+    v.metrics.handler_seconds["CLOCK"] = Histogram(HANDLER_BOUNDS)
+    text = scrape(v)
+    assert 'vitaminder_events_total{device="DEFAULT",type="CLOCK"} 0' in text
+
+
+def test_handled_events_are_counted():
+    v = Vitaminder(config=load_section())
+    for _ in range(3):
+        v.metrics.event_handled("CLOCK", 0.00002)
+    text = scrape(v)
+    assert 'vitaminder_events_total{device="DEFAULT",type="CLOCK"} 3' in text
+    assert 'vitaminder_handler_seconds_count{device="DEFAULT",type="CLOCK"} 3' in text
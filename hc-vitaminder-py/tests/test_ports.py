@@ -0,0 +1,76 @@
+import itertools
+import os
+
+import pytest
+
+from hc_vitaminder_ports import PortDiscovery
+
+pytest.importorskip("serial.tools.list_ports_linux")
+
+# some filesystems only keep coarse timestamps, make every change move /dev's mtime
+TICKS = itertools.count(1)
+
+
+def changed(dev_dir):
+    os.utime(dev_dir, ns=(0, next(TICKS) * 1000000000))
+
+
+def make_node(dev_dir, name):
+    open(os.path.join(dev_dir, name), "w").close()
+    changed(dev_dir)
+
+
+@pytest.fixture
+def dev_dir(tmp_path):
+    for i in range(4):
+        make_node(str(tmp_path), "rfcomm%d" % i)
+    make_node(str(tmp_path), "not-a-port")
+    return str(tmp_path)
+
+
+def test_first_scan_lists_the_nodes_and_later_ones_probe_nothing(dev_dir):
+    heard = []
+    discovery = PortDiscovery(dev_dir=dev_dir, incremental=True)
+    discovery.add_listener(lambda added, removed: heard.append(([p.device for p in added], removed)))
+
+    added, removed = discovery.refresh()
+    expected = [os.path.join(dev_dir, "rfcomm%d" % i) for i in range(4)]
+    assert [p.device for p in added] == expected
+    assert [p.device for p in discovery.ports()] == expected
+    assert heard == [(expected, [])]
+    probes = discovery.probes
+
+    assert discovery.refresh() == ([], [])
+    assert discovery.probes == probes
+    assert len(heard) == 1
+
+
+def test_new_and_removed_nodes_are_reported(dev_dir):
+    discovery = PortDiscovery(dev_dir=dev_dir, incremental=True)
+    discovery.refresh()
+    probes = discovery.probes
+
+    make_node(dev_dir, "ttyUSB0")
+    added, removed = discovery.refresh()
+    assert [p.device for p in added] == [os.path.join(dev_dir, "ttyUSB0")]
+    assert removed == []
+    # only the new node was probed
+    assert discovery.probes == probes + 1
+
+    os.remove(os.path.join(dev_dir, "rfcomm2"))
+    changed(dev_dir)
+    assert discovery.refresh() == ([], [os.path.join(dev_dir, "rfcomm2")])
+    assert not discovery.has(os.path.join(dev_dir, "rfcomm2"))
+
+
+def test_node_replaced_between_two_rounds_is_a_replug(dev_dir):
+    discovery = PortDiscovery(dev_dir=dev_dir, incremental=True)
+    discovery.refresh()
+
+    path = os.path.join(dev_dir, "rfcomm0")
+    os.remove(path)
+    make_node(dev_dir, "rfcomm0")
+    added, removed = discovery.refresh()
+    assert [p.device for p in added] == [path]
+    assert removed == [path]
+    assert discovery.has(path)
@@ -0,0 +1,122 @@
+from hc_vitaminder import VitEvent, VitMsg, VitState, FRAME_TYPES
+from hc_vitaminder_proto import VitFrameDecoder, MSG_REQ_HELLO, MSG_REQ_SET_LED, MSG_REQ_SET_PIXELS, \
+    MSG_RSP_HEARTBEAT_V2, MSG_RSP_SET_PIXELS, PROTO_V1, PROTO_V2, sequenced
+from hc_vitaminder_sim import LoopbackHost, LoopbackSerial, SimFirmware
+
+from conftest import load_section
+
+# state changes that need every pixel group, sys gets its own color
+# a pixel echo without any byte that is also a frame ID
+ECHO = bytes([30, 0x40, 0x41, 0x42, 0x43, 0x44, 0x45])
+
+STATES = [VitState.SOFT_REMINDER, VitState.HARD_REMINDER, VitState.SNOOZE, VitState.NAILED_IT,
+          VitState.UNMEDICATED]
+
+
+def split_section(host_version):
+    section = load_section(protocol_version=host_version, request_timeout_sec=0.05)
+    for key in ("unmedicated", "nailed_it", "soft_reminder", "hard_reminder", "snooze"):
+        section["sys_color_" + key] = "0,0,64"
+    return section
+
+
+def confirmed(v):
+    return v.led_echo_acked == v.cfg.led_plan(v.state).echo
+
+
+def test_v2_is_negotiated_with_v2_firmware(clock):
+    host = LoopbackHost(load_section(protocol_version=2), SimFirmware(protocol=2), clock=clock).start()
+    try:
+        assert host.wait_for(lambda: host.v.protocol == PROTO_V2)
+        assert host.wait_for(lambda: confirmed(host.v))
+        assert host.firmware.crc_errors == 0
+    finally:
+        host.stop()
+
+
+def test_hello_timeout_falls_back_to_v1(clock):
+    written = []
+    host = LoopbackHost(split_section(2), SimFirmware(protocol=1), clock=clock,
+                        on_write=lambda data: written.append(data[0])).start()
+    v = host.v
+    try:
+        assert host.wait_for(lambda: v.requests.stats()["timeouts"] >= 1)
+        assert host.wait_for(lambda: confirmed(v))
+        assert v.protocol == PROTO_V1
+        # v1 firmware never answers, no point asking again
+        assert written.count(MSG_REQ_HELLO) == 1
+        assert MSG_REQ_SET_PIXELS not in written
+        assert MSG_REQ_SET_LED in written
+    finally:
+        host.stop()
+
+
+def test_decoder_drops_a_frame_with_a_bad_crc():
+    good = sequenced(MSG_RSP_HEARTBEAT_V2, 7, ECHO)
+    bad = bytearray(sequenced(MSG_RSP_HEARTBEAT_V2, 6, ECHO))
+    bad[-1] ^= 0x5A
+    decoder = VitFrameDecoder(FRAME_TYPES)
+    frames = [(t, bytes(f)) for t, f in decoder.feed(bytes(bad) + good)]
+    assert frames == [(VitMsg.SERIAL_HEARTBEAT_RSP, good)]
+    assert decoder.bad_frames >= 1
+    assert decoder.resyncs == 1
+
+
+class CorruptingSerial(LoopbackSerial):
+    # damages the CRC of the first SET_PIXELS response on its way to the host
+    def __init__(self, firmware):
+        LoopbackSerial.__init__(self, firmware, timeout=0.05)
+        self.corrupted = 0
+
+    def inject(self, data):
+        if data[0] == MSG_RSP_SET_PIXELS and not self.corrupted:
+            self.corrupted += 1
+            data = bytes(data[:-1]) + bytes([data[-1] ^ 0xFF])
+        LoopbackSerial.inject(self, data)
+
+
+def test_bad_crc_response_is_dropped_and_the_request_retried(clock):
+    fw = SimFirmware(protocol=2)
+    port = CorruptingSerial(fw)
+    host = LoopbackHost(split_section(2), fw, port=port, clock=clock).start()
+    v = host.v
+    try:
+        assert host.wait_for(lambda: v.protocol == PROTO_V2)
+        v.state = VitState.SOFT_REMINDER
+        v.add_event(VitEvent(VitMsg.STATE))
+        assert host.wait_for(lambda: port.corrupted == 1 and confirmed(v))
+        assert v.decoder.bad_frames >= 1
+        assert v.requests.stats()["timeouts"] >= 1
+        assert tuple(fw.pixels) == v.cfg.led_plan(v.state).pixels
+    finally:
+        host.stop()
+
+
+def air_bytes_per_change(host_version):
+    # bytes both ways and frames out per state change, like bench proto
+    fw = SimFirmware(protocol=host_version)
+    host = LoopbackHost(split_section(host_version), fw, timers=False).start()
+    v = host.v
+    try:
+        v.send_hello()
+        assert host.wait_for(lambda: v.protocol == host_version)
+        port = host.port
+        out_before, in_before, frames_before = port.bytes_written, port.bytes_read, v.metrics.serial_frames_out
+        for state in STATES * 4:
+            v.state = state
+            v.add_event(VitEvent(VitMsg.STATE))
+            assert host.wait_for(lambda: confirmed(v))
+            assert tuple(fw.pixels) == v.cfg.led_plan(state).pixels
+        changes = len(STATES) * 4
+        return ((port.bytes_written - out_before + port.bytes_read - in_before) / changes,
+                (v.metrics.serial_frames_out - frames_before) / changes)
+    finally:
+        host.stop()
+
+
+def test_set_pixels_saves_bytes_on_air_over_per_pixel_v1_frames():
+    v1_bytes, v1_frames = air_bytes_per_change(PROTO_V1)
+    v2_bytes, v2_frames = air_bytes_per_change(PROTO_V2)
+    assert v2_frames == 1.0
+    assert v1_frames > 1.0
+    assert v2_bytes < v1_bytes
@@ -0,0 +1,62 @@
+import threading
+
+from hc_vitaminder import VitEvent, VitMsg, EVENT_PRIORITIES, COALESCED_EVENTS, TIMER_EVENTS
+from hc_vitaminder_queue import VitEventQueue
+
+
+def full_queue(maxsize=4):
+    q = VitEventQueue(EVENT_PRIORITIES, COALESCED_EVENTS, maxsize=maxsize, unbounded=TIMER_EVENTS)
+    for _ in range(maxsize):
+        assert q.put(VitEvent(VitMsg.SERIAL_BUTTON, b"x"), block=False)
+    assert q.full()
+    return q
+
+
+def test_priorities_and_fifo_inside_a_band():
+    q = VitEventQueue(EVENT_PRIORITIES, COALESCED_EVENTS)
+    for e in (VitEvent(VitMsg.HEARTBEAT), VitEvent(VitMsg.STATE), VitEvent(VitMsg.SERIAL_BUTTON, 1),
+              VitEvent(VitMsg.SERIAL_BUTTON, 2), VitEvent(VitMsg.EXIT)):
+        q.put(e)
+    order = [(e.event_id, e.data) for e in iter(lambda: q.get(block=False), None)]
+    assert order == [(VitMsg.EXIT, None), (VitMsg.SERIAL_BUTTON, 1), (VitMsg.SERIAL_BUTTON, 2),
+                     (VitMsg.STATE, None), (VitMsg.HEARTBEAT, None)]
+
+
+def test_producers_wait_for_room():
+    q = full_queue()
+    assert not q.put(VitEvent(VitMsg.SERIAL_BUTTON, b"y"), block=False)
+    assert not q.put(VitEvent(VitMsg.SERIAL_BUTTON, b"y"), timeout=0.01)
+    assert q.stats()["blocked_puts"] == 1
+
+
+def test_timer_events_never_block_on_a_full_queue():
+    # the scheduler thread is shared by every device, it must not wait on any one of them
+    q = full_queue()
+    done = threading.Event()
+
+    def timers():
+        for event_id in (VitMsg.CLOCK, VitMsg.REQUEST_TIMEOUT, VitMsg.ANIMATE, VitMsg.HEARTBEAT):
+            q.put(VitEvent(event_id))
+        done.set()
+
+    t = threading.Thread(target=timers)
+    t.start()
+    assert done.wait(1.0)
+    t.join()
+    assert q.qsize() == 8
+    assert q.stats()["blocked_puts"] == 0
+    assert q.stats()["over_bound"] == 4
+
+
+def test_forced_heartbeat_upgrades_a_pending_one():
+    q = VitEventQueue(EVENT_PRIORITIES, COALESCED_EVENTS)
+    assert q.put(VitEvent(VitMsg.HEARTBEAT))
+    assert not q.put(VitEvent(VitMsg.HEARTBEAT, True))
+    # a plain one coming after doesn't take the force away again
+    assert not q.put(VitEvent(VitMsg.HEARTBEAT))
+    e = q.get(block=False)
+    assert (e.event_id, e.data) == (VitMsg.HEARTBEAT, True)
+    assert q.empty()
+    assert q.stats()["coalesced"] == 2
+    # taken, so the next one queues again
+    assert q.put(VitEvent(VitMsg.HEARTBEAT))
@@ -0,0 +1,80 @@
+import configparser
+import logging
+import os
+
+import pytest
+
+from hc_vitaminder import VitState
+from hc_vitaminder_reload import ConfigWatcher
+from hc_vitaminder_sim import LoopbackHost
+
+from conftest import load_section
+
+
+def write_config(path, **overrides):
+    configuration = configparser.ConfigParser()
+    configuration["DEFAULT"] = dict(load_section(**overrides))
+    with open(path, "w") as f:
+        configuration.write(f)
+    # a new mtime even on filesystems with coarse timestamps
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000000000))
+
+
+@pytest.fixture
+def reloading(tmp_path, clock):
+    path = str(tmp_path / "hc-vitaminder.ini")
+    write_config(path)
+    host = LoopbackHost(load_section(), clock=clock).start()
+    v = host.v
+    watcher = ConfigWatcher(path, lambda configuration: v.reload_config(configuration["DEFAULT"]), interval=0)
+    assert host.wait_for(lambda: v.led_echo_acked == v.cfg.led_plan(VitState.HARD_REMINDER).echo)
+    yield path, host, watcher
+    host.stop()
+
+
+def test_unchanged_file_is_not_read_again(reloading):
+    path, host, watcher = reloading
+    assert watcher.check() is False
+    assert watcher.stats() == {"checks": 1, "reloads": 0, "rejected": 0}
+
+
+def test_broken_configs_keep_the_running_one(reloading):
+    path, host, watcher = reloading
+    cfg = host.v.cfg
+
+    with open(path, "w") as f:
+        f.write("[DEFAULT\ncomm_port = loopback\n")
+    assert watcher.check() is False
+    write_config(path, request_timeout_sec="0")
+    assert watcher.check() is False
+    write_config(path, color_hard_reminder="not,a,color")
+    assert watcher.check() is False
+
+    assert watcher.rejected == 3
+    assert watcher.reloads == 0
+    assert host.v.cfg is cfg
+
+
+def test_color_change_reaches_the_device(reloading):
+    path, host, watcher = reloading
+    v = host.v
+    write_config(path, color_hard_reminder="0,0,255")
+    assert watcher.check() is True
+    assert host.wait_for(lambda: v.cfg.led_plan(VitState.HARD_REMINDER).pixels[1] == (0, 0, 255))
+    assert host.wait_for(lambda: tuple(host.firmware.pixels) == v.cfg.led_plan(VitState.HARD_REMINDER).pixels)
+    assert v.state == VitState.HARD_REMINDER
+    assert watcher.reloads == 1
+
+
+def test_restart_settings_only_warn(reloading, caplog):
+    path, host, watcher = reloading
+    v = host.v
+    with caplog.at_level(logging.WARNING, logger="hc_vitaminder"):
+        write_config(path, journal_fsync_batch="8", msg_size="8")
+        assert watcher.check() is True
+        assert host.wait_for(lambda: v.cfg.journal_fsync_batch == 8)
+    warned = [r.getMessage() for r in caplog.records if "next restart" in r.getMessage()]
+    assert warned == ["DEFAULT: journal_fsync_batch changed, it takes effect on the next restart"]
+    assert v.journal is None
+    assert host.alive()
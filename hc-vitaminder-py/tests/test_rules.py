@@ -0,0 +1,49 @@
+from datetime import datetime, timedelta
+
+from hc_vitaminder_rules import Medication, cached_index, compile_rules, parse_days, parse_windows, \
+    INDEX_CACHE_SIZE, LEVEL_SOFT, LEVEL_UNMEDICATED, LEVEL_HARD, week_us
+
+
+def medications(shift=0):
+    return [
+        Medication("morning", {LEVEL_UNMEDICATED: parse_windows("05:00:00-08:00:00"),
+                               LEVEL_SOFT: parse_windows("08:00:00-%02d:30:00" % (10 + shift))}),
+        Medication("evening", {LEVEL_UNMEDICATED: parse_windows("12:00:00-18:00:00"),
+                               LEVEL_SOFT: parse_windows("18:00:00-20:00:00"),
+                               LEVEL_HARD: parse_windows("20:00:00-01:00:00")}, parse_days("mon-fri"), 600),
+    ]
+
+
+def scan(meds, when):
+    # what each medication is due for, straight from its own timeline
+    levels = []
+    for m in meds:
+        starts, due = m.timeline()
+        now = week_us(when)
+        levels.append([level for start, level in zip(starts, due) if start <= now][-1])
+    return tuple(levels)
+
+
+def test_index_matches_a_scan_of_every_medication():
+    meds = medications()
+    index = compile_rules(meds)
+    when = datetime(2026, 1, 5)
+    while when < datetime(2026, 1, 12):
+        assert index.levels_at(when) == scan(meds, when), when
+        boundary = index.next_boundary(when)
+        assert boundary > when
+        if week_us(boundary):
+            # monday 00:00 always starts a segment, the others are real changes
+            assert index.levels_at(boundary) != index.levels_at(boundary - timedelta(microseconds=1))
+        when += timedelta(minutes=7)
+
+
+def test_same_schedule_shares_one_index():
+    assert compile_rules(medications()) is compile_rules(medications())
+    assert compile_rules(medications()).snooze_deltas == (timedelta(seconds=900), timedelta(seconds=600))
+
+
+def test_index_cache_is_bounded():
+    for shift in range(2 * INDEX_CACHE_SIZE):
+        compile_rules(medications(shift % 10) + [Medication("extra%d" % shift, {})])
+    assert cached_index.cache_info().currsize <= INDEX_CACHE_SIZE
@@ -0,0 +1,198 @@
+import configparser
+import logging
+
+import pytest
+
+from hc_vitaminder_shard import SEQ, ROW_SIZE, ShardSupervisor, StateTable
+
+
+class FakeProcess:
+    def __init__(self, pid):
+        self.pid = pid
+        self.exitcode = None
+
+    def is_alive(self):
+        return self.exitcode is None
+
+    def kill(self):
+        self.exitcode = -9
+
+
+class FakeControl:
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    def put(self, msg):
+        self.sent.append(msg)
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSupervisor(ShardSupervisor):
+    # workers that are just objects: they are alive until killed, and keep what they are sent
+    def spawn(self, shard):
+        self.spawned = getattr(self, "spawned", 0) + 1
+        self.workers[shard] = (FakeProcess(1000 + self.spawned), FakeControl(), self.clock())
+
+
+class StepClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def fleet_config(devices, journal_dir=""):
+    configuration = configparser.ConfigParser()
+    configuration["DEFAULT"]["journal_dir"] = journal_dir
+    for n in range(devices):
+        configuration["dev%d" % n] = {"comm_port": "loopback"}
+    return configuration
+
+
+@pytest.fixture
+def table():
+    table = StateTable(4)
+    yield table
+    table.close()
+
+
+@pytest.fixture
+def supervisor():
+    clock = StepClock()
+    supervisor = FakeSupervisor("fleet.ini", fleet_config(6, journal_dir="/var/lib/vitaminder"), shards=3,
+                                clock=clock)
+    # not start(), that would take over SIGHUP for the test run
+    for shard in range(supervisor.shards):
+        supervisor.spawn(shard)
+    yield supervisor
+    supervisor.table.close()
+
+
+def kill(supervisor, shard):
+    process, control, _ = supervisor.workers[shard]
+    process.kill()
+    return control
+
+
+def test_rows_read_back_what_was_written(table):
+    assert table.read(0) is None
+    table.write(0, 3, 1, 2, 10.0, 20.0, 30.0)
+    table.write(1, 1, 0, 0, 0.0, 0.0, 5.0)
+    table.write(0, 4, 0, 2, 11.0, 21.0, 31.0)
+    assert table.read(0) == (4, 0, 2, 11.0, 21.0, 31.0)
+    assert table.read(1) == (1, 0, 0, 0.0, 0.0, 5.0)
+    assert table.read(2) is None
+    assert SEQ.unpack_from(table.view(), 0)[0] == 4
+
+
+def test_a_worker_killed_mid_write_does_not_hide_the_row(table):
+    # the dead worker got as far as making seq odd.  the adopting worker's writes have to
+    # come out even, or every read gives up and the device drops off the fleet for good
+    table.write(2, 1, 1, 0, 0.0, 0.0, 1.0)
+    SEQ.pack_into(table.view(), 2 * ROW_SIZE, 3)
+    assert table.read(2) is None
+    for n in range(3):
+        table.write(2, 2, 1, 1, 0.0, 0.0, 2.0 + n)
+        assert table.read(2) == (2, 1, 1, 0.0, 0.0, 2.0 + n)
+        assert SEQ.unpack_from(table.view(), 2 * ROW_SIZE)[0] % 2 == 0
+
+
+def test_the_seq_wrap_skips_zero(table):
+    SEQ.pack_into(table.view(), 3 * ROW_SIZE, 0xFFFFFFFE)
+    table.write(3, 1, 0, 0, 0.0, 0.0, 1.0)
+    assert SEQ.unpack_from(table.view(), 3 * ROW_SIZE)[0] == 2
+    assert table.read(3) == (1, 0, 0, 0.0, 0.0, 1.0)
+
+
+def test_a_dead_workers_devices_go_to_the_live_ones(supervisor):
+    assert {shard: len(assigned) for shard, assigned in supervisor.assigned.items()} == {0: 2, 1: 2, 2: 2}
+    orphans = list(supervisor.assigned[0])
+    control = kill(supervisor, 0)
+    supervisor.check()
+
+    assert control.closed
+    assert supervisor.assigned[0] == []
+    assert supervisor.pending == []
+    sent = [device for shard in (1, 2) for msg in supervisor.workers[shard][1].sent for device in msg]
+    assert sorted(sent) == sorted(orphans)
+    assert {shard: len(supervisor.assigned[shard]) for shard in (1, 2)} == {1: 3, 2: 3}
+    assert 0 not in supervisor.workers
+    stats = supervisor.stats()
+    assert (stats["deaths"], stats["moved"], stats["restarts"]) == (1, 2, 0)
+
+
+def test_the_dead_worker_comes_back_empty_after_its_backoff(supervisor):
+    clock = supervisor.clock
+    kill(supervisor, 0)
+    supervisor.check()
+    delay = supervisor.restart_at[0] - clock.now
+    # the first backoff step is 1s, jittered down by at most half
+    assert 0.5 <= delay <= 1.0
+
+    clock.now += delay / 2
+    supervisor.check()
+    assert 0 not in supervisor.workers
+
+    clock.now += delay
+    supervisor.check()
+    assert 0 in supervisor.workers and supervisor.restarts == 1
+    assert supervisor.assigned[0] == [] and supervisor.workers[0][1].sent == []
+
+    # nothing is handed back, but it is first in line for the next dead worker's devices
+    orphans = list(supervisor.assigned[1])
+    kill(supervisor, 1)
+    supervisor.check()
+    assert supervisor.assigned[0] == orphans[:3]
+    assert len(supervisor.assigned[2]) == 3
+
+
+def test_the_backoff_grows_on_quick_deaths_and_resets_after_a_long_run(supervisor):
+    clock = supervisor.clock
+    delays = []
+    for _ in range(3):
+        kill(supervisor, 2)
+        supervisor.check()
+        delays.append(supervisor.restart_at[2] - clock.now)
+        clock.now += delays[-1]
+        supervisor.check()
+    # nominal 1s, 2s, 4s, each jittered down by at most half
+    assert 0.5 <= delays[0] <= 1.0
+    assert 1.0 <= delays[1] <= 2.0
+    assert 2.0 <= delays[2] <= 4.0
+
+    clock.now += supervisor.backoff[2].maximum + 1.0
+    kill(supervisor, 2)
+    supervisor.check()
+    assert 0.5 <= supervisor.restart_at[2] - clock.now <= 1.0
+
+
+def test_devices_wait_while_no_worker_is_alive(supervisor):
+    clock = supervisor.clock
+    for shard in range(3):
+        kill(supervisor, shard)
+    supervisor.check()
+    assert len(supervisor.pending) == 6
+    assert supervisor.workers == {}
+
+    clock.now = max(supervisor.restart_at.values())
+    supervisor.check()
+    assert supervisor.pending == []
+    assert sorted(len(assigned) for assigned in supervisor.assigned.values()) == [2, 2, 2]
+    assert supervisor.moved == 6
+
+
+def test_sharding_without_a_journal_warns(caplog):
+    with caplog.at_level(logging.WARNING, logger="hc_vitaminder"):
+        supervisor = FakeSupervisor("fleet.ini", fleet_config(2), shards=2, clock=StepClock())
+    supervisor.table.close()
+    assert "no journal_dir for dev0, dev1" in caplog.text
+
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger="hc_vitaminder"):
+        supervisor = FakeSupervisor("fleet.ini", fleet_config(2, journal_dir="/tmp"), shards=2, clock=StepClock())
+    supervisor.table.close()
+    assert "journal_dir" not in caplog.text
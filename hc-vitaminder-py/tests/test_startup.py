@@ -0,0 +1,65 @@
+import io
+import os
+import pickle
+import shutil
+import sys
+import types
+
+import hc_vitaminder_startup
+from hc_vitaminder import VitConfig
+from hc_vitaminder_startup import SNAPSHOT_MODULES, load_config_snapshot, save_config_snapshot
+
+from conftest import ROOT, load_section
+
+
+def snapshot_config(tmp_path):
+    config_file = str(tmp_path / "hc-vitaminder.ini")
+    shutil.copy(os.path.join(ROOT, "hc-vitaminder.ini"), config_file)
+    return config_file
+
+
+def test_snapshot_round_trip(tmp_path):
+    config_file = snapshot_config(tmp_path)
+    cfg = VitConfig(load_section())
+    save_config_snapshot(config_file, cfg)
+    loaded = load_config_snapshot(config_file)
+    assert loaded is not None
+    assert loaded.led_plans.keys() == cfg.led_plans.keys()
+
+
+def test_editing_any_snapshot_module_invalidates_it(tmp_path, monkeypatch):
+    config_file = snapshot_config(tmp_path)
+    save_config_snapshot(config_file, VitConfig(load_section()))
+    real_stat = os.stat
+
+    for name in SNAPSHOT_MODULES:
+        def stat(path, *args, **kwargs):
+            st = real_stat(path, *args, **kwargs)
+            if os.path.basename(path) == name:
+                return types.SimpleNamespace(st_mtime_ns=st.st_mtime_ns + 1, st_size=st.st_size)
+            return st
+        monkeypatch.setattr(hc_vitaminder_startup.os, "stat", stat)
+        assert load_config_snapshot(config_file) is None, name
+    monkeypatch.undo()
+    assert load_config_snapshot(config_file) is not None
+
+
+class ModuleRecorder(pickle.Pickler):
+    def __init__(self, f):
+        pickle.Pickler.__init__(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.modules = set()
+
+    def reducer_override(self, obj):
+        self.modules.add(type(obj).__module__)
+        if isinstance(obj, type):
+            self.modules.add(obj.__module__)
+        return NotImplemented
+
+
+def test_every_module_in_the_pickle_is_keyed():
+    recorder = ModuleRecorder(io.BytesIO())
+    recorder.dump(VitConfig(load_section()))
+    ours = {name for name in recorder.modules if name.startswith("hc_vitaminder")}
+    assert {"hc_vitaminder", "hc_vitaminder_anim", "hc_vitaminder_rules"} <= ours
+    for name in ours:
+        assert os.path.basename(sys.modules[name].__file__) in SNAPSHOT_MODULES
@@ -0,0 +1,58 @@
+import time
+from datetime import date
+
+import pytest
+
+from hc_vitaminder_timesim import DaySimulation, parse_press, sim_config
+
+from conftest import load_section
+
+PRESSES = [parse_press("19:05 snooze"), parse_press("19:30 ok")]
+
+
+def simulate(days, **kwargs):
+    sim = DaySimulation(sim_config(load_section()), days, start=date(2026, 1, 5), presses=PRESSES, **kwargs)
+    return sim, sim.report(sim.run())
+
+
+def test_a_week_follows_the_schedule():
+    _, result = simulate(7)
+    assert result["off_schedule"] == 0
+    assert result["solitude_errors"] == 0
+    assert result["presses"] == 14
+    assert result["nailed_days"] == 7
+    # every day takes the same path through the states
+    for counts in result["transition_times"].values():
+        assert len(counts) == 1
+
+
+def test_jittered_and_forgotten_days_stay_on_schedule():
+    _, result = simulate(60, jitter_sec=600.0, skip_prob=0.2, seed=7)
+    assert result["off_schedule"] == 0
+    assert result["solitude_errors"] == 0
+    assert result["skipped_days"] > 0
+    assert result["nailed_days"] == 60 - result["skipped_days"]
+    assert result["liveness"]["heartbeats_sent"] > 0
+
+
+@pytest.fixture
+def new_york(monkeypatch):
+    # a fixed zone with DST changes, whatever the machine running the tests is set to
+    if not hasattr(time, "tzset"):
+        pytest.skip("no tzset here")
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.parametrize("start", [date(2026, 10, 20), date(2026, 2, 25)])
+def test_presses_keep_their_wall_clock_time_across_dst(new_york, start):
+    # 2026-11-01 and 2026-03-08 are in there, the presses stay at 19:05 and 19:30 all along
+    sim = DaySimulation(sim_config(load_section()), 30, start=start, presses=PRESSES)
+    result = sim.report(sim.run())
+    times = result["transition_times"]
+    assert times["HARD_REMINDER -> SNOOZE"] == {"19:05:00": 30}
+    assert times["HARD_REMINDER -> NAILED_IT"] == {"19:30:00": 30}
+    assert result["off_schedule"] == 0